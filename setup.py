@@ -38,6 +38,11 @@ setup(name='SnakeMUD',
       main = snakemud:main
       [console_scripts]
       snakemud = snakemud.interpreter:main
+      snakemud-benchmark = snakemud.benchmark:main
+      snakemud-grid = snakemud.levels:main
+      snakemud-simulate = snakemud.simulate:main
+      snakemud-telnet = snakemud.telnet:main
+      snakemud-telnet-loadtest = snakemud.telnet:load_test_main
       """,
       )
 
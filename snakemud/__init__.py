@@ -1,15 +1,76 @@
+import os
+
 from pyramid.config import Configurator
+from pyramid.settings import asbool
 from pyramid_beaker import session_factory_from_settings
 
+from .caves import caves
+from .levels import levels
+from .live import flush_on_sigterm, live_games
+from . import metrics
+
+
+def saved_bytes(session):
+    """The size of the file a session was saved in, or None if it's not
+    in a file."""
+    namespace = getattr(session.__dict__.get('_sess'), 'namespace', None)
+    filename = getattr(namespace, 'file', None)
+    if filename is None:
+        return None
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return None
+
+
+def timed_session_factory(factory):
+    """Make a session factory that records how long saving sessions takes,
+    and how big they are."""
+    class TimedSession(factory):
+        def persist(self):
+            if not self.__dict__.get('_dirty'):
+                # nothing to save
+                return factory.persist(self)
+            with metrics.session_save_seconds.time():
+                result = factory.persist(self)
+            size = saved_bytes(self)
+            if size is not None:
+                metrics.session_state_bytes.observe(size)
+            return result
+    return TimedSession
+
+
 def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application.
     """
     session_factory = session_factory_from_settings(settings)
+    levels.auto_reload = asbool(settings.get('pyramid.reload_templates'))
+    metrics.registry.enabled = asbool(settings.get('snakemud.metrics', True))
+    caves.max_cells = int(settings.get('snakemud.cave_cache_cells',
+                                       caves.max_cells))
+    live_games.max_size = int(settings.get('snakemud.live_games', 0))
+    live_games.flush_interval = float(settings.get(
+        'snakemud.live_games_flush_interval', live_games.flush_interval))
+    if live_games.enabled:
+        live_games.start_flusher()
+        flush_on_sigterm()
+    if metrics.registry.enabled:
+        session_factory = timed_session_factory(session_factory)
     config = Configurator(settings=settings,
                           session_factory=session_factory)
     config.add_static_view('static', 'static', cache_max_age=3600)
     config.add_route('home', '/')
     config.add_route('api_command', '/command')
     config.add_route('api_events', '/events')
+    config.add_route('api_frame', '/frame')
+    if metrics.registry.enabled:
+        config.registry.settings['snakemud.metrics_from'] = set(
+            settings.get('snakemud.metrics_from', '127.0.0.1 ::1').split())
+        config.add_route('metrics', '/metrics')
+        config.add_view('snakemud.views.show_metrics', route_name='metrics')
     config.scan()
-    return config.make_wsgi_app()
+    app = config.make_wsgi_app()
+    if settings.get('snakemud.websocket_port'):
+        from .websocket import start_server
+        start_server(settings)
+    return app
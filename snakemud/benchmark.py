@@ -0,0 +1,414 @@
+"""Measure how big and how slow to (de)serialize player sessions are,
+how much traffic an idle player causes, and how fast commands are.
+
+Commands are timed by replaying traces (recorded ones from
+snakemud/traces, synthetic ones, and any trace files given on the command
+line) against an Interpreter and against the whole web app.
+
+Usage: snakemud-benchmark [number-of-moves] [trace-file ...]
+"""
+import gc
+import os
+import sys
+import shutil
+import pickle
+import copy_reg
+import random
+import tempfile
+import timeit
+
+import pkg_resources
+
+from snakemud.interpreter import Interpreter, Map
+from snakemud.levels import level_exists, levels
+
+
+def make_session(level, moves):
+    interpreter = Interpreter()
+    interpreter.interpret('restart %d' % level)
+    interpreter.interpret('explore %d' % moves)
+    return interpreter
+
+
+class LegacyState(object):
+    """Pickles as an instance of cls with the given __dict__.
+
+    This is what pickle did with our objects before they had their own
+    state formats.
+    """
+
+    def __init__(self, cls, state):
+        self.cls = cls
+        self.state = state
+
+    @property
+    def __class__(self):
+        # pickle checks that __newobj__ gets the object's own class
+        return self.cls
+
+    def __reduce_ex__(self, protocol):
+        return (copy_reg.__newobj__, (self.cls, ), self.state)
+
+
+def legacy_map(map):
+    """Return the map the way it used to be kept: a list of lists of
+    characters, with the snake drawn in."""
+    template = map.template
+    data = [[map[x, y] for x in range(len(row))]
+            for y, row in enumerate(template.rows)]
+    return LegacyState(Map, dict(data=data,
+                                 start_pos=list(template.start_pos),
+                                 start_length=template.start_length))
+
+
+def legacy_pickle(interpreter):
+    """Pickle an interpreter the way sessions used to: as its object graph."""
+    state = dict((name, value) for name, value in interpreter.__dict__.items()
+                 if name in Interpreter.persistent_attributes)
+    # old sessions didn't know about shared worlds
+    state.pop('shared_world', None)
+    state.pop('snake_id', None)
+    state['map'] = legacy_map(interpreter.map)
+    state['tail'] = tuple(interpreter.tail)
+    if interpreter.seen is not None:
+        state['seen'] = set(interpreter.seen)
+    return pickle.dumps(LegacyState(Interpreter, state),
+                        pickle.HIGHEST_PROTOCOL)
+
+
+def legacy_unpickle(data):
+    return pickle.loads(data)
+
+
+def compact_pickle(interpreter):
+    return pickle.dumps(interpreter, pickle.HIGHEST_PROTOCOL)
+
+
+def measure(fn, arg, number=200):
+    return min(timeit.repeat(lambda: fn(arg), number=number,
+                             repeat=3)) / number
+
+
+def compare_session_formats(moves=100):
+    """Yield (level, format, bytes, dump seconds, load seconds) tuples."""
+    level = 1
+    while level_exists(level):
+        interpreter = make_session(level, moves)
+        for name, dump, load in [
+                ('pickle', legacy_pickle, legacy_unpickle),
+                ('compact', compact_pickle, pickle.loads)]:
+            data = dump(interpreter)
+            yield (level, name, len(data), measure(dump, interpreter),
+                   measure(load, data))
+        level += 1
+
+
+class FakeClock(object):
+    """Stand-in for the time module that only moves when told to sleep."""
+
+    def __init__(self, now=1000000000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class CountingSession(dict):
+    """Stand-in for a Beaker session that counts writes."""
+
+    saves = 0
+
+    def save(self):
+        self.saves += 1
+
+    def load(self):
+        pass
+
+
+def legacy_events(request):
+    """The /events view as it was before long polling."""
+    from snakemud.views import get_interpreter
+    interpreter = get_interpreter(request)
+    events = interpreter.events()
+    request.session.save()  # interpreter may have changed its state
+    return {'response': events,
+            'command_list': interpreter.command_list}
+
+
+def polling_client(make_request, clock, end, next_event_in, max_wait):
+    """The old client: asks /events for news once a second."""
+    requests = 0
+    while clock.time() < end:
+        legacy_events(make_request())
+        requests += 1
+        clock.sleep(1)
+    return requests
+
+
+def long_polling_client(make_request, clock, end, next_event_in, max_wait):
+    """The current client: comes back shortly before the next event."""
+    from snakemud.views import events
+    requests = 0
+    while next_event_in is not None:
+        # the client sleeps until shortly before the event is due
+        clock.sleep(max(0, next_event_in - max_wait))
+        if clock.time() >= end:
+            break
+        response = events(make_request(wait=max_wait))
+        requests += 1
+        next_event_in = response['next_event_in']
+    return requests
+
+
+def idle_player_traffic(minutes=1, max_wait=10):
+    """Simulate a player who opens the page and then does nothing.
+
+    Returns (requests, session writes) per minute for the old client, which
+    polled /events once a second (and every poll saved the session), and
+    for the current long-polling client.
+    """
+    from pyramid import testing
+    from snakemud import views, interpreter
+    results = []
+    for client in polling_client, long_polling_client:
+        clock = FakeClock()
+        saved_time = views.time, interpreter.time
+        views.time = interpreter.time = clock
+        testing.setUp(settings={'snakemud.events_max_wait': max_wait})
+        try:
+            session = CountingSession()
+            make_request = lambda **params: testing.DummyRequest(
+                params=params, session=session)
+            next_event_in = views.index(make_request())['next_event_in']
+            session.saves = 0
+            end = clock.time() + minutes * 60
+            requests = client(make_request, clock, end, next_event_in,
+                              max_wait)
+        finally:
+            testing.tearDown()
+            views.time, interpreter.time = saved_time
+        results.append((float(requests) / minutes,
+                        float(session.saves) / minutes))
+    return tuple(results)
+
+
+def parse_trace(text):
+    """Return the commands in a trace: one per line, # starts a comment."""
+    return [line.strip() for line in text.splitlines()
+            if line.strip() and not line.lstrip().startswith('#')]
+
+
+def recorded_traces():
+    """Return a dict of the traces in snakemud/traces."""
+    traces = {}
+    for name in pkg_resources.resource_listdir('snakemud', 'traces'):
+        if name.endswith('.txt'):
+            text = pkg_resources.resource_string('snakemud',
+                                                 'traces/' + name)
+            traces[name[:-len('.txt')]] = parse_trace(text)
+    return traces
+
+
+def synthetic_traces(moves=100, seed=0):
+    """Return a dict of generated traces that exercise the hot paths."""
+    rng = random.Random(seed)
+    walk = [rng.choice('nsew') for n in range(moves)]
+    return {
+        'movement': ['restart 3'] + walk,
+        'explore': ['restart 3'] + ['explore 10'] * max(1, moves // 10),
+        'automap': ['restart 3', 'map on', 'draw on'] + walk,
+        'restarts': ['restart %d' % level for level in sorted(levels.levels)
+                     ] * max(1, moves // 20),
+        'caves': ['restart cave %d 200x100' % rng.randint(0, 1000),
+                  'explore 10'] * max(1, moves // 20),
+    }
+
+
+def command_name(command):
+    """Group commands by verb: 'n' and 'go north' are both 'go'."""
+    words = command.lower().split()
+    if not words:
+        return ''
+    aliases = Interpreter.commands().aliases
+    return aliases.get(words[0], words)[0]
+
+
+class CommandStats(object):
+    """Latencies, allocations and session writes of one kind of command."""
+
+    def __init__(self):
+        self.times = []
+        self.objects = []
+        self.session_bytes = []
+
+    def add(self, seconds, objects, session_bytes):
+        self.times.append(seconds)
+        self.objects.append(objects)
+        self.session_bytes.append(session_bytes)
+
+    def __len__(self):
+        return len(self.times)
+
+    def percentile(self, p):
+        times = sorted(self.times)
+        return times[min(len(times) - 1, int(len(times) * p / 100.0))]
+
+    def mean(self, values):
+        return float(sum(values)) / len(values)
+
+
+def timed_call(fn, *args):
+    """Call fn, return (result, seconds, objects allocated).
+
+    Allocations are counted as the net number of new objects tracked by
+    the garbage collector (containers like lists, dicts and instances),
+    which is all Python 2 can tell us cheaply.
+    """
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        start = timeit.default_timer()
+        result = fn(*args)
+        elapsed = timeit.default_timer() - start
+        objects = gc.get_count()[0] - before
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return result, elapsed, objects
+
+
+def replay_interpreter(commands, seed=0):
+    """Replay a trace against an Interpreter.
+
+    Returns a dict mapping command names to CommandStats.  Session bytes
+    are the size of the pickled interpreter, if the web app would have
+    saved it after this command.
+    """
+    random.seed(seed)
+    interpreter = Interpreter()
+    interpreter.mark_saved()
+    stats = {}
+    for command in commands:
+        output, elapsed, objects = timed_call(interpreter.interpret, command)
+        session_bytes = 0
+        if interpreter.changed:
+            session_bytes = len(pickle.dumps(interpreter,
+                                             pickle.HIGHEST_PROTOCOL))
+            interpreter.mark_saved()
+        stats.setdefault(command_name(command), CommandStats()).add(
+            elapsed, objects, session_bytes)
+    return stats
+
+
+def make_app(data_dir, **settings):
+    """Create the web app, with file sessions in data_dir."""
+    from snakemud import main as make_wsgi_app
+    app_settings = {
+        'session.type': 'file',
+        'session.data_dir': os.path.join(data_dir, 'data'),
+        'session.lock_dir': os.path.join(data_dir, 'lock'),
+        'session.key': 'snakemud-benchmark',
+        'session.secret': 'snakemud-benchmark',
+        'session.save_accessed_time': 'false',
+    }
+    app_settings.update(settings)
+    return make_wsgi_app({}, **app_settings)
+
+
+def file_sizes(directory):
+    """Return a dict mapping file names to (mtime, size)."""
+    sizes = {}
+    for path, dirs, files in os.walk(directory):
+        for name in files:
+            filename = os.path.join(path, name)
+            st = os.stat(filename)
+            sizes[filename] = (st.st_mtime, st.st_size)
+    return sizes
+
+
+def replay_app(commands, seed=0):
+    """Replay a trace against the web app, through an in-process client.
+
+    Each command is POSTed to /command, the way the browser does it.
+    Returns a dict mapping command names to CommandStats; session bytes
+    are the sizes of session files written while handling the request.
+    """
+    from webob import Request
+    random.seed(seed)
+    data_dir = tempfile.mkdtemp(prefix='snakemud-benchmark-')
+    try:
+        app = make_app(data_dir)
+        cookie = None
+        version = ''
+        stats = {}
+        for command in commands:
+            request = Request.blank('/command',
+                                    POST={'c': command, 'v': version})
+            if cookie:
+                request.headers['Cookie'] = cookie
+            before = file_sizes(data_dir)
+            response, elapsed, objects = timed_call(request.get_response,
+                                                    app)
+            after = file_sizes(data_dir)
+            if response.status_int != 200:
+                raise AssertionError('%s: %s' % (command, response.status))
+            session_bytes = sum(size for name, (mtime, size) in after.items()
+                                if before.get(name) != (mtime, size))
+            for header in response.headers.getall('Set-Cookie'):
+                cookie = header.split(';')[0]
+            version = response.json.get('command_list_version', version)
+            stats.setdefault(command_name(command), CommandStats()).add(
+                elapsed, objects, session_bytes)
+        return stats
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def print_command_stats(results):
+    """Print a table of (trace name, {command name: CommandStats}) pairs."""
+    print '%-10s %-10s %5s %9s %9s %9s %9s %8s %9s' % (
+        'trace', 'command', 'count', 'p50 us', 'p90 us', 'p99 us', 'max us',
+        'objects', 'session B')
+    for trace, stats in results:
+        for name, s in sorted(stats.items()):
+            print '%-10s %-10s %5d %9.1f %9.1f %9.1f %9.1f %8.1f %9.1f' % (
+                trace, name, len(s), s.percentile(50) * 1e6,
+                s.percentile(90) * 1e6, s.percentile(99) * 1e6,
+                max(s.times) * 1e6, s.mean(s.objects),
+                s.mean(s.session_bytes))
+
+
+def main():
+    moves = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    traces = sorted(recorded_traces().items())
+    traces += sorted(synthetic_traces(moves).items())
+    for filename in sys.argv[2:]:
+        with open(filename) as f:
+            traces.append((os.path.basename(filename), parse_trace(f.read())))
+    random.seed(0)
+    print '%-6s %-8s %8s %10s %10s' % ('level', 'format', 'bytes',
+                                       'dump us', 'load us')
+    for level, name, size, dump, load in compare_session_formats(moves):
+        print '%-6d %-8s %8d %10.1f %10.1f' % (level, name, size,
+                                               dump * 1e6, load * 1e6)
+    print
+    old, new = idle_player_traffic(minutes=10)
+    print 'idle player, per minute: %7s %7s' % ('before', 'after')
+    print '  requests to /events:   %7.1f %7.1f' % (old[0], new[0])
+    print '  session writes:        %7.1f %7.1f' % (old[1], new[1])
+    print
+    print 'Interpreter:'
+    print_command_stats([(name, replay_interpreter(commands))
+                         for name, commands in traces])
+    print
+    print 'Web app:'
+    print_command_stats([(name, replay_app(commands))
+                         for name, commands in traces])
+
+
+if __name__ == '__main__':
+    main()
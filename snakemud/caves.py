@@ -0,0 +1,172 @@
+import random
+import threading
+import weakref
+from collections import OrderedDict, deque, namedtuple
+
+from snakemud.levels import FLOOR, WALL, LevelTemplate
+
+
+class Cave(namedtuple('Cave', 'seed width height')):
+    """A generated level, identified by the seed and size it's made from."""
+
+    min_size = 10
+    # biggest cave you can ask for with 'restart'
+    max_size = 500
+    max_seed = 0xffffffff
+
+    default_width = 80
+    default_height = 40
+
+    def __str__(self):
+        return 'cave %d %dx%d' % self
+
+    @classmethod
+    def parse(cls, args, rng=random):
+        """Parse the arguments of 'restart cave [seed] [WIDTHxHEIGHT]'.
+
+        Raises ValueError with a message for the player if they're wrong.
+        """
+        seed = None
+        width, height = cls.default_width, cls.default_height
+        for arg in args:
+            if 'x' in arg:
+                try:
+                    width, height = [int(n) for n in arg.split('x')]
+                except ValueError:
+                    raise ValueError("That's not a cave size.")
+            else:
+                try:
+                    seed = int(arg)
+                except ValueError:
+                    raise ValueError("That's not a cave number.")
+        if not (cls.min_size <= width <= cls.max_size and
+                cls.min_size <= height <= cls.max_size):
+            raise ValueError("Caves can be from %d to %d cells across."
+                             % (cls.min_size, cls.max_size))
+        if seed is None:
+            seed = rng.randint(0, cls.max_seed)
+        elif not 0 <= seed <= cls.max_seed:
+            raise ValueError("There is no cave %d." % seed)
+        return cls(seed, width, height)
+
+
+# chance of a cell starting out as wall, and how many times to smooth
+fill_ratio = 0.45
+smoothing_steps = 4
+
+
+def smooth(cells):
+    """One step of the cave cellular automaton.
+
+    A cell becomes wall if at least 5 of the 9 cells around it (counting
+    itself) are walls.  The edges of the level stay wall.
+    """
+    # wall counts of each cell and its left and right neighbours
+    across = [[1] + [a + b + c for a, b, c in zip(row, row[1:], row[2:])] +
+              [1] for row in cells]
+    new = [cells[0]]
+    for above, here, below in zip(across, across[1:], across[2:]):
+        new.append([1] + [1 if a + b + c >= 5 else 0
+                          for a, b, c in zip(above[1:-1], here[1:-1],
+                                             below[1:-1])] + [1])
+    new.append(cells[-1])
+    return new
+
+
+def largest_region(cells):
+    """Return the set of cells of the biggest connected area of floor."""
+    height, width = len(cells), len(cells[0])
+    seen = [bytearray(width) for row in cells]
+    best = set()
+    for y0 in range(height):
+        for x0 in range(width):
+            if cells[y0][x0] or seen[y0][x0]:
+                continue
+            region = set([(x0, y0)])
+            seen[y0][x0] = 1
+            queue = deque([(x0, y0)])
+            while queue:
+                x, y = queue.popleft()
+                for nx, ny in (x, y - 1), (x, y + 1), (x + 1, y), (x - 1, y):
+                    if not cells[ny][nx] and not seen[ny][nx]:
+                        seen[ny][nx] = 1
+                        region.add((nx, ny))
+                        queue.append((nx, ny))
+            if len(region) > len(best):
+                best = region
+    return best
+
+
+def generate_cave(cave):
+    """Make a LevelTemplate for a Cave.
+
+    The same cave always comes out the same: the walls come from a
+    cellular automaton seeded by the cave's seed, and only the biggest
+    connected part is kept so every floor cell can be reached.
+    """
+    rng = random.Random(cave.seed)
+    width, height = cave.width, cave.height
+    cells = [[1] * width]
+    for y in range(1, height - 1):
+        cells.append([1] + [1 if rng.random() < fill_ratio else 0
+                            for x in range(1, width - 1)] + [1])
+    cells.append([1] * width)
+    for step in range(smoothing_steps):
+        cells = smooth(cells)
+    floor = largest_region(cells)
+    if not floor:
+        floor = set([(width // 2, height // 2)])
+    rows = [''.join(FLOOR if (x, y) in floor else WALL for x in range(width))
+            for y in range(height)]
+    floor = sorted(floor, key=lambda (x, y): (y, x))
+    start_pos = rng.sample(floor, min(5, len(floor)))
+    start_length = rng.randint(11, max(11, min(99, len(floor) // 40)))
+    return LevelTemplate(cave, rows, start_pos, start_length)
+
+
+class CaveCache(object):
+    """Generated caves: the recently used ones, and any still in use.
+
+    Sessions only store which cave a game is in, so a cave that's not in
+    the cache is generated again on the next request of its player
+    (0.3 s for 300x200).  The recent ones are kept up to max_cells cells
+    in all, so the cache has room for more small caves than big ones.
+    """
+
+    # a cell takes about 50 bytes, so this is about 50 MB: 300 caves of
+    # the default size, or 16 of 300x200, or 4 of the biggest
+    max_cells = 1000000
+
+    def __init__(self):
+        self._recent = OrderedDict()
+        self._cells = 0
+        self._alive = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def _used(self, cave, template):
+        if self._recent.pop(cave, None) is None:
+            self._cells += cave.width * cave.height
+        self._recent[cave] = template
+        while self._cells > self.max_cells and len(self._recent) > 1:
+            old, template = self._recent.popitem(last=False)
+            self._cells -= old.width * old.height
+
+    def __getitem__(self, cave):
+        with self._lock:
+            template = self._alive.get(cave)
+            if template is not None:
+                self._used(cave, template)
+                return template
+        template = generate_cave(cave)
+        with self._lock:
+            template = self._alive.setdefault(cave, template)
+            self._used(cave, template)
+        return template
+
+    def clear(self):
+        with self._lock:
+            self._recent.clear()
+            self._cells = 0
+
+
+caves = CaveCache()
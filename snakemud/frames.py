@@ -0,0 +1,134 @@
+"""Sending just the changes of the automap and autodraw pictures.
+
+With 'map on' or 'draw on', every move ends with a picture (a frame) that
+is mostly the same as the one before.  Clients that can patch their last
+frame say which one they have, and get the new one as a list of parts:
+
+- a string is a new row,
+- [i, n] stands for n rows of the old frame, starting at row i,
+- [i, p, text, s] is row i of the old frame with everything but its first
+  p and last s characters replaced by text.
+
+Frames are identified by a hash of their text, and the recently sent ones
+are remembered by the process, so there's nothing to store per player.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def frame_id(text):
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return hashlib.sha1(text).hexdigest()[:16]
+
+
+# don't bother patching rows that share fewer characters with the old one
+min_patch = 8
+
+
+def patch_row(old, new):
+    """Return (p, text, s) that turns old into new, or None if it's not
+    worth it."""
+    limit = min(len(old), len(new))
+    p = 0
+    while p < limit and old[p] == new[p]:
+        p += 1
+    s = 0
+    while s < limit - p and old[-1 - s] == new[-1 - s]:
+        s += 1
+    if p + s < min_patch:
+        return None
+    return p, new[p:len(new) - s], s
+
+
+def diff_rows(base, rows):
+    """Describe rows as parts referring to the rows of base."""
+    index = {}
+    for i, row in enumerate(base):
+        index.setdefault(row, i)
+    parts = []
+    # the old row that would come next if nothing had changed
+    next = 0
+    for row in rows:
+        last = parts[-1] if parts else None
+        if (isinstance(last, list) and len(last) == 2 and
+                next < len(base) and base[next] == row):
+            last[1] += 1
+            next += 1
+            continue
+        i = index.get(row)
+        if i is not None:
+            parts.append([i, 1])
+            next = i + 1
+            continue
+        patch = patch_row(base[next], row) if next < len(base) else None
+        if patch is None:
+            parts.append(row)
+        else:
+            parts.append([next] + list(patch))
+        next += 1
+    return parts
+
+
+def apply_diff(base, parts):
+    """Rebuild the rows described by diff_rows()."""
+    rows = []
+    for part in parts:
+        if isinstance(part, list) and len(part) == 2:
+            i, n = part
+            rows.extend(base[i:i + n])
+        elif isinstance(part, list):
+            i, p, text, s = part
+            rows.append(base[i][:p] + text + base[i][len(base[i]) - s:])
+        else:
+            rows.append(part)
+    return rows
+
+
+class FrameCache(object):
+    """The rows of recently sent frames, by frame id."""
+
+    size = 2048
+
+    def __init__(self):
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, id):
+        with self._lock:
+            rows = self._frames.pop(id, None)
+            if rows is not None:
+                self._frames[id] = rows
+            return rows
+
+    def add(self, text):
+        """Remember a frame; returns its id and rows."""
+        id = frame_id(text)
+        rows = text.split('\n')
+        with self._lock:
+            self._frames.pop(id, None)
+            self._frames[id] = rows
+            while len(self._frames) > self.size:
+                self._frames.popitem(last=False)
+        return id, rows
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+
+
+frames = FrameCache()
+
+
+def frame_update(frame, base_id):
+    """Return the 'frame' response field for a frame.
+
+    base_id is the id of the client's last frame; if we remember it, only
+    the changes are sent.
+    """
+    base = frames.get(base_id) if base_id else None
+    id, rows = frames.add(frame)
+    if base is None:
+        return {'id': id, 'base': None, 'rows': rows}
+    return {'id': id, 'base': base_id, 'rows': diff_rows(base, rows)}
@@ -1,45 +1,484 @@
+import itertools
 import time
-import pkg_resources
-import re
 import random
-from functools import partial
+import struct
+import zlib
+from array import array
+from collections import deque
+from heapq import heappush, heappop
 
-FLOOR = '.'
-HEAD = '@'
-BODY = '*'
-TAIL = ','
-WALL = '#'
+from snakemud.levels import FLOOR, HEAD, BODY, TAIL, WALL
+from snakemud.levels import NEIGHBOR_BITS, neighbor_cells
+from snakemud.levels import LevelTemplate, get_template, level_exists, levels
+from snakemud.world import get_world
+from snakemud.caves import Cave
+from snakemud.markup import Text, join, markup, plain
+from snakemud import metrics
 
 
-strip_escapes = partial(re.sub, r'\[\[[^]]*]([^]]*)]', r'\1')
+snake_ids = random.SystemRandom()
+
+# the color of the snake on maps and drawings
+SNAKE_COLOR = '#a84'
+EXIT_COLOR = '#66f'
 
 
 class Map(object):
+    """A player's copy of a level.
+
+    The level itself is a LevelTemplate shared by everyone; the only
+    per-player data is a dict of cells that differ from the template (i.e.
+    the snake), so pickled maps stay small.
+    """
+
+    # counts changes, for neighbors_version()
+    _version = 0
+
+    def __init__(self, level=1, template=None):
+        if template is None:
+            template = get_template(level)
+        self.template = template
+        self.changes = {}
 
-    def __init__(self, level=1):
-        self.data = pkg_resources.resource_string('snakemud', 'maps/l%d.txt' % level).splitlines()
-        self.start_length = int(self.data.pop())
-        self.start_pos = []
-        for y in range(len(self.data)):
-            self.data[y] = list(self.data[y])
-            for x in range(len(self.data[y])):
-                if self[x, y] == HEAD:
-                    self.start_pos.append((x, y))
-                    self.data[y][x] = FLOOR
-        if not self.start_pos:
-            self.start_pos.append((1, 1))
+    @property
+    def start_pos(self):
+        return self.template.start_pos
+
+    @property
+    def start_length(self):
+        return self.template.start_length
 
     def has_level(self, level):
-        return pkg_resources.resource_exists('snakemud', 'maps/l%d.txt' % level)
+        return level_exists(level)
+
+    def start_positions(self, rng=random):
+        """Return the places a snake could start at, in random order."""
+        pos = list(self.start_pos)
+        rng.shuffle(pos)
+        return pos
+
+    def claim(self, pos):
+        """Make room for the snake's head in an empty cell.
+
+        Only a shared map can find the cell taken by someone else.
+        """
+        return True
+
+    def leave(self):
+        """Forget the snake on this map."""
+
+    def row_version(self, y):
+        """Changes when other snakes change row y of the map."""
+        return 0
+
+    def neighbors_version(self, y):
+        """Changes when anything in rows y-1 to y+1 of the map does."""
+        return self._version
+
+    def neighbors(self, x, y):
+        """Return what's to the north, south, east and west of (x, y).
+
+        Cells that aren't floor in the level are all walls.
+        """
+        mask = self.template.neighbor_mask(x, y)
+        changes = self.changes
+        return tuple([changes.get(pos, FLOOR if mask & bit else WALL)
+                      for pos, bit in zip(neighbor_cells(x, y),
+                                          NEIGHBOR_BITS)])
+
+    def __getitem__(self, pos):
+        try:
+            return self.changes[pos]
+        except KeyError:
+            return self.template[pos]
+
+    def __setitem__(self, pos, c):
+        assert pos in self.template
+        self._version += 1
+        if c == self.template[pos]:
+            self.changes.pop(pos, None)
+        else:
+            self.changes[pos] = c
+
+    def __getstate__(self):
+        if self.template.number is None:
+            return dict(rows=self.template.rows,
+                        start_pos=self.template.start_pos,
+                        start_length=self.template.start_length,
+                        changes=self.changes)
+        return dict(level=self.template.number, changes=self.changes)
+
+    def __setstate__(self, state):
+        if 'data' in state:
+            state = self._upgrade_state(state)
+        if state.get('level') is not None:
+            self.template = get_template(state['level'])
+        else:
+            self.template = LevelTemplate(None, state['rows'],
+                                          state['start_pos'],
+                                          state['start_length'])
+        self.changes = state['changes']
+
+    @staticmethod
+    def _upgrade_state(state):
+        # Old sessions pickled the whole level as a list of lists of
+        # characters, with the snake drawn in.  Split the snake out, and
+        # go back to sharing the template if the level is still the same.
+        rows = []
+        changes = {}
+        for y, row in enumerate(state['data']):
+            for x, c in enumerate(row):
+                if c in (HEAD, BODY, TAIL):
+                    changes[x, y] = c
+            rows.append(''.join(FLOOR if c in (HEAD, BODY, TAIL) else c
+                                for c in row))
+        rows = tuple(rows)
+        for template in levels.levels.values():
+            if getattr(template, 'rows', None) == rows:
+                return dict(level=template.number, changes=changes)
+        return dict(rows=rows, start_pos=state['start_pos'],
+                    start_length=state['start_length'], changes=changes)
+
+
+class SharedMap(Map):
+    """A player's view of a level shared with other players' snakes.
+
+    The cells of all the snakes are kept in the level's World; this object
+    just remembers which of the snakes there is ours.
+    """
+
+    def __init__(self, level, snake_id):
+        self.world = get_world(level)
+        self.template = self.world.template
+        self.snake_id = snake_id
+        self.world.join(snake_id)
+
+    @property
+    def changes(self):
+        body = list(self.world.snakes.get(self.snake_id, ()))
+        return dict((pos, self.world[pos]) for pos in body)
+
+    def start_positions(self, rng=random):
+        pos = super(SharedMap, self).start_positions(rng)
+        # if all the starting places are taken, start anywhere
+        return pos + self.world.free_cells()
+
+    def __getitem__(self, pos):
+        return self.world[pos]
+
+    def neighbors(self, x, y):
+        return self.world.neighbors(x, y)
+
+    def __setitem__(self, pos, c):
+        if c == FLOOR:
+            self.world.release(self.snake_id, pos)
+        elif not (self.world.put(self.snake_id, pos, c) or
+                  # reaped meanwhile: take it back if it's still free
+                  self.world.claim(self.snake_id, pos, c)):
+            raise ValueError('%r is not ours' % (pos, ))
+
+    def present(self):
+        """Is our snake still in the level?  It's removed if its player
+        is idle for too long."""
+        return self.world.present(self.snake_id)
+
+    def claim(self, pos):
+        return self.world.claim(self.snake_id, pos, HEAD)
+
+    def rejoin(self, cells):
+        return self.world.rejoin(self.snake_id, cells)
+
+    def leave(self):
+        self.world.leave(self.snake_id)
+
+    def row_version(self, y):
+        return self.world.row_version(y)
+
+    def neighbors_version(self, y):
+        row_version = self.world.row_version
+        return row_version(y - 1), row_version(y), row_version(y + 1)
+
+
+class Body(object):
+    """The snake's body, from the tip of the tail to the neck.
+
+    Growing at the neck, dropping the tip of the tail and checking whether
+    a cell is part of the body are all O(1).
+    """
+
+    def __init__(self, cells=()):
+        self.cells = deque(cells)
+        self.index = set(self.cells)
+
+    def append(self, pos):
+        self.cells.append(pos)
+        self.index.add(pos)
+
+    def popleft(self):
+        pos = self.cells.popleft()
+        self.index.discard(pos)
+        return pos
+
+    def __contains__(self, pos):
+        return pos in self.index
+
+    def __getitem__(self, n):
+        return self.cells[n]
+
+    def __iter__(self):
+        return iter(self.cells)
+
+    def __len__(self):
+        return len(self.cells)
+
+    def __eq__(self, other):
+        return tuple(self) == tuple(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Body(%r)' % (tuple(self.cells), )
+
+    def __reduce__(self):
+        return (Body, (tuple(self.cells), ))
+
+
+class Explored(object):
+    """The cells a player has seen.
+
+    A bitmap covering the level plus a one-cell border around it, and the
+    bounding box of the cells seen so far.
+    """
 
-    def __getitem__(self, (x, y)):
-        if not 0 <= y < len(self.data) or not 0 <= x < len(self.data[y]):
-            return WALL
-        return self.data[y][x]
+    popcount = [bin(n).count('1') for n in range(256)]
 
-    def __setitem__(self, (x, y), c):
-        assert 0 <= y < len(self.data) and 0 <= x < len(self.data[y])
-        self.data[y][x] = c
+    def __init__(self, width, height, bits=None):
+        self.width = width + 2
+        self.height = height + 2
+        size = (self.width * self.height + 7) // 8
+        self.xmin = self.ymin = self.xmax = self.ymax = None
+        if bits is None:
+            self.bits = bytearray(size)
+            self.count = 0
+        else:
+            self.bits = bytearray(bits[:size])
+            self.bits.extend(bytearray(size - len(self.bits)))
+            self.count = sum(self.popcount[byte] for byte in self.bits)
+        # the bounding box is computed lazily after loading from a string
+        self._bounds_known = not self.count
+
+    def _find_bounds(self):
+        for i, byte in enumerate(self.bits):
+            if not byte:
+                continue
+            for bit in range(8):
+                if byte & (1 << bit):
+                    y, x = divmod(i * 8 + bit, self.width)
+                    self._extend_bounds(x - 1, y - 1)
+        self._bounds_known = True
+
+    def _extend_bounds(self, x, y):
+        if self.xmin is None:
+            self.xmin = self.xmax = x
+            self.ymin = self.ymax = y
+        else:
+            self.xmin = min(self.xmin, x)
+            self.xmax = max(self.xmax, x)
+            self.ymin = min(self.ymin, y)
+            self.ymax = max(self.ymax, y)
+
+    def add(self, (x, y)):
+        if not (-1 <= x < self.width - 1 and -1 <= y < self.height - 1):
+            return
+        n = (y + 1) * self.width + x + 1
+        mask = 1 << (n & 7)
+        if not self.bits[n >> 3] & mask:
+            self.bits[n >> 3] |= mask
+            self.count += 1
+            if self._bounds_known:
+                self._extend_bounds(x, y)
+
+    def mark_around(self, x, y):
+        for ax in range(x-1, x+2):
+            for ay in range(y-1, y+2):
+                self.add((ax, ay))
+
+    def unseen_around(self, x, y):
+        """Count the unseen cells in the 3x3 square centered on (x, y)."""
+        unseen = 0
+        for ay in range(y-1, y+2):
+            if not -1 <= ay < self.height - 1:
+                unseen += 3
+                continue
+            for ax in range(x-1, x+2):
+                if not -1 <= ax < self.width - 1:
+                    unseen += 1
+                    continue
+                n = (ay + 1) * self.width + ax + 1
+                if not self.bits[n >> 3] & (1 << (n & 7)):
+                    unseen += 1
+        return unseen
+
+    def __contains__(self, (x, y)):
+        if not (-1 <= x < self.width - 1 and -1 <= y < self.height - 1):
+            return False
+        n = (y + 1) * self.width + x + 1
+        return bool(self.bits[n >> 3] & (1 << (n & 7)))
+
+    def __iter__(self):
+        if not self.count:
+            return
+        xmin, xmax, ymin, ymax = self.bounds
+        for y in range(ymin, ymax + 1):
+            for x in range(xmin, xmax + 1):
+                if (x, y) in self:
+                    yield (x, y)
+
+    def __len__(self):
+        return self.count
+
+    def __eq__(self, other):
+        return set(self) == set(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    @property
+    def bounds(self):
+        """Return (xmin, xmax, ymin, ymax) of the cells seen so far."""
+        if not self._bounds_known:
+            self._find_bounds()
+        return self.xmin, self.xmax, self.ymin, self.ymax
+
+    def tostring(self):
+        return str(self.bits)
+
+    def __reduce__(self):
+        return (Explored, (self.width - 2, self.height - 2, self.tostring()))
+
+
+class ChunkedExplored(Explored):
+    """The cells a player has seen on a very big level.
+
+    Like Explored, but the bitmap is cut into square chunks, and only the
+    chunks you've seen something in are kept.
+    """
+
+    chunk_size = 64
+    chunk_header = struct.Struct('<HH')
+
+    def __init__(self, width, height, bits=None):
+        self.width = width + 2
+        self.height = height + 2
+        self.xmin = self.ymin = self.xmax = self.ymax = None
+        self.chunks = {}
+        self.count = 0
+        if bits:
+            data = zlib.decompress(bits)
+            size = self.chunk_header.size + self.chunk_size ** 2 // 8
+            for offset in range(0, len(data), size):
+                key = self.chunk_header.unpack_from(data, offset)
+                chunk = bytearray(data[offset + self.chunk_header.size:
+                                       offset + size])
+                self.chunks[key] = chunk
+                self.count += sum(self.popcount[byte] for byte in chunk)
+        self._bounds_known = not self.count
+
+    def _locate(self, x, y):
+        # (chunk key, bit number in the chunk) of a cell
+        cx, x = divmod(x + 1, self.chunk_size)
+        cy, y = divmod(y + 1, self.chunk_size)
+        return (cx, cy), y * self.chunk_size + x
+
+    def _find_bounds(self):
+        for (x, y) in self:
+            self._extend_bounds(x, y)
+        self._bounds_known = True
+
+    def add(self, (x, y)):
+        if not (-1 <= x < self.width - 1 and -1 <= y < self.height - 1):
+            return
+        key, n = self._locate(x, y)
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            chunk = self.chunks[key] = bytearray(self.chunk_size ** 2 // 8)
+        mask = 1 << (n & 7)
+        if not chunk[n >> 3] & mask:
+            chunk[n >> 3] |= mask
+            self.count += 1
+            if self._bounds_known:
+                self._extend_bounds(x, y)
+
+    def unseen_around(self, x, y):
+        """Count the unseen cells in the 3x3 square centered on (x, y)."""
+        return sum(1 for ay in range(y-1, y+2) for ax in range(x-1, x+2)
+                   if (ax, ay) not in self)
+
+    def __contains__(self, (x, y)):
+        if not (-1 <= x < self.width - 1 and -1 <= y < self.height - 1):
+            return False
+        key, n = self._locate(x, y)
+        chunk = self.chunks.get(key)
+        return chunk is not None and bool(chunk[n >> 3] & (1 << (n & 7)))
+
+    def __iter__(self):
+        size = self.chunk_size
+        for (cx, cy), chunk in sorted(self.chunks.items()):
+            for i, byte in enumerate(chunk):
+                if not byte:
+                    continue
+                for bit in range(8):
+                    if byte & (1 << bit):
+                        y, x = divmod(i * 8 + bit, size)
+                        yield (cx * size + x - 1, cy * size + y - 1)
+
+    def tostring(self):
+        return zlib.compress(''.join(
+            self.chunk_header.pack(*key) + str(chunk)
+            for key, chunk in sorted(self.chunks.items())))
+
+    def __reduce__(self):
+        return (ChunkedExplored,
+                (self.width - 2, self.height - 2, self.tostring()))
+
+
+# levels with more cells than this get a ChunkedExplored
+max_explored_bitmap = 1 << 16
+
+
+def make_explored(template, bits=None):
+    """Return a record of the cells seen on a level."""
+    if template.width * template.height > max_explored_bitmap:
+        return ChunkedExplored(template.width, template.height, bits)
+    return Explored(template.width, template.height, bits)
+
+
+def command_list_version(command_list):
+    """A short checksum clients can use to tell if a command list changed."""
+    return '%08x' % (zlib.crc32('\n'.join(command_list)) & 0xffffffff)
+
+
+class CommandRegistry(object):
+    """The commands of an Interpreter class, collected once.
+
+    Maps verbs to their handlers and help text, and aliases (of one or two
+    words) to the words they stand for.
+    """
+
+    def __init__(self, cls):
+        self.handlers = {}
+        self.help = {}
+        for name in dir(cls):
+            if name.startswith('do_'):
+                handler = getattr(cls, name)
+                self.handlers[name[3:]] = handler
+                self.help[name[3:]] = handler.__doc__
+        self.aliases = dict((phrase, expansion.split())
+                            for phrase, expansion in cls.aliases.items())
+        self.command_list = sorted(verb for verb, doc in self.help.items()
+                                   if doc)
+        self.command_list_version = command_list_version(self.command_list)
 
 
 class Interpreter(object):
@@ -85,9 +524,16 @@ class Interpreter(object):
         'west': 'west',
     }
 
+    # direction -> its place in neighbors()
+    neighbor_index = dict((d, 'nsew'.index(d[0])) for d in directions)
+    # offset -> direction
+    adjacent = dict((offset, d) for d, offset in directions.items()
+                    if len(d) == 1)
+
     last_event = None
     last_command = None
     activity = True
+    idle_time = 60
 
     auto_map = False
     auto_draw = False
@@ -95,44 +541,309 @@ class Interpreter(object):
     x, y = random.choice(map.start_pos)
     seen = None
     tail = ()
+
+    # rendered map rows, y -> (xmin, xmax, row version, text); not part of
+    # the session
+    _map_rows = None
+    # the map and/or drawing that automap and autodraw added to the end of
+    # the last command's output; not part of the session either
+    frame = None
+    # what's around the head: (map, x, y, map version, neighbors()); not
+    # part of the session
+    _neighbors = None
     length = 11
     found_tail = False
 
-    def __init__(self):
+    # In shared-world mode the snake lives in a World with other players'
+    # snakes, unless the level was too full when it started.
+    shared_world = False
+    snake_id = None
+
+    # something that happened to the snake while the player was away
+    news = None
+
+    # Where the game gets its random numbers and the time from.  Replaying
+    # a game from a journal sets these for each command, so it comes out
+    # the same as it did the first time.
+    rng = random
+
+    def clock(self):
+        return time.time()
+
+    # Session state format: a fixed header, the snake's body as a packed
+    # array of coordinates, and (if any) a bitmap of the explored cells
+    # covering the level plus a one-cell border.  Generated caves are
+    # stored as just their seed and size (the level number is then 0).
+    state_version = 3
+    state_header = struct.Struct('<BHhhHBdHQIHH')
+    # older versions we can still load
+    old_state_headers = {1: struct.Struct('<BHhhHBdH'),
+                         2: struct.Struct('<BHhhHBdHQ')}
+
+    (FOUND_TAIL, AUTO_MAP, AUTO_DRAW, ACTIVITY, HAS_LAST_EVENT, HAS_SEEN,
+     SHARED_WORLD, IN_WORLD) = (1 << n for n in range(8))
+
+    # Attributes that are saved in the session.  Assigning a different value
+    # to any of them sets self.changed, so we know whether the session needs
+    # to be saved.  Containers (the map, the body, the explored bitmap) are
+    # compared by identity; they're only modified when the snake moves, and
+    # that changes x and y as well.
+    persistent_attributes = frozenset([
+        'level', 'map', 'x', 'y', 'length', 'tail', 'seen', 'found_tail',
+        'auto_map', 'auto_draw', 'activity', 'last_event', 'shared_world',
+        'snake_id'])
+
+    # Every command updates last_event.  Don't save the session just for
+    # that unless the saved value is this many seconds out of date.
+    last_event_slack = 10
+
+    changed = False
+    _saved_last_event = None
+
+    def __init__(self, shared_world=False):
+        if shared_world:
+            self.shared_world = True
+            self.snake_id = snake_ids.getrandbits(64)
+        self.do_restart()
+
+    def __setattr__(self, name, value):
+        if name in self.persistent_attributes and not self.changed:
+            if name == 'last_event':
+                saved = self._saved_last_event
+                changed = ((saved is None) != (value is None) or
+                           value is not None and
+                           abs(value - saved) >= self.last_event_slack)
+            else:
+                old = getattr(self, name, None)
+                if isinstance(value, (int, long, float, basestring)):
+                    changed = old != value
+                else:
+                    changed = old is not value
+            if changed:
+                object.__setattr__(self, 'changed', True)
+        object.__setattr__(self, name, value)
+
+    def mark_saved(self):
+        """Note that the current state has been saved in the session."""
+        self.changed = False
+        self._saved_last_event = self.last_event
+
+    def __getstate__(self):
+        if self.map.template.number is None:
+            # a level we can't refer to by number; pickle it all
+            return dict((name, value) for name, value in self.__dict__.items()
+                        if name in self.persistent_attributes)
+        flags = 0
+        for flag, value in [(self.FOUND_TAIL, self.found_tail),
+                            (self.AUTO_MAP, self.auto_map),
+                            (self.AUTO_DRAW, self.auto_draw),
+                            (self.ACTIVITY, self.activity),
+                            (self.HAS_LAST_EVENT, self.last_event is not None),
+                            (self.HAS_SEEN, self.seen is not None),
+                            (self.SHARED_WORLD, self.shared_world),
+                            (self.IN_WORLD, isinstance(self.map, SharedMap))]:
+            if value:
+                flags |= flag
+        tail = array('h')
+        for x, y in self.tail:
+            tail.extend((x, y))
+        if isinstance(self.level, Cave):
+            level, cave = 0, self.level
+        else:
+            level, cave = self.level, (0, 0, 0)
+        state = [self.state_header.pack(
+            self.state_version, level, self.x, self.y, self.length,
+            flags, self.last_event or 0, len(self.tail),
+            self.snake_id or 0, *cave), tail.tostring()]
+        if self.seen is not None:
+            state.append(self.seen.tostring())
+        return ''.join(state)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # a session pickled before we had our own state format
+            self.__dict__.update(state)
+            if not isinstance(self.tail, Body):
+                self.tail = Body(self.tail)
+            if self.seen is not None and not isinstance(self.seen, Explored):
+                seen = self.seen
+                self.seen = None
+                for pos in seen:
+                    self._explored().add(pos)
+            return
+        version = ord(state[0])
+        if version == self.state_version:
+            header = self.state_header
+        elif version in self.old_state_headers:
+            header = self.old_state_headers[version]
+        else:
+            raise ValueError('unsupported state version: %d' % version)
+        fields = header.unpack_from(state)
+        (version, self.level, self.x, self.y, self.length, flags,
+         last_event, tail_length) = fields[:8]
+        self.snake_id = fields[8] if len(fields) > 8 else None
+        if len(fields) > 9 and fields[10]:
+            self.level = Cave(*fields[9:12])
+        self.shared_world = bool(flags & self.SHARED_WORLD)
+        self.found_tail = bool(flags & self.FOUND_TAIL)
+        self.auto_map = bool(flags & self.AUTO_MAP)
+        self.auto_draw = bool(flags & self.AUTO_DRAW)
+        self.activity = bool(flags & self.ACTIVITY)
+        self.last_event = (last_event if flags & self.HAS_LAST_EVENT
+                           else None)
+        offset = header.size
+        coords = array('h')
+        coords.fromstring(state[offset:offset + 4 * tail_length])
+        offset += 4 * tail_length
+        self.tail = Body(zip(coords[::2], coords[1::2]))
+        rejoined = True
+        if flags & self.IN_WORLD:
+            self.map = SharedMap(self.level, self.snake_id)
+            rejoined = self.map.rejoin(self.body_cells())
+        else:
+            self.map = Map(level=self.level)
+            for pos, c in self.body_cells():
+                self.map[pos] = c
+        if flags & self.HAS_SEEN:
+            self.seen = make_explored(self.map.template, state[offset:])
+        else:
+            self.seen = None
+        self.mark_saved()
+        if not rejoined:
+            self.wake_up_elsewhere()
+
+    def body_cells(self):
+        """Return the snake's cells as (pos, what) pairs."""
+        cells = [(pos, BODY) for pos in self.tail]
+        if cells:
+            cells[0] = (self.tail[0], TAIL)
+        cells.append(((self.x, self.y), HEAD))
+        return cells
+
+    def wake_up_elsewhere(self):
         self.do_restart()
+        self.news = ("While you were away, other snakes moved into your"
+                     " cavern.\nYou wake up somewhere else.")
+
+    def come_back(self):
+        """Put the snake back in the shared world if it was removed while
+        its player was idle (the game stayed in memory meanwhile)."""
+        if isinstance(self.map, SharedMap) and not self.map.present():
+            if not self.map.rejoin(self.body_cells()):
+                self.wake_up_elsewhere()
+
+    @classmethod
+    def commands(cls):
+        """Return the CommandRegistry of this class."""
+        registry = cls.__dict__.get('_commands')
+        if registry is None:
+            registry = cls._commands = CommandRegistry(cls)
+        return registry
+
+    def _extra_commands(self):
+        # commands added to this instance, like the console's 'quit'
+        return dict((name[3:], handler)
+                    for name, handler in self.__dict__.items()
+                    if name.startswith('do_'))
+
+    @property
+    def command_help(self):
+        """Return a dict mapping verbs to their help text."""
+        help = self.commands().help
+        extra = self._extra_commands()
+        if extra:
+            help = dict(help)
+            help.update((verb, handler.__doc__)
+                        for verb, handler in extra.items())
+        return help
 
     @property
     def command_list(self):
-        return sorted(name[3:] for name in dir(self) if name.startswith('do_')
-                      and getattr(self, name).__doc__)
+        if not self._extra_commands():
+            return list(self.commands().command_list)
+        return sorted(verb for verb, doc in self.command_help.items() if doc)
+
+    @property
+    def command_list_version(self):
+        if not self._extra_commands():
+            return self.commands().command_list_version
+        return command_list_version(self.command_list)
 
     def events(self):
+        if self.news:
+            news, self.news = self.news, None
+            return news
         if self.last_event is None:
-            self.last_event = time.time()
-        elif time.time() - self.last_event > 60:
-            self.last_event = time.time()
+            self.last_event = self.clock()
+        elif self.clock() - self.last_event > self.idle_time:
+            self.last_event = self.clock()
             if self.activity:
                 self.activity = False
                 return 'You sense the passage of time.'
 
+    def next_event_in(self):
+        """Seconds until events() has something to say.
+
+        Returns None if nothing is going to happen until the player types
+        another command.
+        """
+        if self.last_event is None or self.news:
+            return 0
+        if not self.activity:
+            return None
+        return max(0, self.last_event + self.idle_time - self.clock())
+
+    def parse(self, command):
+        """Split a command into words, expanding any alias."""
+        words = command.split()
+        if not words:
+            return words
+        registry = self.commands()
+        phrase = ' '.join(words[:2]).lower()
+        if phrase in registry.aliases:
+            words[:2] = registry.aliases[phrase]
+        elif words[0].lower() in registry.aliases:
+            words[:1] = registry.aliases[words[0].lower()]
+        words[0] = words[0].lower()
+        return words
+
+    def verb(self, command):
+        """Return the name of the command a command would run.
+
+        That's '' for an empty command and 'unknown' for unknown ones.
+        """
+        words = self.parse(command)
+        if not words:
+            return ''
+        if (words[0] in self.commands().handlers or
+                'do_' + words[0] in self.__dict__):
+            return words[0]
+        return 'unknown'
+
     def interpret(self, command):
-        self.last_event = time.time()
+        """Run a command; returns its output with jquery.terminal markup."""
+        output = self.interpret_text(command)
+        if self.frame is not None:
+            self.frame = markup(self.frame)
+        return markup(output)
+
+    def interpret_text(self, command):
+        """Run a command; returns its output as a string or a Text."""
+        self.come_back()
+        self.last_event = self.clock()
+        self.frame = None
         self.activity = True
-        words = command.split()
+        words = self.parse(command)
         if not words:
             return "Huh?"
-        command = ' '.join(words[:2]).lower()
-        if command in self.aliases:
-            words[:2] = self.aliases.get(command).split()
-            command = words[0].lower()
-        else:
-            command = words[0].lower()
-            if command in self.aliases:
-                words[:1] = self.aliases.get(command).split()
-                command = words[0].lower()
-        fn = getattr(self, 'do_' + command,
-                     partial(self.unknown_command, command))
-        return fn(*words[1:])
+        command = words[0]
+        handler = self.__dict__.get('do_' + command)
+        if handler is not None:
+            return handler(*words[1:])
+        handler = self.commands().handlers.get(command)
+        if handler is None:
+            return self.unknown_command(command, *words[1:])
+        return handler(self, *words[1:])
 
     def unknown_command(self, command, *args):
         return ("Don't know how to %s, sorry." % command)
@@ -151,31 +862,38 @@ class Interpreter(object):
 
     def describe_surroundings(self, mention_self=True):
         description = ''
-        for d in 'nsew':
-            if self.look(d) in (BODY, TAIL):
-                if self.coords(d) == self.tail[0] or self.look(d) != BODY:
+        for d, what in zip('nsew', self.neighbors()):
+            if what in (BODY, TAIL):
+                if not self.tail:
+                    # you're so squeezed in you have no body yet
+                    description += '\n\nYou see a snake body in the %s.' % self.full_direction[d]
+                elif self.coords(d) == self.tail[0] or what != BODY:
                     description += '\n\nYou see a snake tail in the %s!  Is that your tail?' % self.full_direction[d]
                 elif self.coords(d) == self.tail[-1]:
                     if mention_self:
                         description += '\n\nYour body fills the cavern to the %s.' % self.full_direction[d]
                 else:
                     description += '\n\nYou see a snake body in the %s.' % self.full_direction[d]
+            elif what == HEAD:
+                description += '\n\nYou see the head of another snake in the %s.' % self.full_direction[d]
         return description.lstrip()
 
     def describe_exits(self):
-        exit_color = '#66f'
-        exits = [direction for direction in ['north', 'south', 'east', 'west']
-                 if self.look(direction) in (FLOOR, BODY, TAIL)]
+        exits = [direction for direction, what in zip(
+                     ['north', 'south', 'east', 'west'], self.neighbors())
+                 if what in (FLOOR, BODY, TAIL)]
         if not exits:
             return ''
         elif len(exits) == 1:
-            return "There's an exit to the [[;%s;]%s]." % (
-                exit_color, exits[0])
+            return Text.build(["There's an exit to the ",
+                               (EXIT_COLOR, exits[0]), "."])
         else:
-            return ("There are exits to %s and the [[;%s;]%s]." % (
-                ', '.join('the [[;%s;]%s]' % (exit_color, d)
-                          for d in exits[:-1]),
-                exit_color, exits[-1]))
+            parts = ["There are exits to "]
+            for d in exits[:-1]:
+                parts += ["the ", (EXIT_COLOR, d), ", "]
+            parts[-1] = " and the "
+            parts += [(EXIT_COLOR, exits[-1]), "."]
+            return Text.build(parts)
 
     def do_inventory(self, *args):
         """examine your inventory"""
@@ -201,7 +919,7 @@ class Interpreter(object):
             return self.do_gps()
         elif what == 'gps':
             return self.do_gps()
-        elif what == 'tail' and self.adjacent_to(self.tail[0]):
+        elif what == 'tail' and self.tail and self.adjacent_to(self.tail[0]):
             return "What a magnificent tail!  Your mouth waters."
         elif what == 'snake' and self.can_see(BODY, TAIL):
             return "It's a snake."
@@ -238,12 +956,13 @@ class Interpreter(object):
 
     def do_commands(self, *args):
         """list available commands"""
+        help = self.command_help
         return "\n".join([
             "Commands:",
         ] + [
             '    %(command)-10s -- %(help)s' % dict(
                 command=command,
-                help=getattr(self, 'do_' + command).__doc__,
+                help=help[command],
             ) for command in self.command_list
         ])
 
@@ -261,12 +980,15 @@ class Interpreter(object):
         if what in ('compass', 'map', 'gps'):
             return "It is inedible and not threatening."
         if what in ('tail', 'snake'):
-            if self.adjacent_to(self.tail[0]):
+            if self.tail and self.adjacent_to(self.tail[0]):
                 msg = "Ouch!"
                 if not self.found_tail:
                     self.found_tail = True
                     msg += "  You found your tail!"
-                if self.map.has_level(self.level + 1):
+                if isinstance(self.level, Cave):
+                    return (msg + "\n\n" +
+                            "You win!  Type 'restart cave' to play another cave.")
+                elif self.map.has_level(self.level + 1):
                     return (msg + "\n\n" +
                             "You win!  Type 'restart %d' to play the next level." % (self.level + 1))
                 else:
@@ -293,17 +1015,22 @@ class Interpreter(object):
             dx, dy = self.directions[direction.lower()]
         except KeyError:
             return "I don't know where %s is." % direction
-        what = self.map[self.x + dx, self.y + dy]
+        target = (self.x + dx, self.y + dy)
+        what = self.map[target]
+        while what == FLOOR and not self.map.claim(target):
+            # another snake got there first
+            what = self.map[target]
         if what == FLOOR:
             if not self.seen:
                 self.mark_seen(self.x, self.y)
-            self.tail += ((self.x, self.y), )
+            self.tail.append((self.x, self.y))
             self.map[self.x, self.y] = BODY
             while len(self.tail) > self.length:
-                x, y = self.tail[0]
+                x, y = self.tail.popleft()
                 self.map[x, y] = FLOOR
-                self.tail = self.tail[1:]
+                self.forget_map_rows(y)
             self.map[self.tail[0]] = TAIL
+            self.forget_map_rows(self.y, self.tail[0][1])
             self.x += dx
             self.y += dy
             self.mark_seen(self.x, self.y)
@@ -312,7 +1039,8 @@ class Interpreter(object):
                     + self.auto_things())
         elif what == WALL:
             return "There's a wall blocking your way."
-        elif what == TAIL and self.coords(direction) == self.tail[0]:
+        elif (what == TAIL and self.tail and
+                self.coords(direction) == self.tail[0]):
             if self.found_tail:
                 return "You found your tail! Try biting it."
             else:
@@ -325,6 +1053,8 @@ class Interpreter(object):
         elif what == TAIL:
             # never gonna happen if BODY == TAIL
             return "Some other snake's tail blocks sthe way."
+        elif what == HEAD:
+            return "Another snake is in the way."
         else:
             return "You can't go there!"
 
@@ -332,21 +1062,33 @@ class Interpreter(object):
         dx, dy = self.directions[direction.lower()]
         return (self.x + dx, self.y + dy)
 
+    def neighbors(self):
+        """Return what's to the north, south, east and west.
+
+        The answer is kept until the snake moves or the map around it
+        changes.
+        """
+        # Get the version before looking at the cells: if another snake
+        # moves meanwhile, the snapshot will be out of date, not wrong.
+        key = (self.map, self.x, self.y, self.map.neighbors_version(self.y))
+        cached = self._neighbors
+        if cached is not None and cached[:4] == key:
+            return cached[4]
+        neighbors = self.map.neighbors(self.x, self.y)
+        self._neighbors = key + (neighbors, )
+        return neighbors
+
     def look(self, direction):
-        what = self.map[self.coords(direction)]
-        return what
+        return self.neighbors()[self.neighbor_index[direction.lower()]]
 
     def can_see(self, *what):
-        for d in 'nsew':
-            if self.look(d) in what:
+        for d, there in zip('nsew', self.neighbors()):
+            if there in what:
                 return d
         return False
 
     def adjacent_to(self, (x, y)):
-        for d in 'nsew':
-            if self.coords(d) == (x, y):
-                return d
-        return False
+        return self.adjacent.get((x - self.x, y - self.y), False)
 
     def can_go(self, direction):
         try:
@@ -379,7 +1121,12 @@ class Interpreter(object):
     def do_restart(self, *args):
         """start the game from the very beginning"""
         level = self.level
-        if args:
+        if args and args[0] == 'cave':
+            try:
+                self.level = Cave.parse(args[1:], self.rng)
+            except ValueError as e:
+                return str(e)
+        elif args:
             try:
                 level = int(args[0])
             except ValueError:
@@ -387,34 +1134,58 @@ class Interpreter(object):
             if not self.map.has_level(level):
                 return "There is no level %d." % level
             self.level = level
-        self.map = Map(level=self.level)
+        self.map.leave()
+        msg = '\n\n\n\n\n'
+        if self.shared_world:
+            self.map = SharedMap(self.level, self.snake_id)
+            if not self.place_head():
+                self.map.leave()
+                self.map = Map(level=self.level)
+                msg += ("This level is full of snakes, so you get a cavern"
+                        " of your own.\n\n")
+        else:
+            self.map = Map(level=self.level)
+        self._map_rows = None
         self.length = self.map.start_length
         self.last_event = None
         self.found_tail = None
-        self.tail = ()
-        pos = list(self.map.start_pos)
-        random.shuffle(pos)
-        for self.x, self.y in pos:
-            if self.map[self.x, self.y] == FLOOR:
-                break
-        self.map[self.x, self.y] = HEAD
-        self.do_explore(self.length)
+        self.tail = Body()
+        if not isinstance(self.map, SharedMap):
+            self.place_head()
+        self.seen = None
+        self.wander(self.length)
         self.seen = None
         self.mark_seen(self.x, self.y)
-        msg = '\n\n\n\n\n' + self.greeting
+        msg += self.greeting
         return msg + self.auto_things()
 
-    def mark_seen(self, x, y):
+    def place_head(self):
+        """Put the snake's head in one of the level's starting places."""
+        for self.x, self.y in self.map.start_positions(self.rng):
+            if (self.map[self.x, self.y] == FLOOR and
+                    self.map.claim((self.x, self.y))):
+                self.map[self.x, self.y] = HEAD
+                return True
+        return False
+
+    def _explored(self):
         if self.seen is None:
-            self.seen = set()
-        for ax in range(x-1, x+2):
-            for ay in range(y-1, y+2):
-                self.seen.add((ax, ay))
+            self.seen = make_explored(self.map.template)
+            self._map_rows = None
+        return self.seen
+
+    def mark_seen(self, x, y):
+        self._explored().mark_around(x, y)
+        self.forget_map_rows(y - 1, y, y + 1)
+
+    def forget_map_rows(self, *ys):
+        """Drop cached renderings of map rows that have changed."""
+        if self._map_rows:
+            for y in ys:
+                self._map_rows.pop(y, None)
 
     def do_map(self, *args):
         """draw the map of cavern's you've seen"""
-        if not self.seen:
-            self.mark_seen(self.x, self.y)
         if args:
             if args[0] == 'on':
                 self.auto_map = True
@@ -424,37 +1195,68 @@ class Interpreter(object):
                 return 'Automap disabled.'
             else:
                 return 'Map what?'
-        xs = [x for (x, y) in self.seen]
-        ys = [y for (x, y) in self.seen]
-        xmin, xmax = min(xs), max(xs)
+        return join('\n', self.map_rows())
+
+    @metrics.timed(metrics.render_seconds, 'map')
+    def map_rows(self):
+        """Return the rows of the map."""
+        if not self.seen:
+            self.mark_seen(self.x, self.y)
+        xmin, xmax, ymin, ymax = self.seen.bounds
         xmin = max(xmin, self.x - 15)
         xmax = min(xmax, self.x + 15)
-        ymin, ymax = min(ys), max(ys)
         ymin = max(ymin, self.y - 15)
         ymax = min(ymax, self.y + 15)
+        if self._map_rows is None:
+            self._map_rows = {}
         rows = []
         for y in range(ymin, ymax + 1):
-            row = ['[[;#a84;]%s]' % self.map[x, y]
-                        if (x, y) == (self.x, self.y) or
-                           (x, y) in self.tail and (x, y) in self.seen
-                   else self.map[x, y] if (x, y) in self.seen
-                   else ' '
-                   for x in range(xmin, xmax + 1)]
-            rows.append(' '.join(row))
-        map = '\n'.join(rows)
-        while True:
-            s = re.sub(r'(\[\[;#a84;][^]]*)] \[\[;#a84;]([^]]*])', r'\1 \2', map)
-            if s == map:
-                break
-            map = s
-        return map
+            key = (xmin, xmax, self.map.row_version(y))
+            cached = self._map_rows.get(y)
+            if cached is None or cached[:3] != key:
+                cached = key + (self.render_map_row(y, xmin, xmax), )
+                self._map_rows[y] = cached
+            rows.append(cached[3])
+        return rows
+
+    def render_map_row(self, y, xmin, xmax):
+        # Runs of adjacent highlighted cells share a single color span
+        parts = []
+        run = None
+        for x in range(xmin, xmax + 1):
+            pos = (x, y)
+            if pos in self.seen:
+                c = self.map[pos]
+                highlight = pos in self.tail or pos == (self.x, self.y)
+            elif pos == (self.x, self.y):
+                c = self.map[pos]
+                highlight = True
+            else:
+                c = ' '
+                highlight = False
+            if highlight:
+                if run is None:
+                    run = []
+                run.append(c)
+            else:
+                if run is not None:
+                    parts.append((SNAKE_COLOR, ' '.join(run)))
+                    parts.append(' ')
+                    run = None
+                parts.append(c)
+                parts.append(' ')
+        if run is not None:
+            parts.append((SNAKE_COLOR, ' '.join(run)))
+        elif parts:
+            parts.pop()
+        return Text.build(parts)
 
     def do_undocumented(self, *args):
         return "\n".join([
             "Undocumented commands:",
-        ] + ['    ' + name[3:]
-             for name in sorted(dir(self))
-             if name.startswith('do_') and not getattr(self, name).__doc__
+        ] + ['    ' + command
+             for command, doc in sorted(self.command_help.items())
+             if not doc
         ])
 
     def pick_direction(self):
@@ -463,20 +1265,102 @@ class Interpreter(object):
         choices = []
         for direction in 'nsew':
             if self.can_go(direction):
-                dx, dy = self.directions[direction]
-                x = self.x + dx
-                y = self.y + dy
-                for ax in range(x-1, x+2):
-                    for ay in range(y-1, y+2):
-                        if (ax, ay) not in self.seen:
-                            choices.append(direction)
+                x, y = self.coords(direction)
+                choices.extend(direction * self.seen.unseen_around(x, y))
         if choices:
-            return random.choice(choices)
+            return self.rng.choice(choices)
         else:
             return None
 
+    def wander(self, n):
+        """Move randomly towards unseen locations for n turns."""
+        res = []
+        for i in range(n):
+            d = self.pick_direction()
+            if not d:
+                break
+            res.append(self.do_go(d))
+        return res
+
+    def known_floor(self, pos):
+        return pos in self.seen and self.map[pos] == FLOOR
+
+    def body_clearance(self):
+        """Map body cells to the move after which you could enter them.
+
+        Your tail moves away as you move (once you've grown to your full
+        length), so a path can go through cells your body is in now.
+        """
+        growth = max(0, self.length - len(self.tail))
+        return dict((pos, n + 2 + growth) for n, pos in enumerate(self.tail))
+
+    def can_pass(self, pos, move, clearance):
+        """Can you be at pos after this many moves?"""
+        if self.known_floor(pos):
+            return True
+        return pos in self.seen and clearance.get(pos, move + 1) <= move
+
+    def explore_direction(self):
+        """Pick the first step towards the nearest unexplored area.
+
+        That's the closest cell with unseen cells around it that you can
+        reach through floor you've seen without going through yourself,
+        unless going that way would leave you no room to turn around.
+        """
+        if not self.seen:
+            self.mark_seen(self.x, self.y)
+        clearance = self.body_clearance()
+        start = (self.x, self.y)
+        first_step = {start: None}
+        candidates = []
+        queue = deque([(start, 0)])
+        while queue and len(candidates) < 4:
+            pos, moves = queue.popleft()
+            if (pos != start and first_step[pos] not in candidates and
+                    self.seen.unseen_around(*pos)):
+                candidates.append(first_step[pos])
+            x, y = pos
+            for d in 'nsew':
+                dx, dy = self.directions[d]
+                next = (x + dx, y + dy)
+                if (next not in first_step and
+                        self.can_pass(next, moves + 1, clearance)):
+                    first_step[next] = first_step[pos] or d
+                    queue.append((next, moves + 1))
+        for d in candidates:
+            if self.has_room(self.coords(d), clearance):
+                return d
+        return candidates[0] if candidates else None
+
+    def has_room(self, pos, clearance):
+        """Would you have room to move about if your head was at pos?
+
+        Counts the cells you could reach from there (unseen cells count,
+        optimistically, as floor) until there are as many as your body
+        is long.
+        """
+        wanted = self.length + 1
+        reached = {(self.x, self.y): 0, pos: 1}
+        queue = deque([pos])
+        room = 1
+        while queue and room < wanted:
+            pos = queue.popleft()
+            moves = reached[pos]
+            x, y = pos
+            for next in (x, y - 1), (x, y + 1), (x + 1, y), (x - 1, y):
+                if next in reached:
+                    continue
+                if next not in self.seen:
+                    room += 1
+                    reached[next] = moves + 1
+                elif self.can_pass(next, moves + 1, clearance):
+                    room += 1
+                    reached[next] = moves + 1
+                    queue.append(next)
+        return room >= wanted
+
     def do_explore(self, *args):
-        """move randomly towards unseen locations for N turns"""
+        """move towards the nearest unexplored area for N turns"""
         if args:
             try:
                 n = int(args[0])
@@ -486,14 +1370,75 @@ class Interpreter(object):
             n = 1
         res = []
         for i in range(n):
-            d = self.pick_direction()
+            d = self.explore_direction()
             if not d:
                 break
             res.append(self.do_go(d))
         if not res:
             return 'I agree, you should do some exploring.'
         else:
-            return '\n'.join(res)
+            return join('\n', res)
+
+    def find_path(self, goal):
+        """Find the shortest way to goal through floor you've seen.
+
+        Returns a list of directions, or None if there's no way.
+        """
+        # A* search, with distances on the empty level as the heuristic
+        distances = self.map.template.distances_to(goal)
+        clearance = self.body_clearance()
+        start = (self.x, self.y)
+        if start not in distances:
+            return None
+        came_from = {start: None}
+        cost = {start: 0}
+        queue = [(distances[start], 0, start)]
+        while queue:
+            estimate, steps, pos = heappop(queue)
+            if pos == goal:
+                path = []
+                while came_from[pos] is not None:
+                    pos, d = came_from[pos]
+                    path.append(d)
+                path.reverse()
+                return path
+            if steps > cost[pos]:
+                continue
+            x, y = pos
+            for d in 'nsew':
+                dx, dy = self.directions[d]
+                next = (x + dx, y + dy)
+                if (steps + 1 < cost.get(next, steps + 2) and
+                        next in distances and
+                        self.can_pass(next, steps + 1, clearance)):
+                    cost[next] = steps + 1
+                    came_from[next] = (pos, d)
+                    heappush(queue, (steps + 1 + distances[next],
+                                     steps + 1, next))
+        return None
+
+    def do_goto(self, *args):
+        """go to the place with the given GPS coordinates"""
+        try:
+            x, y = [int(arg.strip(',')) for arg in args]
+        except ValueError:
+            return 'Go to where?  (Try the coordinates your GPS shows.)'
+        if (x, y) == (self.x, self.y):
+            return "You're already there."
+        if not self.known_floor((x, y)):
+            return "You don't know of any way there."
+        path = self.find_path((x, y))
+        if path is None:
+            return "You don't know of any way there."
+        output = []
+        for d in path:
+            here = (self.x, self.y)
+            output.append(self.do_go(d))
+            if (self.x, self.y) == here:
+                # something's in the way; don't keep bumping into it
+                output.append("You stop at %+d, %+d." % here)
+                break
+        return join('\n', output)
 
     def do_draw(self, *args):
         """artistically draw the cavern you're in"""
@@ -506,208 +1451,45 @@ class Interpreter(object):
                 return 'Autodraw disabled.'
             else:
                 return 'Map what?'
-        room = [
-            ' ______________ ',
-            '|\            /|',
-            '| \ ________ / |',
-            '|  |        |  |',
-            '|  |        |  |',
-            '|  |        |  |',
-            '|  |________|  |',
-            '| /          \ |',
-            '|/____________\|',
-        ]
-        north_exit = [
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '     .----.     ',
-            '     |    |     ',
-            '     |____|     ',
-            '                ',
-            '                ',
-        ]
-        north_snake = [
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '       @@       ',
-            '       @@       ',
-            '                ',
-            '                ',
-        ]
-        north_tail = [
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '      ,,,,      ',
-            '                ',
-            '                ',
-        ]
-        east_exit = [
-            '                ',
-            '                ',
-            '                ',
-            '              . ',
-            '             /| ',
-            '             || ',
-            '             || ',
-            '             \| ',
-            '              \ ',
-        ]
-        east_snake = [
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '             @  ',
-            '             @  ',
-            '                ',
-        ]
-        east_tail = [
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '             ,  ',
-            '                ',
-        ]
-        west_exit = [
-            '                ',
-            '                ',
-            '                ',
-            ' .              ',
-            ' |\             ',
-            ' ||             ',
-            ' ||             ',
-            ' |/             ',
-            ' /              ',
-        ]
-        west_snake = [
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '  @             ',
-            '  @             ',
-            '                ',
-        ]
-        west_tail = [
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '  ,             ',
-            '                ',
-        ]
-        room_snake = [
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '     @ @@ @     ',
-            '    @  @@  @    ',
-            '                ',
-        ]
-        south_exit = [
-            '                ',
-            '   _--------_   ',
-            '  /          \  ',
-            ' |            | ',
-            ' |            | ',
-            ' |            | ',
-            ' |            | ',
-            ' |            | ',
-            ' |____________| ',
-        ]
-        south_snake = [
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '   @  @  @  @   ',
-        ]
-        south_tail = [
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '                ',
-            '      ,,,,      ',
-        ]
-        def overlay_image(back, front):
-            return [''.join(fc if fc != ' ' else bc
-                            for fc, bc in zip(frow, brow))
-                    for frow, brow in zip(front, back)]
-        if self.look('n') in (FLOOR, BODY, TAIL):
-            room = overlay_image(room, north_exit)
-        if self.look('n') == BODY:
-            room = overlay_image(room, north_snake)
-        elif self.look('n') == TAIL:
-            room = overlay_image(room, north_tail)
-        if self.look('e') in (FLOOR, BODY, TAIL):
-            room = overlay_image(room, east_exit)
-        if self.look('e') == BODY:
-            room = overlay_image(room, east_snake)
-        elif self.look('e') == TAIL:
-            room = overlay_image(room, east_tail)
-        if self.look('w') in (FLOOR, BODY, TAIL):
-            room = overlay_image(room, west_exit)
-        if self.look('w') == BODY:
-            room = overlay_image(room, west_snake)
-        elif self.look('w') == TAIL:
-            room = overlay_image(room, west_tail)
-        # The player is always in the middle of the room
-        room = overlay_image(room, room_snake)
-        if self.look('s') in (FLOOR, BODY, TAIL):
-            room = overlay_image(room, south_exit)
-        if self.look('s') == BODY:
-            room = overlay_image(room, south_snake)
-        elif self.look('s') == TAIL:
-            room = overlay_image(room, south_tail)
-        return '\n'.join(room).replace('@', '[[;#a84;]@]')\
-                              .replace(',', '[[;#a84;],]')
+        return self.room_drawing()
+
+    @metrics.timed(metrics.render_seconds, 'draw')
+    def room_drawing(self):
+        """Return a drawing of the cavern you're in."""
+        n, s, e, w = self.neighbors()
+        key = tuple(what if what in (FLOOR, BODY, TAIL) else WALL
+                    for what in (n, e, s, w))
+        return room_art[key]
 
     def side_by_side(self, left, right, padding=4):
         if not left:
             return right
-        if not isinstance(left, list):
-            left = left.splitlines()
+        if isinstance(left, list):
+            left, stripped, blank = pad_column(left, padding)
+        else:
+            try:
+                left, stripped, blank = padded_columns[left, padding]
+            except KeyError:
+                if len(padded_columns) >= 1000:
+                    padded_columns.clear()
+                padded = pad_column(left.splitlines(), padding)
+                padded_columns[left, padding] = padded
+                left, stripped, blank = padded
         if not isinstance(right, list):
             right = right.splitlines()
-        lwidth = max(len(strip_escapes(l)) for l in left) + padding
-        while len(left) < len(right):
-            left.append('')
-        while len(left) > len(right):
-            right.append('')
-        return '\n'.join(
-            (l + ' ' * (lwidth - len(strip_escapes(l))) + r).rstrip()
-            for l, r in zip(left, right))
+        # one Text for all the lines, so the rows it's made of (which are
+        # usually cached) don't need to be copied
+        parts = []
+        for n in range(max(len(left), len(right))):
+            if n:
+                parts.append('\n')
+            r = right[n].rstrip() if n < len(right) else ''
+            if r:
+                parts.append(left[n] if n < len(left) else blank)
+                parts.append(r)
+            elif n < len(left):
+                parts.append(stripped[n])
+        return join('', parts)
 
     def auto_things(self):
         msg = ''
@@ -718,27 +1500,250 @@ class Interpreter(object):
         if surroundings:
             msg += '\n\n' + surroundings
         if self.auto_map and self.auto_draw:
-            msg += '\n\n' + self.side_by_side(self.do_draw(),
-                                              '\n' + self.do_map())
+            self.frame = self.side_by_side(self.room_drawing(),
+                                           [''] + self.map_rows())
         elif self.auto_map:
-            msg += '\n\n' + self.do_map()
+            self.frame = self.do_map()
         elif self.auto_draw:
-            msg += '\n\n' + self.do_draw()
-        return msg
+            self.frame = self.room_drawing()
+        else:
+            return msg
+        return msg + '\n\n' + self.frame
 
     def do_level(self, *args):
         """print current game level number"""
         if args:
             return "If you want to play a different level, use 'restart %s' instead." % args[0]
+        if isinstance(self.level, Cave):
+            return "You're playing %s." % (self.level, )
         return "You're playing level %d." % self.level
 
 
+ROOM = [
+    ' ______________ ',
+    '|\            /|',
+    '| \ ________ / |',
+    '|  |        |  |',
+    '|  |        |  |',
+    '|  |        |  |',
+    '|  |________|  |',
+    '| /          \ |',
+    '|/____________\|',
+]
+NORTH_EXIT = [
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '     .----.     ',
+    '     |    |     ',
+    '     |____|     ',
+    '                ',
+    '                ',
+]
+NORTH_SNAKE = [
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '       @@       ',
+    '       @@       ',
+    '                ',
+    '                ',
+]
+NORTH_TAIL = [
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '      ,,,,      ',
+    '                ',
+    '                ',
+]
+EAST_EXIT = [
+    '                ',
+    '                ',
+    '                ',
+    '              . ',
+    '             /| ',
+    '             || ',
+    '             || ',
+    '             \| ',
+    '              \ ',
+]
+EAST_SNAKE = [
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '             @  ',
+    '             @  ',
+    '                ',
+]
+EAST_TAIL = [
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '             ,  ',
+    '                ',
+]
+WEST_EXIT = [
+    '                ',
+    '                ',
+    '                ',
+    ' .              ',
+    ' |\             ',
+    ' ||             ',
+    ' ||             ',
+    ' |/             ',
+    ' /              ',
+]
+WEST_SNAKE = [
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '  @             ',
+    '  @             ',
+    '                ',
+]
+WEST_TAIL = [
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '  ,             ',
+    '                ',
+]
+ROOM_SNAKE = [
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '     @ @@ @     ',
+    '    @  @@  @    ',
+    '                ',
+]
+SOUTH_EXIT = [
+    '                ',
+    '   _--------_   ',
+    '  /          \  ',
+    ' |            | ',
+    ' |            | ',
+    ' |            | ',
+    ' |            | ',
+    ' |            | ',
+    ' |____________| ',
+]
+SOUTH_SNAKE = [
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '   @  @  @  @   ',
+]
+SOUTH_TAIL = [
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '                ',
+    '      ,,,,      ',
+]
+
+
+def overlay_image(back, front):
+    return [''.join(fc if fc != ' ' else bc
+                    for fc, bc in zip(frow, brow))
+            for frow, brow in zip(front, back)]
+
+
+def draw_room(n, e, s, w):
+    """Draw a room given what's to the north, east, south and west of it."""
+    room = ROOM
+    if n in (FLOOR, BODY, TAIL):
+        room = overlay_image(room, NORTH_EXIT)
+    if n == BODY:
+        room = overlay_image(room, NORTH_SNAKE)
+    elif n == TAIL:
+        room = overlay_image(room, NORTH_TAIL)
+    if e in (FLOOR, BODY, TAIL):
+        room = overlay_image(room, EAST_EXIT)
+    if e == BODY:
+        room = overlay_image(room, EAST_SNAKE)
+    elif e == TAIL:
+        room = overlay_image(room, EAST_TAIL)
+    if w in (FLOOR, BODY, TAIL):
+        room = overlay_image(room, WEST_EXIT)
+    if w == BODY:
+        room = overlay_image(room, WEST_SNAKE)
+    elif w == TAIL:
+        room = overlay_image(room, WEST_TAIL)
+    # The player is always in the middle of the room
+    room = overlay_image(room, ROOM_SNAKE)
+    if s in (FLOOR, BODY, TAIL):
+        room = overlay_image(room, SOUTH_EXIT)
+    if s == BODY:
+        room = overlay_image(room, SOUTH_SNAKE)
+    elif s == TAIL:
+        room = overlay_image(room, SOUTH_TAIL)
+    return Text.build((SNAKE_COLOR, c) if c in '@,' else c
+                      for c in '\n'.join(room))
+
+
+# draw_room() results for every (n, e, s, w): each side is a wall, floor,
+# or part of the snake's body or tail
+room_art = dict((key, draw_room(*key)) for key in itertools.product(
+    (WALL, FLOOR, BODY, TAIL), repeat=4))
+
+
+def pad_column(lines, padding):
+    """Pad lines to the same visible width plus padding.
+
+    Returns the padded lines, the lines with trailing whitespace stripped
+    (for when there's nothing next to them), and a blank line of the same
+    width.
+    """
+    widths = [len(l) for l in lines]
+    width = max(widths) + padding
+    return (tuple(l + ' ' * (width - w) for l, w in zip(lines, widths)),
+            tuple(l.rstrip() for l in lines),
+            ' ' * width)
+
+
+# pad_column() results for side_by_side(), keyed by (text, padding)
+padded_columns = {}
+
+
 def main():
     import readline
     interpreter = Interpreter()
     interpreter.do_quit = lambda: 'Bye!'
     interpreter.do_quit.__doc__ = 'exit'
-    print strip_escapes(interpreter.greeting)
+    print interpreter.greeting
     while True:
         print
         try:
@@ -750,8 +1755,8 @@ def main():
         output = interpreter.events() or ''
         if output:
             output += '\n\n'
-        output += interpreter.interpret(command)
-        print strip_escapes(output)
+        output += plain(interpreter.interpret_text(command))
+        print output
 
 
 if __name__ == '__main__':
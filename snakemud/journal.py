@@ -0,0 +1,311 @@
+"""Game state kept as a log of what the player did, plus snapshots.
+
+Instead of saving the whole game after every request, the journal appends
+each command (with the time it ran at and the seed of the random numbers
+it used) to the player's log.  The game is rebuilt by loading the latest
+snapshot and running the commands logged since.
+
+Each player has a directory with numbered generations: N.snap is the
+pickled game and N.log the commands played after it.  Once a log gets
+long (or takes too long to replay), a snapshot of the current game
+becomes the next generation and the old one is deleted, so a request
+never has to replay more than snapshot_every commands.  With
+keep_history, old generations are kept; each one is a regression trace
+that must take its snapshot to the next one.
+
+Requests of the same player may run at the same time.  Loading a game
+takes a shared lock on the player's lock file, and logging commands and
+taking snapshots take an exclusive one, so a load never sees a
+generation half gone, and commands are always logged to the latest
+generation, even if another request has moved on to a new one since
+this one loaded the game.
+
+Other players' snakes can't be replayed, so journaled games are always
+played on private levels.
+"""
+import cPickle as pickle
+import contextlib
+import errno
+import fcntl
+import json
+import os
+import random
+import re
+import time
+import uuid
+
+from snakemud.interpreter import Interpreter
+
+
+seeds = random.SystemRandom()
+
+
+def run(interpreter, entry):
+    """Run a logged call on an interpreter, the same way it first ran.
+
+    entry is [time, seed, 'command', text] or [time, seed, 'events'].
+    """
+    now, seed, call = entry[:3]
+    interpreter.rng = random.Random(seed)
+    interpreter.clock = lambda: now
+    try:
+        if call == 'command':
+            return interpreter.interpret(entry[3])
+        elif call == 'events':
+            return interpreter.events()
+        else:
+            raise ValueError('unknown journal entry: %r' % (entry, ))
+    finally:
+        del interpreter.rng
+        del interpreter.clock
+
+
+def replay(interpreter, entries):
+    """Run all the logged calls on an interpreter."""
+    for entry in entries:
+        run(interpreter, entry)
+    return interpreter
+
+
+def parse_log(data):
+    """Return the entries of a log.
+
+    An unfinished last line (someone is writing it right now) is ignored.
+    """
+    lines = data.split('\n')
+    return [json.loads(line) for line in lines[:-1] if line]
+
+
+class Game(object):
+    """A player's game, loaded from the journal.
+
+    Runs commands like an Interpreter (and has all its attributes), but
+    remembers them so save() can log them.
+    """
+
+    def __init__(self, journal, player, generation, interpreter,
+                 logged=0, replay_time=0):
+        self.journal = journal
+        self.player = player
+        self.generation = generation
+        self.interpreter = interpreter
+        # entries in the log file when we loaded it
+        self.logged = logged
+        self.replay_time = replay_time
+        self.new_entries = []
+
+    def __getattr__(self, name):
+        return getattr(self.interpreter, name)
+
+    def _run(self, *call):
+        entry = [time.time(), seeds.getrandbits(32)] + list(call)
+        result = run(self.interpreter, entry)
+        return entry, result
+
+    def interpret(self, command):
+        entry, result = self._run('command', command)
+        self.new_entries.append(entry)
+        return result
+
+    def events(self):
+        self.interpreter.mark_saved()
+        entry, result = self._run('events')
+        # events() usually does nothing at all
+        if self.interpreter.changed:
+            self.new_entries.append(entry)
+        return result
+
+    @property
+    def changed(self):
+        return bool(self.new_entries)
+
+    def mark_saved(self):
+        self.interpreter.mark_saved()
+
+    def save(self):
+        """Log the calls made since the game was loaded.
+
+        Returns True if anything was written.
+        """
+        if not self.new_entries:
+            return False
+        journal = self.journal
+        with journal.locked(self.player):
+            generation = journal.generations(self.player)[-1]
+            logged = journal.append(self.player, generation,
+                                    self.new_entries)
+            expected = self.logged + len(self.new_entries)
+            if generation != self.generation:
+                # another request took a snapshot since we loaded the game
+                expected = None
+            self.generation = generation
+            self.logged = logged
+            self.new_entries = []
+            if ((logged >= journal.snapshot_every or
+                 self.replay_time >= journal.max_replay_time) and
+                    logged == expected):
+                # nobody else added anything to the log, so our game is
+                # what replaying the whole log gives
+                self.generation = journal.snapshot(
+                    self.player, self.interpreter, generation + 1)
+                self.logged = 0
+                self.replay_time = 0
+        return True
+
+
+class Journal(object):
+    """The logs and snapshots of all the players, in a directory."""
+
+    # take a snapshot when the log has this many entries
+    snapshot_every = 100
+    # or when replaying it took this many seconds
+    max_replay_time = 0.1
+
+    player_pattern = re.compile(r'^[0-9a-f]{32}$')
+
+    def __init__(self, directory, snapshot_every=None, keep_history=False):
+        self.directory = directory
+        if snapshot_every is not None:
+            self.snapshot_every = snapshot_every
+        self.keep_history = keep_history
+
+    def new_player(self):
+        return uuid.uuid4().hex
+
+    def valid_player(self, player):
+        return bool(player and self.player_pattern.match(player))
+
+    def _path(self, player, name=''):
+        return os.path.join(self.directory, player[:2], player, name)
+
+    @contextlib.contextmanager
+    def locked(self, player, exclusive=True):
+        """Hold the player's lock (shared if not exclusive)."""
+        directory = self._path(player)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        with open(self._path(player, 'lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def generations(self, player):
+        """Return the numbers of the player's snapshots, oldest first."""
+        try:
+            names = os.listdir(self._path(player))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+        return sorted(int(name[:-len('.snap')]) for name in names
+                      if name.endswith('.snap') and name[:-5].isdigit())
+
+    def read_snapshot(self, player, generation):
+        with open(self._path(player, '%d.snap' % generation), 'rb') as f:
+            return pickle.load(f)
+
+    def read_log(self, player, generation):
+        try:
+            with open(self._path(player, '%d.log' % generation), 'rb') as f:
+                return parse_log(f.read())
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+
+    def load(self, player):
+        """Return the player's Game, or None if there's no such player."""
+        if not self.generations(player):
+            return None
+        with self.locked(player, exclusive=False):
+            generation = self.generations(player)[-1]
+            start = time.time()
+            interpreter = self.read_snapshot(player, generation)
+            entries = self.read_log(player, generation)
+        replay(interpreter, entries)
+        interpreter.mark_saved()
+        return Game(self, player, generation, interpreter, len(entries),
+                    time.time() - start)
+
+    def new_game(self, player, interpreter):
+        """Start a journal for a player's new game."""
+        with self.locked(player):
+            self.snapshot(player, interpreter, 0)
+        return Game(self, player, 0, interpreter)
+
+    def append(self, player, generation, entries):
+        """Add entries to a log.  Hold the player's lock for this.
+
+        Returns the number of entries in the log afterwards.
+        """
+        data = ''.join(json.dumps(entry, separators=(',', ':')) + '\n'
+                       for entry in entries)
+        with open(self._path(player, '%d.log' % generation), 'a+b') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(data)
+                f.flush()
+                f.seek(0)
+                return f.read().count('\n')
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def snapshot(self, player, interpreter, generation):
+        """Save the game as a new generation, and forget the older ones.
+
+        Hold the player's lock for this.
+        """
+        directory = self._path(player)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        filename = self._path(player, '%d.snap' % generation)
+        tmp = '%s.%s.tmp' % (filename, uuid.uuid4().hex)
+        with open(tmp, 'wb') as f:
+            pickle.dump(interpreter, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, filename)
+        if not self.keep_history:
+            for old in self.generations(player):
+                if old < generation:
+                    for name in '%d.log' % old, '%d.snap' % old:
+                        try:
+                            os.unlink(self._path(player, name))
+                        except OSError as e:
+                            if e.errno != errno.ENOENT:
+                                raise
+        return generation
+
+    def check_history(self, player):
+        """Replay every kept generation of a player's game.
+
+        Returns the numbers of the generations whose log doesn't take their
+        snapshot to the next one.
+        """
+        generations = self.generations(player)
+        bad = []
+        for old, new in zip(generations, generations[1:]):
+            interpreter = replay(self.read_snapshot(player, old),
+                                 self.read_log(player, old))
+            expected = self.read_snapshot(player, new)
+            if interpreter.__getstate__() != expected.__getstate__():
+                bad.append(old)
+        return bad
+
+
+def load_or_create(journal, player):
+    """Return the Game of a player, starting a new one if needed.
+
+    Returns (player, game); player changes if it was not a valid one.
+    """
+    if journal.valid_player(player):
+        game = journal.load(player)
+        if game is not None:
+            return player, game
+    else:
+        player = journal.new_player()
+    return player, journal.new_game(player, Interpreter())
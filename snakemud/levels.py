@@ -0,0 +1,381 @@
+import os
+import re
+import sys
+import mmap
+import random
+import struct
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+
+import pkg_resources
+
+FLOOR = '.'
+HEAD = '@'
+BODY = '*'
+TAIL = ','
+WALL = '#'
+
+# Neighbor masks have a bit for each of the cells to the north, south,
+# east and west (in that order) that are floor.
+NEIGHBOR_BITS = (1, 2, 4, 8)
+
+
+def neighbor_cells(x, y):
+    """The cells to the north, south, east and west of (x, y)."""
+    return (x, y - 1), (x, y + 1), (x + 1, y), (x - 1, y)
+
+
+def neighbor_mask(template, x, y):
+    """Work out the neighbor mask of a cell the slow way."""
+    mask = 0
+    for pos, bit in zip(neighbor_cells(x, y), NEIGHBOR_BITS):
+        if template[pos] == FLOOR:
+            mask |= bit
+    return mask
+
+
+class DistanceFields(object):
+    """Shortest distances between cells of a level, for pathfinding."""
+
+    # how many distance fields to keep per level
+    distance_cache_size = 64
+
+    def distances_to(self, target):
+        """Return a dict mapping floor cells to their distance to target.
+
+        Distances ignore snakes, so they are a lower bound of how far a
+        player really has to go.  Recently used fields are cached.
+        """
+        with self._distances_lock:
+            distances = self._distances.pop(target, None)
+            if distances is not None:
+                self._distances[target] = distances
+                return distances
+        distances = {target: 0}
+        queue = deque([target])
+        while queue:
+            x, y = pos = queue.popleft()
+            for next in (x, y - 1), (x, y + 1), (x + 1, y), (x - 1, y):
+                if next not in distances and self[next] == FLOOR:
+                    distances[next] = distances[pos] + 1
+                    queue.append(next)
+        with self._distances_lock:
+            self._distances[target] = distances
+            while len(self._distances) > self.distance_cache_size:
+                self._distances.popitem(last=False)
+        return distances
+
+
+class LevelTemplate(DistanceFields):
+    """Parsed level, shared read-only by every player in the process.
+
+    Players never modify a template; their changes live in a Map overlay.
+    """
+
+    def __init__(self, number, rows, start_pos, start_length):
+        self.number = number
+        self.rows = tuple(rows)
+        self.start_pos = tuple(start_pos)
+        self.start_length = start_length
+        self.height = len(self.rows)
+        self.width = max(len(row) for row in self.rows) if self.rows else 0
+        self.floor = tuple((x, y) for y, row in enumerate(self.rows)
+                           for x, c in enumerate(row) if c == FLOOR)
+        self.masks = self._neighbor_masks()
+        self._distances = OrderedDict()
+        self._distances_lock = threading.Lock()
+
+    @classmethod
+    def parse(cls, number, text):
+        rows = text.splitlines()
+        start_length = int(rows.pop())
+        start_pos = []
+        for y, row in enumerate(rows):
+            for x, c in enumerate(row):
+                if c == HEAD:
+                    start_pos.append((x, y))
+        rows = [row.replace(HEAD, FLOOR) for row in rows]
+        if not start_pos:
+            start_pos.append((1, 1))
+        return cls(number, rows, start_pos, start_length)
+
+    def __getitem__(self, (x, y)):
+        if not 0 <= y < len(self.rows) or not 0 <= x < len(self.rows[y]):
+            return WALL
+        return self.rows[y][x]
+
+    def __contains__(self, (x, y)):
+        return 0 <= y < len(self.rows) and 0 <= x < len(self.rows[y])
+
+    def _neighbor_masks(self):
+        width = self.width
+        masks = array('B', [0]) * (width * self.height)
+        for x, y in self.floor:
+            # tell the neighbors there's floor here
+            n = y * width + x
+            if y + 1 < self.height:
+                masks[n + width] |= 1
+            if y > 0:
+                masks[n - width] |= 2
+            if x > 0:
+                masks[n - 1] |= 4
+            if x + 1 < width:
+                masks[n + 1] |= 8
+        return masks
+
+    def neighbor_mask(self, x, y):
+        """Return the neighbor mask of a cell."""
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return self.masks[y * self.width + x]
+        return neighbor_mask(self, x, y)
+
+    def sample_floor(self, n):
+        """Return up to n floor cells, in random order."""
+        return random.sample(self.floor, min(n, len(self.floor)))
+
+
+class ManhattanDistances(object):
+    """Distances to a target as the crow flies, for levels too big to
+    compute all the distances of."""
+
+    def __init__(self, template, target):
+        self.template = template
+        self.x, self.y = target
+
+    def __contains__(self, pos):
+        return self.template[pos] == FLOOR
+
+    def __getitem__(self, (x, y)):
+        return abs(x - self.x) + abs(y - self.y)
+
+
+class GridTemplate(DistanceFields):
+    """A level too big to keep in memory, memory-mapped from a grid file.
+
+    The file has a header, the starting positions, and then a bitmap with a
+    bit for every cell (set for floor) laid out in square chunks, so the
+    cells around a player are close together in the file.  The operating
+    system reads in the chunks players look at as they need them.
+
+    Grid files are made from text levels with snakemud-grid, or written
+    with write_grid().  Levels can be up to max_size cells across, because
+    sessions store coordinates as 16-bit numbers.
+    """
+
+    magic = 'SNAKEGRD'
+    version = 1
+    header = struct.Struct('<8sBIIHHH')
+    position = struct.Struct('<II')
+
+    max_size = 0x7fff
+
+    # don't try to find and keep all the distances on levels this big
+    distance_field_limit = 1 << 20
+
+    def __init__(self, number, filename):
+        self.number = number
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.width, self.height, self.chunk_size,
+         self.start_length, n_start) = self.header.unpack_from(self.data)
+        if magic != self.magic or version != self.version:
+            raise ValueError('%s is not a grid file' % filename)
+        offset = self.header.size
+        start_pos = []
+        for n in range(n_start):
+            start_pos.append(self.position.unpack_from(self.data, offset))
+            offset += self.position.size
+        self.start_pos = tuple(start_pos)
+        self.offset = offset
+        self.chunks_across = -(-self.width // self.chunk_size)
+        self._distances = OrderedDict()
+        self._distances_lock = threading.Lock()
+
+    def __getitem__(self, (x, y)):
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return WALL
+        size = self.chunk_size
+        cy, y = divmod(y, size)
+        cx, x = divmod(x, size)
+        n = ((cy * self.chunks_across + cx) * size + y) * size + x
+        if ord(self.data[self.offset + (n >> 3)]) & (1 << (n & 7)):
+            return FLOOR
+        return WALL
+
+    def __contains__(self, (x, y)):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def neighbor_mask(self, x, y):
+        # too many cells to keep masks for
+        return neighbor_mask(self, x, y)
+
+    def sample_floor(self, n):
+        """Return up to n floor cells, picked at random."""
+        cells = set()
+        for attempt in range(n * 10):
+            if len(cells) >= n:
+                break
+            pos = (random.randrange(self.width), random.randrange(self.height))
+            if self[pos] == FLOOR:
+                cells.add(pos)
+        return list(cells)
+
+    def distances_to(self, target):
+        if self.width * self.height > self.distance_field_limit:
+            return ManhattanDistances(self, target)
+        return super(GridTemplate, self).distances_to(target)
+
+
+def write_grid(f, width, height, rows, start_pos, start_length,
+               chunk_size=64):
+    """Write a level to a grid file.
+
+    rows is an iterable of strings; floor cells are FLOOR or HEAD, and any
+    other character, or a row that's too short, is wall.  Only chunk_size
+    rows are kept in memory at a time, so rows can be generated on the fly
+    for levels that wouldn't fit.
+    """
+    if chunk_size % 8:
+        raise ValueError('chunk size must be a multiple of 8')
+    if max(width, height) > GridTemplate.max_size:
+        raise ValueError('levels can be at most %d cells across'
+                         % GridTemplate.max_size)
+    f.write(GridTemplate.header.pack(GridTemplate.magic, GridTemplate.version,
+                                     width, height, chunk_size,
+                                     start_length, len(start_pos)))
+    for x, y in start_pos:
+        f.write(GridTemplate.position.pack(x, y))
+    chunks_across = -(-width // chunk_size)
+    row_width = chunks_across * chunk_size
+    to_bits = ''.join('1' if chr(c) in (FLOOR, HEAD) else '0'
+                      for c in range(256))
+    bytes = dict((bits, chr(int(bits[::-1], 2)))
+                 for bits in ('{0:08b}'.format(n) for n in range(256)))
+    rows = iter(rows)
+    for top in range(0, height, chunk_size):
+        band = []
+        for y in range(top, top + chunk_size):
+            row = next(rows, '') if y < height else ''
+            row = row[:width].translate(to_bits).ljust(row_width, '0')
+            band.append(''.join(bytes[row[x:x + 8]]
+                                for x in range(0, row_width, 8)))
+        step = chunk_size // 8
+        for cx in range(chunks_across):
+            f.write(''.join(row[cx * step:(cx + 1) * step] for row in band))
+
+
+def convert_level(text, filename):
+    """Turn a text level into a grid file."""
+    template = LevelTemplate.parse(None, text)
+    with open(filename, 'wb') as f:
+        write_grid(f, template.width, template.height, template.rows,
+                   template.start_pos, template.start_length)
+
+
+class LevelIndex(object):
+    """All the levels in snakemud/maps, parsed once per process.
+
+    Levels are text files named lNUMBER.txt, or grid files (for very big
+    levels) named lNUMBER.grid.
+
+    With auto_reload set (development mode), the map files are checked for
+    changes every now and then and the index is rebuilt if they've changed.
+    """
+
+    filename_pattern = re.compile(r'^l(\d+)\.(txt|grid)$')
+    check_interval = 1.0
+
+    def __init__(self, package='snakemud', directory='maps'):
+        self.package = package
+        self.directory = directory
+        self.auto_reload = False
+        self._levels = None
+        self._mtimes = None
+        self._last_check = 0
+
+    def _files(self):
+        for name in pkg_resources.resource_listdir(self.package,
+                                                   self.directory):
+            m = self.filename_pattern.match(name)
+            if m:
+                yield int(m.group(1)), '%s/%s' % (self.directory, name)
+
+    def _file_mtimes(self):
+        return dict(
+            (path, os.path.getmtime(
+                pkg_resources.resource_filename(self.package, path)))
+            for level, path in self._files())
+
+    def scan(self):
+        levels = {}
+        for level, path in self._files():
+            if path.endswith('.grid'):
+                filename = pkg_resources.resource_filename(self.package, path)
+                levels[level] = GridTemplate(level, filename)
+            else:
+                text = pkg_resources.resource_string(self.package, path)
+                levels[level] = LevelTemplate.parse(level, text)
+        if self.auto_reload:
+            self._mtimes = self._file_mtimes()
+        self._levels = levels
+
+    def invalidate(self):
+        self._levels = None
+
+    def _check_for_changes(self):
+        now = time.time()
+        if now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        if self._file_mtimes() != self._mtimes:
+            self.invalidate()
+
+    @property
+    def levels(self):
+        if self.auto_reload and self._levels is not None:
+            self._check_for_changes()
+        levels = self._levels
+        if levels is None:
+            self.scan()
+            levels = self._levels
+        return levels
+
+    def __contains__(self, level):
+        return level in self.levels
+
+    def __getitem__(self, level):
+        return self.levels[level]
+
+    def __len__(self):
+        return len(self.levels)
+
+
+levels = LevelIndex()
+
+
+def level_exists(level):
+    return level in levels
+
+
+def get_template(level):
+    """Return the shared LevelTemplate for a level number or a Cave."""
+    if isinstance(level, tuple):
+        from snakemud.caves import caves
+        return caves[level]
+    return levels[level]
+
+
+def main():
+    """Convert a text level into a grid file."""
+    if len(sys.argv) != 3:
+        sys.exit('Usage: snakemud-grid level.txt level.grid')
+    with open(sys.argv[1]) as f:
+        text = f.read()
+    convert_level(text, sys.argv[2])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+"""Recently used games, kept in memory between requests.
+
+Loading a game from the session unpickles it and saving pickles it again,
+on every request.  With the live game cache (snakemud.live_games, the
+most games to keep), a player's Interpreter stays in memory between their
+requests, and changes are written to the session store later:
+
+- every flush_interval seconds, if the game has changed (a background
+  thread looks for such games, so this doesn't wait for requests),
+- when the game is dropped from the cache, because it's been idle for
+  idle_timeout seconds or the cache is full,
+- when the server shuts down, including when it's stopped with SIGTERM
+  (which is what pserve --stop-daemon and the --reload monitor send).
+
+A server killed in any harsher way loses up to flush_interval seconds of
+its players' games.
+
+Each cached game has a lock, held for the whole request, so requests of
+the same player in different threads take turns.
+
+The cache belongs to one process, so in a deployment with several server
+processes requests of a player must always go to the same one.
+"""
+import atexit
+import logging
+import os
+import signal
+import threading
+import time
+from collections import OrderedDict
+
+from beaker.session import InvalidSignature, Session, SignedCookie
+from Cookie import CookieError, SimpleCookie
+from pyramid.interfaces import ISessionFactory
+
+
+log = logging.getLogger(__name__)
+
+
+def session_params(request):
+    """Return the Beaker session options, or None if sessions aren't Beaker
+    sessions."""
+    factory = request.registry.queryUtility(ISessionFactory)
+    return getattr(factory, '_options', None)
+
+
+def session_id(request):
+    """Return the id of the request's session, without loading it.
+
+    Returns None if the player has no session yet, or the session isn't a
+    Beaker one.
+    """
+    # Don't touch request.session: pyramid_beaker can't cope with requests
+    # that create a session object but never load it.
+    params = session_params(request)
+    if params is None:
+        return None
+    return parse_session_cookie(params, request.environ.get('HTTP_COOKIE', ''))
+
+
+def parse_session_cookie(params, header):
+    """Return the session id in a Cookie header, or None."""
+    key = params.get('key', 'beaker.session.id')
+    secret = params.get('secret')
+    try:
+        if secret:
+            cookie = SignedCookie(secret, header)
+        else:
+            cookie = SimpleCookie(header)
+    except CookieError:
+        return None
+    if key not in cookie:
+        return None
+    value = cookie[key].value
+    if value is InvalidSignature or not value:
+        return None
+    return value
+
+
+def acquire_until(lock, deadline=None):
+    """Acquire a lock, giving up at time.time() deadline if it's not None.
+
+    Returns whether the lock was acquired.
+    """
+    if deadline is None:
+        return lock.acquire()
+    while not lock.acquire(False):
+        if time.time() >= deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class LiveGame(object):
+    """A game in the cache.
+
+    interpreter is None until the request that added it has loaded it.
+    """
+
+    def __init__(self, session_id, params):
+        self.session_id = session_id
+        self.params = params
+        self.interpreter = None
+        self.lock = threading.Lock()
+        self.last_used = time.time()
+        # when the game changed first since it was last written
+        self.dirty_since = None
+        self.dropped = False
+
+    def write(self):
+        """Save the game in the session store.  Hold the lock for this."""
+        if self.dirty_since is None or self.interpreter is None:
+            return
+        session = Session({}, id=self.session_id, use_cookies=False,
+                          **self.params)
+        session['interpreter'] = self.interpreter
+        session.save()
+        self.dirty_since = None
+
+
+class LiveGames(object):
+    """The live game cache of the process."""
+
+    # most games to keep; 0 turns the cache off
+    max_size = 0
+    idle_timeout = 5 * 60
+    flush_interval = 30
+    # how often to look for games to write or drop
+    sweep_interval = 5
+
+    def __init__(self):
+        self._games = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_sweep = time.time()
+        self._flusher = None
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def __len__(self):
+        return len(self._games)
+
+    def acquire(self, session_id, params):
+        """Return the locked LiveGame of a session, adding it if needed.
+
+        If its interpreter is None, the caller should load it from the
+        session.  Always release() it when the request is done.
+        """
+        while True:
+            with self._lock:
+                game = self._games.pop(session_id, None)
+                if game is None:
+                    game = LiveGame(session_id, params)
+                self._games[session_id] = game
+            game.lock.acquire()
+            if not game.dropped:
+                break
+            # dropped from the cache while we were waiting for it
+            game.lock.release()
+        game.last_used = time.time()
+        return game
+
+    def changed(self, game):
+        """Note that a game needs to be written some time."""
+        if game.dirty_since is None:
+            game.dirty_since = time.time()
+
+    def release(self, game):
+        if game.interpreter is None:
+            # loading it failed
+            self._drop(game)
+        game.lock.release()
+        self.maybe_sweep()
+
+    def _drop(self, game):
+        game.dropped = True
+        with self._lock:
+            if self._games.get(game.session_id) is game:
+                del self._games[game.session_id]
+
+    def maybe_sweep(self):
+        now = time.time()
+        with self._lock:
+            sweep = (now - self._last_sweep >= self.sweep_interval or
+                     len(self._games) > self.max_size)
+            if sweep:
+                self._last_sweep = now
+        if sweep:
+            self.sweep(now)
+
+    def sweep(self, now=None):
+        """Write games that changed a while ago, and drop the idle ones and
+        the least recently used ones that don't fit."""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            games = list(self._games.values())
+        excess = len(games) - self.max_size
+        for n, game in enumerate(games):
+            drop = n < excess or now - game.last_used > self.idle_timeout
+            flush = (game.dirty_since is not None and
+                     now - game.dirty_since > self.flush_interval)
+            if not (drop or flush):
+                continue
+            if not game.lock.acquire(False):
+                # in use right now
+                continue
+            try:
+                self._write(game)
+                if drop:
+                    self._drop(game)
+            finally:
+                game.lock.release()
+
+    def _write(self, game):
+        try:
+            game.write()
+        except Exception:
+            log.exception('could not save session %s', game.session_id)
+
+    def start_flusher(self):
+        """Start the thread that sweeps the cache every sweep_interval
+        seconds, so games get written even when no requests come."""
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._sweep_forever,
+                                             name='live-games')
+            self._flusher.daemon = True
+        self._flusher.start()
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            if self.enabled:
+                try:
+                    self.sweep()
+                except Exception:
+                    log.exception('could not sweep the live game cache')
+
+    def flush(self, timeout=None):
+        """Write all the changed games.
+
+        With a timeout, games that stay locked (by requests that don't
+        finish) until that many seconds have passed are not written.
+        """
+        with self._lock:
+            games = list(self._games.values())
+        deadline = None if timeout is None else time.time() + timeout
+        for game in games:
+            if not acquire_until(game.lock, deadline):
+                log.warning('could not save session %s: it is in use',
+                            game.session_id)
+                continue
+            try:
+                self._write(game)
+            finally:
+                game.lock.release()
+
+    def clear(self):
+        """Write all the changed games and forget them."""
+        self.flush()
+        with self._lock:
+            games = list(self._games.values())
+            self._games.clear()
+        for game in games:
+            game.dropped = True
+
+
+live_games = LiveGames()
+atexit.register(live_games.flush)
+
+
+_sigterm_handled = False
+# how long to wait for requests to finish with their games on SIGTERM
+sigterm_timeout = 5
+
+
+def flush_on_sigterm():
+    """Write the changed games before the process is terminated.
+
+    SIGTERM doesn't run atexit handlers.  Only works when called from the
+    main thread.
+    """
+    global _sigterm_handled
+    if _sigterm_handled:
+        return
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def handler(signum, frame):
+        live_games.flush(timeout=sigterm_timeout)
+        if callable(previous):
+            previous(signum, frame)
+        else:
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+
+    try:
+        signal.signal(signal.SIGTERM, handler)
+    except ValueError:
+        log.warning('not in the main thread; the live game cache will not'
+                    ' be written if the server is terminated')
+        return
+    _sigterm_handled = True
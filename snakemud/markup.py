@@ -0,0 +1,239 @@
+"""Colored text, and ways to show it.
+
+The game's output is mostly plain strings.  The parts that have colors
+(exits, the map, room drawings) are Text objects: a sequence of spans,
+each a (color, string) pair where color is None for plain text.  Adding
+a string to a Text gives a Text, so output can be built as usual.
+
+How the colors are shown is up to the client:
+
+- markup() gives jquery.terminal's [[;color;]text] markup (the web client),
+- ansi() gives ANSI escape sequences (telnet),
+- plain() drops the colors (the console).
+
+Each of them takes a string or a Text.
+"""
+
+
+class Text(object):
+    """A piece of text with colored spans.
+
+    parts are (color, string) spans and other Texts, so adding up Texts
+    doesn't copy them, and the rendering of a Text that's used again (a
+    map row, a room drawing) is remembered.
+    """
+
+    __slots__ = ('parts', 'width', '_rendered', '_hash')
+
+    def __init__(self, parts=(), width=None):
+        self.parts = tuple(parts)
+        if width is None:
+            width = sum([len(part) if isinstance(part, Text) else
+                         len(part[1]) for part in self.parts])
+        # the visible length
+        self.width = width
+        # (serializer, rendered text) of the last rendering
+        self._rendered = None
+        self._hash = None
+
+    @classmethod
+    def build(cls, parts):
+        """Make a Text of plain strings and (color, string) pairs."""
+        spans = []
+        plain = []
+        for part in parts:
+            if isinstance(part, tuple):
+                if plain:
+                    spans.append((None, ''.join(plain)))
+                    plain = []
+                spans.append(part)
+            else:
+                plain.append(part)
+        if plain:
+            spans.append((None, ''.join(plain)))
+        return cls(spans)
+
+    @property
+    def spans(self):
+        """All the (color, string) spans."""
+        spans = []
+        for part in self.parts:
+            if isinstance(part, Text):
+                spans.extend(part.spans)
+            else:
+                spans.append(part)
+        return tuple(spans)
+
+    def __len__(self):
+        return self.width
+
+    def __eq__(self, other):
+        return isinstance(other, Text) and self.spans == other.spans
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(self.spans)
+        return self._hash
+
+    def __repr__(self):
+        return 'Text(%r)' % (self.spans, )
+
+    def __add__(self, other):
+        if not other:
+            return self
+        return Text([self, as_part(other)], self.width + len(other))
+
+    def __radd__(self, other):
+        if not other:
+            return self
+        return Text([as_part(other), self], len(other) + self.width)
+
+    def splitlines(self):
+        """Split into lines, like str.splitlines()."""
+        lines = []
+        line = []
+        for color, text in self.spans:
+            parts = text.split('\n')
+            for part in parts[:-1]:
+                if part:
+                    line.append((color, part))
+                lines.append(Text(line))
+                line = []
+            if parts[-1]:
+                line.append((color, parts[-1]))
+        if line:
+            lines.append(Text(line))
+        return lines
+
+    def rstrip(self):
+        """Strip trailing whitespace that isn't colored."""
+        last = self.parts[-1] if self.parts else None
+        if isinstance(last, tuple) and (last[0] is not None or
+                                        not last[1][-1:].isspace()):
+            return self
+        parts = list(self.parts)
+        while parts:
+            last = parts.pop()
+            if isinstance(last, Text):
+                stripped = last.rstrip()
+            elif last[0] is None:
+                stripped = last[1].rstrip()
+                if stripped == last[1]:
+                    stripped = last
+                elif stripped:
+                    stripped = (None, stripped)
+            else:
+                stripped = last
+            if stripped is last:
+                if len(parts) + 1 == len(self.parts):
+                    return self
+                parts.append(last)
+                break
+            if stripped:
+                parts.append(stripped)
+                break
+        return Text(parts)
+
+
+def as_part(text):
+    if isinstance(text, Text):
+        return text
+    return (None, text)
+
+
+def colored(color, text):
+    return Text([(color, text)])
+
+
+def join(separator, items):
+    """Like separator.join(items), for strings and Texts."""
+    parts = []
+    width = 0
+    separator = as_part(separator) if separator else None
+    for item in items:
+        if separator is not None and parts:
+            parts.append(separator)
+            width += len(separator[1])
+        if isinstance(item, Text):
+            parts.append(item)
+            width += item.width
+        elif item:
+            parts.append((None, item))
+            width += len(item)
+    return Text(parts, width)
+
+
+def render(text, span_format):
+    """Render a Text with span_format(color, string) for each colored span."""
+    if not isinstance(text, Text):
+        return text
+    rendered = text._rendered
+    if rendered is not None and rendered[0] is span_format:
+        return rendered[1]
+    pieces = []
+    for part in text.parts:
+        if isinstance(part, Text):
+            rendered = part._rendered
+            if rendered is not None and rendered[0] is span_format:
+                pieces.append(rendered[1])
+            else:
+                pieces.append(render(part, span_format))
+        elif part[0] is None:
+            pieces.append(part[1])
+        else:
+            pieces.append(span_format(*part))
+    result = ''.join(pieces)
+    text._rendered = (span_format, result)
+    return result
+
+
+def markup_span(color, text):
+    return '[[;%s;]%s]' % (color, text)
+
+
+def plain_span(color, text):
+    return text
+
+
+def markup(text):
+    """Show colors with jquery.terminal markup."""
+    return render(text, markup_span)
+
+
+def plain(text):
+    """Drop the colors."""
+    return render(text, plain_span)
+
+
+def xterm_color(color):
+    """Return the xterm 256-color palette index closest to #rgb/#rrggbb."""
+    color = color.lstrip('#')
+    if len(color) == 3:
+        color = ''.join(c * 2 for c in color)
+    rgb = [int(color[i:i + 2], 16) for i in (0, 2, 4)]
+    levels = (0, 95, 135, 175, 215, 255)
+    cube = [min(range(6), key=lambda n: abs(levels[n] - c)) for c in rgb]
+    return 16 + 36 * cube[0] + 6 * cube[1] + cube[2]
+
+
+# ANSI escape sequences by color, filled in as they're needed
+ansi_codes = {}
+
+
+def ansi_code(color):
+    code = ansi_codes.get(color)
+    if code is None:
+        code = ansi_codes[color] = '\x1b[38;5;%dm' % xterm_color(color)
+    return code
+
+
+def ansi_span(color, text):
+    return ansi_code(color) + text + '\x1b[0m'
+
+
+def ansi(text):
+    """Show colors with ANSI escape sequences."""
+    return render(text, ansi_span)
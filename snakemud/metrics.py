@@ -0,0 +1,191 @@
+"""Counters and histograms of what the server spends its time on.
+
+They're shown at /metrics in the Prometheus text exposition format.
+Recording a value takes a microsecond or two, so they can stay on in
+production; set snakemud.metrics = false to turn them off.
+"""
+import bisect
+import functools
+import threading
+import time
+
+
+class Metric(object):
+    """A named metric, optionally split up by the value of one label."""
+
+    type = None
+
+    def __init__(self, registry, name, help, label=None):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.label = label
+        self.lock = threading.Lock()
+
+    def format_labels(self, value, **extra):
+        labels = []
+        if self.label is not None:
+            labels.append((self.label, value))
+        labels.extend(sorted(extra.items()))
+        if not labels:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (name, escape(value))
+                                 for name, value in labels)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        lines.extend('%s%s %s' % sample for sample in self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def __init__(self, *args, **kw):
+        super(Counter, self).__init__(*args, **kw)
+        self.values = {}
+
+    def inc(self, label=None, amount=1):
+        if not self.registry.enabled:
+            return
+        with self.lock:
+            self.values[label] = self.values.get(label, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        for label, value in values:
+            yield self.name, self.format_labels(label), value
+
+
+class Timer(object):
+    """Context manager that adds the time spent in it to a histogram."""
+
+    def __init__(self, histogram, label):
+        self.histogram = histogram
+        self.label = label
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.time() - self.start, self.label)
+
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    # in seconds
+    default_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                       0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, *args, **kw):
+        self.buckets = tuple(kw.pop('buckets', self.default_buckets))
+        super(Histogram, self).__init__(*args, **kw)
+        # label -> [count in each bucket..., count above the last, sum]
+        self.values = {}
+
+    def observe(self, value, label=None):
+        if not self.registry.enabled:
+            return
+        n = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(label)
+            if counts is None:
+                counts = self.values[label] = [0] * (len(self.buckets) + 2)
+            counts[n] += 1
+            counts[-1] += value
+
+    def time(self, label=None):
+        return Timer(self, label)
+
+    def samples(self):
+        with self.lock:
+            values = sorted((label, list(counts))
+                            for label, counts in self.values.items())
+        for label, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf', ), counts):
+                total += count
+                le = bound if bound == '+Inf' else repr(float(bound))
+                yield (self.name + '_bucket',
+                       self.format_labels(label, le=le), total)
+            yield self.name + '_sum', self.format_labels(label), counts[-1]
+            yield self.name + '_count', self.format_labels(label), total
+
+
+def escape(value):
+    return (str(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+
+class Registry(object):
+    """All the metrics of the process."""
+
+    content_type = 'text/plain; version=0.0.4'
+
+    def __init__(self):
+        self.metrics = []
+        self.enabled = True
+
+    def counter(self, name, help, label=None):
+        metric = Counter(self, name, help, label=label)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, label=None, **kw):
+        metric = Histogram(self, name, help, label=label, **kw)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return ''.join(metric.render() + '\n' for metric in self.metrics)
+
+
+registry = Registry()
+
+command_seconds = registry.histogram(
+    'snakemud_command_seconds', 'Time to run a command.', label='verb')
+render_seconds = registry.histogram(
+    'snakemud_render_seconds', 'Time to draw the map or the room.',
+    label='what')
+session_load_seconds = registry.histogram(
+    'snakemud_session_load_seconds',
+    'Time to load a session and unpickle the game state.')
+session_save_seconds = registry.histogram(
+    'snakemud_session_save_seconds', 'Time to write a changed session.')
+session_state_bytes = registry.histogram(
+    'snakemud_session_state_bytes',
+    'Size of the saved session (file sessions only).',
+    buckets=(64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 65536))
+session_saves = registry.counter(
+    'snakemud_session_saves_total',
+    'Requests that saved the session, or skipped saving it because the'
+    ' game state did not change.', label='result')
+live_game_lookups = registry.counter(
+    'snakemud_live_game_lookups_total',
+    'Requests that found the game in the live game cache, or had to load'
+    ' it from the session.', label='result')
+events_requests = registry.counter(
+    'snakemud_events_requests_total', 'Requests to /events.')
+events_waits = registry.counter(
+    'snakemud_events_waits_total',
+    'Requests to /events that waited for an event to happen.')
+events_busy = registry.counter(
+    'snakemud_events_busy_total',
+    'Requests to /events that could have waited for an event, but did not'
+    ' because too many others were waiting.')
+
+
+def timed(histogram, label=None):
+    """Decorator that records how long each call takes in a histogram."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kw):
+            with histogram.time(label):
+                return fn(*args, **kw)
+        return wrapper
+    return decorator
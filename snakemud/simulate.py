@@ -0,0 +1,246 @@
+"""Play lots of games with bots, to see how hard the levels are.
+
+Usage: snakemud-simulate [options]
+
+Each game is one bot playing one level from the start until it bites its
+tail, gets stuck, or runs out of moves.  Games are spread over a pool of
+processes; results are written to a CSV (or, for *.jsonl, JSON lines)
+file as they come in, and summed up per level and bot at the end.
+
+Games are reproducible: the same seed gives the same games, no matter
+how many processes play them.
+"""
+import csv
+import json
+import random
+import time
+import argparse
+import multiprocessing
+
+from snakemud.interpreter import Interpreter
+
+
+class Bot(object):
+    """A strategy for playing the game."""
+
+    name = None
+
+    def next_move(self, interpreter):
+        """Return the direction to go in next, or None if there's none."""
+        raise NotImplementedError
+
+
+class RandomBot(Bot):
+    """Wanders about randomly, preferring places it hasn't seen yet."""
+
+    name = 'random'
+
+    def next_move(self, interpreter):
+        return interpreter.pick_direction()
+
+
+class FrontierBot(Bot):
+    """Heads for its tail if it knows a way there, or else for the nearest
+    unexplored place, like the 'explore' command."""
+
+    name = 'frontier'
+
+    def next_move(self, interpreter):
+        if interpreter.tail and interpreter.tail[0] in interpreter.seen:
+            x, y = interpreter.tail[0]
+            for pos in (x, y - 1), (x, y + 1), (x + 1, y), (x - 1, y):
+                if interpreter.known_floor(pos):
+                    path = interpreter.find_path(pos)
+                    if path:
+                        return path[0]
+        return (interpreter.explore_direction() or
+                interpreter.pick_direction())
+
+
+class WallFollowerBot(Bot):
+    """Keeps its left side to the wall."""
+
+    name = 'wall'
+
+    # directions in clockwise order
+    compass = 'nesw'
+
+    def __init__(self):
+        self.heading = None
+
+    def next_move(self, interpreter):
+        if self.heading is None:
+            self.heading = random.choice(self.compass)
+        n = self.compass.index(self.heading)
+        # left, straight ahead, right, back
+        for turn in (-1, 0, 1, 2):
+            d = self.compass[(n + turn) % 4]
+            if interpreter.can_go(d):
+                self.heading = d
+                return d
+        return None
+
+
+bots = dict((bot.name, bot) for bot in [RandomBot, FrontierBot,
+                                        WallFollowerBot])
+
+
+def play(level, bot, seed, max_moves=1000):
+    """Play a game.
+
+    level is the argument of 'restart' ('3', 'cave 42 80x40').  Returns a
+    dict with the outcome ('win', 'dead end' or 'timeout'), the number of
+    moves made, and the time it took.
+    """
+    start = time.time()
+    random.seed(seed)
+    interpreter = Interpreter()
+    interpreter.interpret_text('restart %s' % level)
+    player = bots[bot]()
+    outcome = 'timeout'
+    moves = 0
+    while moves < max_moves:
+        if interpreter.tail and interpreter.adjacent_to(interpreter.tail[0]):
+            interpreter.interpret_text('bite tail')
+            outcome = 'win'
+            break
+        d = player.next_move(interpreter)
+        if d is None:
+            outcome = 'dead end'
+            break
+        interpreter.interpret_text('go %s' % d)
+        moves += 1
+    return dict(level=level, bot=bot, seed=seed, outcome=outcome,
+                moves=moves, seconds=round(time.time() - start, 6))
+
+
+def _play(args):
+    return play(*args)
+
+
+def games(levels, bots, count, seed):
+    """Return a list of (level, bot, seed) for count games of each."""
+    rng = random.Random(seed)
+    return [(level, bot, rng.randint(0, 0xffffffff))
+            for level in levels
+            for bot in bots
+            for n in range(count)]
+
+
+def simulate(games, max_moves=1000, processes=None):
+    """Play the games, yielding results in order.
+
+    processes=0 plays them all in this process.
+    """
+    tasks = [game + (max_moves, ) for game in games]
+    if processes == 0:
+        for task in tasks:
+            yield _play(task)
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap(_play, tasks, chunksize=8):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+fields = ['level', 'bot', 'seed', 'outcome', 'moves', 'seconds']
+
+
+class ResultWriter(object):
+    """Writes results to a CSV or JSON lines file, one game per line."""
+
+    def __init__(self, f, format='csv'):
+        self.f = f
+        self.format = format
+        if format == 'csv':
+            self.writer = csv.DictWriter(f, fields)
+            self.writer.writeheader()
+
+    def write(self, result):
+        if self.format == 'csv':
+            self.writer.writerow(result)
+        else:
+            self.f.write(json.dumps(result, sort_keys=True))
+            self.f.write('\n')
+        self.f.flush()
+
+
+class Summary(object):
+    """Win rates, dead end rates, moves to win and timing of games."""
+
+    def __init__(self):
+        self.results = {}
+
+    def add(self, result):
+        self.results.setdefault((result['level'], result['bot']),
+                                []).append(result)
+
+    def rows(self):
+        for (level, bot), results in sorted(self.results.items()):
+            games = len(results)
+            moves = sorted(r['moves'] for r in results
+                           if r['outcome'] == 'win')
+            dead_ends = sum(1 for r in results if r['outcome'] == 'dead end')
+            yield dict(level=level, bot=bot, games=games,
+                       wins=float(len(moves)) / games,
+                       dead_ends=float(dead_ends) / games,
+                       median_moves=moves[len(moves) // 2] if moves else None,
+                       ms_per_game=sum(r['seconds'] for r in results)
+                       * 1000.0 / games)
+
+    def show(self):
+        print '%-16s %-9s %6s %6s %9s %12s %11s' % (
+            'level', 'bot', 'games', 'wins', 'dead ends', 'moves to win',
+            'ms per game')
+        for row in self.rows():
+            print '%-16s %-9s %6d %5.1f%% %8.1f%% %12s %11.1f' % (
+                row['level'], row['bot'], row['games'], row['wins'] * 100,
+                row['dead_ends'] * 100,
+                '-' if row['median_moves'] is None else row['median_moves'],
+                row['ms_per_game'])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Play lots of games with bots, to see how hard the'
+                    ' levels are.')
+    parser.add_argument('-l', '--level', action='append', dest='levels',
+                        help="level to play: a number, or 'cave SEED WxH'"
+                             " (default: all the levels)")
+    parser.add_argument('-b', '--bot', action='append', dest='bots',
+                        choices=sorted(bots),
+                        help='bot to play with (default: all of them)')
+    parser.add_argument('-n', '--games', type=int, default=100,
+                        help='games per level and bot (default: %(default)s)')
+    parser.add_argument('-m', '--max-moves', type=int, default=1000,
+                        help='give up after this many moves'
+                             ' (default: %(default)s)')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='random seed (default: %(default)s)')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='number of processes (default: one per CPU)')
+    parser.add_argument('-o', '--output', default='simulation.csv',
+                        help='file for the results of every game, CSV or'
+                             ' (if it ends with .jsonl) JSON lines'
+                             ' (default: %(default)s)')
+    args = parser.parse_args()
+    if not args.levels:
+        from snakemud.levels import levels
+        args.levels = [str(level) for level in sorted(levels.levels)]
+    summary = Summary()
+    format = 'jsonl' if args.output.endswith('.jsonl') else 'csv'
+    with open(args.output, 'wb') as f:
+        writer = ResultWriter(f, format)
+        for result in simulate(games(args.levels, args.bots or sorted(bots),
+                                     args.games, args.seed),
+                               args.max_moves, args.processes):
+            writer.write(result)
+            summary.add(result)
+    summary.show()
+
+
+if __name__ == '__main__':
+    main()
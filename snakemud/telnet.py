@@ -0,0 +1,468 @@
+"""A MUD server for telnet (or any line-based TCP) clients.
+
+Usage: snakemud-telnet [--host HOST] [--port PORT]
+
+One process serves all the players from an asyncore event loop.  Each
+connection has an Interpreter of its own; levels are shared as usual.
+Colors are sent as ANSI escape sequences.
+
+Players who haven't typed anything for a while have their game packed
+into its (few hundred bytes long) session state, so idle connections
+take little memory.  It's unpacked when they type the next command or an
+event is due.
+
+snakemud-telnet-loadtest opens lots of connections to a server (by
+default one it starts itself) and sees how it copes.
+"""
+import argparse
+import asyncore
+import cPickle as pickle
+import errno
+import heapq
+import itertools
+import logging
+import os
+import random
+import resource
+import select
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from snakemud.interpreter import Interpreter
+from snakemud.markup import ansi
+
+
+log = logging.getLogger(__name__)
+
+
+IAC, DONT, DO, WONT, WILL, SB, SE = '\xff\xfe\xfd\xfc\xfb\xfa\xf0'
+
+
+def strip_telnet(data):
+    """Remove telnet commands from data.
+
+    Returns (text, rest), where rest is an unfinished command at the end
+    of data that should be looked at again when more data comes.
+    """
+    if IAC not in data:
+        return data, ''
+    text = []
+    i = 0
+    n = len(data)
+    while i < n:
+        j = data.find(IAC, i)
+        if j < 0:
+            text.append(data[i:])
+            break
+        text.append(data[i:j])
+        if j + 1 >= n:
+            return ''.join(text), data[j:]
+        command = data[j + 1]
+        if command == IAC:
+            text.append(IAC)
+            i = j + 2
+        elif command in (WILL, WONT, DO, DONT):
+            if j + 2 >= n:
+                return ''.join(text), data[j:]
+            i = j + 3
+        elif command == SB:
+            end = data.find(IAC + SE, j)
+            if end < 0:
+                return ''.join(text), data[j:]
+            i = end + 2
+        else:
+            i = j + 2
+    return ''.join(text), ''
+
+
+class Player(asyncore.dispatcher):
+    """A player's connection."""
+
+    max_line = 1024
+    # give up on players who don't read what we send them
+    max_output = 1 << 20
+
+    banner = "Welcome to SnakeMUD!  Type 'quit' to leave.\n\n"
+    prompt = '\r\n> '
+
+    def __init__(self, sock, server):
+        asyncore.dispatcher.__init__(self, sock, map=server.map)
+        self.server = server
+        self.in_buffer = ''
+        self.out_buffer = ''
+        self.closing = False
+        self.interpreter = Interpreter()
+        # the interpreter's state, while it's packed away
+        self.state = None
+        self.last_input = time.time()
+        self.event_due = None
+        self.output(self.banner + self.interpreter.greeting + '\n')
+        self.schedule_events()
+        self.pack_due = None
+        self.schedule_pack()
+
+    def readable(self):
+        return not self.closing
+
+    def writable(self):
+        return bool(self.out_buffer)
+
+    def handle_read(self):
+        try:
+            data = self.recv(4096)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        if not data:
+            return
+        data, self.in_buffer = strip_telnet(self.in_buffer + data)
+        lines = data.split('\n')
+        self.in_buffer = lines.pop() + self.in_buffer
+        if len(self.in_buffer) > self.max_line:
+            self.in_buffer = ''
+        for line in lines:
+            if self.closing:
+                break
+            self.handle_command(line.strip('\r\0 ')[:self.max_line])
+
+    def handle_write(self):
+        sent = self.send(self.out_buffer)
+        self.out_buffer = self.out_buffer[sent:]
+        if self.closing and not self.out_buffer:
+            self.close()
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        log.exception('telnet connection error')
+        self.close()
+
+    def close(self):
+        self.server.players.discard(self)
+        self.server.forget(self)
+        asyncore.dispatcher.close(self)
+
+    def output(self, text):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        text = text.replace('\n', '\r\n')
+        self.out_buffer += text + self.prompt
+        if len(self.out_buffer) > self.max_output:
+            self.out_buffer = ''
+            self.close()
+
+    # the game
+
+    def pack(self):
+        """Put the game away until it's needed."""
+        if self.state is None:
+            self.state = pickle.dumps(self.interpreter, pickle.HIGHEST_PROTOCOL)
+            self.interpreter = None
+
+    def unpack(self):
+        if self.state is not None:
+            self.interpreter = pickle.loads(self.state)
+            self.state = None
+            self.schedule_pack()
+        return self.interpreter
+
+    def schedule_pack(self):
+        self.pack_due = self.last_input + self.server.pack_after
+        self.server.schedule(self.pack_due, self)
+
+    def schedule_events(self):
+        delay = self.interpreter.next_event_in()
+        self.event_due = None if delay is None else time.time() + delay
+        if self.event_due is not None:
+            self.server.schedule(self.event_due, self)
+
+    def handle_command(self, command):
+        self.last_input = time.time()
+        if command.lower() == 'quit':
+            self.out_buffer += 'Bye!\r\n'
+            self.closing = True
+            return
+        try:
+            command = command.decode('utf-8')
+        except UnicodeDecodeError:
+            command = command.decode('latin-1')
+        interpreter = self.unpack()
+        output = interpreter.events() or ''
+        if output:
+            output += '\n\n'
+        output += ansi(interpreter.interpret_text(command))
+        self.output(output)
+        self.schedule_events()
+
+    def tick(self, now):
+        """Run the events that are due, and pack the game if it's idle."""
+        if self.event_due is not None and now >= self.event_due:
+            events = self.unpack().events()
+            if events:
+                self.output('\n' + events)
+            self.schedule_events()
+        if self.pack_due is not None and now >= self.pack_due:
+            if now - self.last_input >= self.server.pack_after:
+                self.pack()
+                self.pack_due = None
+            else:
+                self.schedule_pack()
+
+
+class TelnetServer(asyncore.dispatcher):
+    """Accepts players' connections, and wakes them up when it's time."""
+
+    tick_interval = 1.0
+    # pack away the games of players idle for this many seconds
+    pack_after = 30
+
+    def __init__(self, host='0.0.0.0', port=4000):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.players = set()
+        self.epoll = None
+        self._masks = {}
+        # (time, n, player) for players who want a tick() at that time
+        self.timers = []
+        self._counter = itertools.count()
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(1024)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            sock, addr = pair
+            player = Player(sock, self)
+            self.players.add(player)
+            if self.epoll is not None:
+                self.update_poll(player)
+
+    def schedule(self, when, player):
+        heapq.heappush(self.timers, (when, next(self._counter), player))
+
+    def run_timers(self, now):
+        """Tick the players whose time has come; returns them."""
+        ticked = []
+        while self.timers and self.timers[0][0] <= now:
+            when, n, player = heapq.heappop(self.timers)
+            if player in self.players:
+                try:
+                    player.tick(now)
+                except Exception:
+                    player.handle_error()
+                ticked.append(player)
+        return ticked
+
+    # asyncore.loop() goes through all the sockets every time; with
+    # thousands of idle players that's most of the work, so where we can
+    # we keep them registered with epoll and only look at the active ones.
+
+    def update_poll(self, dispatcher):
+        """Tell epoll what the dispatcher is waiting for now."""
+        if dispatcher._fileno is None:
+            # closed
+            return
+        mask = 0
+        if dispatcher.readable():
+            mask |= select.EPOLLIN | select.EPOLLPRI
+        if dispatcher.writable():
+            mask |= select.EPOLLOUT
+        if mask != self._masks.get(dispatcher._fileno):
+            if dispatcher._fileno in self._masks:
+                self.epoll.modify(dispatcher._fileno, mask)
+            else:
+                self.epoll.register(dispatcher._fileno, mask)
+            self._masks[dispatcher._fileno] = mask
+
+    def forget(self, dispatcher):
+        if self._masks.pop(dispatcher._fileno, None) is not None:
+            self.epoll.unregister(dispatcher._fileno)
+
+    def poll(self, timeout):
+        if self.epoll is None:
+            # poll() copes with more sockets than select()
+            asyncore.loop(timeout=timeout, map=self.map, use_poll=True,
+                          count=1)
+            return
+        self.update_poll(self)
+        try:
+            events = self.epoll.poll(timeout)
+        except (IOError, select.error) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        for fd, flags in events:
+            dispatcher = self.map.get(fd)
+            if dispatcher is not None:
+                asyncore.readwrite(dispatcher, flags)
+                if dispatcher is not self:
+                    self.update_poll(dispatcher)
+
+    def serve_forever(self):
+        self.running = True
+        self.epoll = select.epoll() if hasattr(select, 'epoll') else None
+        self._masks = {}
+        while self.running:
+            timeout = self.tick_interval
+            if self.timers:
+                timeout = max(0, min(timeout, self.timers[0][0] - time.time()))
+            self.poll(timeout)
+            for player in self.run_timers(time.time()):
+                if self.epoll is not None:
+                    self.update_poll(player)
+        for dispatcher in self.map.values():
+            dispatcher.close()
+        if self.epoll is not None:
+            self.epoll.close()
+
+    def stop(self):
+        self.running = False
+
+    def start(self):
+        """Serve in a background thread."""
+        thread = threading.Thread(target=self.serve_forever, name='telnet')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def raise_file_limit():
+    """Allow as many open sockets as the system lets us."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve SnakeMUD to telnet clients.')
+    parser.add_argument('--host', default='0.0.0.0',
+                        help='address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=4000,
+                        help='port to listen on (default: %(default)s)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    raise_file_limit()
+    server = TelnetServer(args.host, args.port)
+    log.info('serving telnet on %s:%d', args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def rss(pid):
+    """Resident memory of a process in KB, or None if we can't tell."""
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        return None
+
+
+def read_until_prompt(sock, timeout):
+    """Read what the server sends until the next prompt."""
+    sock.settimeout(timeout)
+    data = ''
+    while not data.endswith(Player.prompt):
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise EOFError('connection closed')
+        data += chunk
+    return data
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, len(values) * p // 100)]
+
+
+def load_test(host, port, connections, commands, seed=0, timeout=30):
+    """Open lots of connections and send commands on some of them.
+
+    Returns a dict of what happened.
+    """
+    rng = random.Random(seed)
+    sockets = []
+    start = time.time()
+    for n in range(connections):
+        sock = socket.create_connection((host, port), timeout)
+        sockets.append(sock)
+    for sock in sockets:
+        read_until_prompt(sock, timeout)
+    connect_time = time.time() - start
+    latencies = []
+    for n in range(commands):
+        sock = rng.choice(sockets)
+        command = rng.choice(['look', 'n', 's', 'e', 'w', 'map', 'draw'])
+        t0 = time.time()
+        sock.sendall(command + '\r\n')
+        read_until_prompt(sock, timeout)
+        latencies.append(time.time() - t0)
+    return dict(connections=len(sockets), connect_time=connect_time,
+                latencies=latencies, sockets=sockets)
+
+
+def load_test_main():
+    parser = argparse.ArgumentParser(
+        description='Open lots of telnet connections to a SnakeMUD server.')
+    parser.add_argument('-n', '--connections', type=int, default=2000,
+                        help='connections to open (default: %(default)s)')
+    parser.add_argument('-c', '--commands', type=int, default=1000,
+                        help='commands to send (default: %(default)s)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=None,
+                        help='port of a running server (default: start one)')
+    args = parser.parse_args()
+    raise_file_limit()
+    server = None
+    port = args.port
+    if port is None:
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        server = subprocess.Popen([sys.executable, '-m', 'snakemud.telnet',
+                                   '--host', '127.0.0.1', '--port', str(port)],
+                                  stderr=open(os.devnull, 'w'))
+        for attempt in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', port)).close()
+                break
+            except socket.error:
+                time.sleep(0.1)
+    try:
+        before = rss(server.pid) if server else None
+        result = load_test(args.host, port, args.connections, args.commands)
+        after = rss(server.pid) if server else None
+        latencies = result['latencies']
+        print '%d connections opened in %.2fs' % (result['connections'],
+                                                  result['connect_time'])
+        if latencies:
+            print '%d commands: median %.2fms, 99%% %.2fms, max %.2fms' % (
+                len(latencies), percentile(latencies, 50) * 1000,
+                percentile(latencies, 99) * 1000, max(latencies) * 1000)
+        if before and after:
+            print 'server memory: %d KB, %.1f KB per connection' % (
+                after, float(after - before) / max(1, result['connections']))
+        for sock in result['sockets']:
+            sock.close()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
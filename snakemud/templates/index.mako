@@ -10,11 +10,123 @@
   <script src="${request.application_url}/static/js/jquery.terminal-0.4.6.js"></script>
   <script>
     jQuery(function($, undefined) {
+        var events_max_wait = ${events_max_wait|js,n};
+        var command_list_version = ${command_list_version|js,n};
+        var update_command_list = function(data) {
+            if (data.command_list) {
+                term.set_command_list(data.command_list);
+                command_list_version = data.command_list_version;
+            }
+        };
+        // The last automap/autodraw picture.  The server sends just the
+        // changes from one picture to the next: new rows as strings,
+        // [i, n] for n rows of the last picture starting at row i, and
+        // [i, p, text, s] for row i with all but the first p and last s
+        // characters replaced by text.
+        var last_frame = null;
+        var with_frame = function(data) {
+            if (!data.frame) {
+                return data.response;
+            }
+            if (data.frame.base !== null && (last_frame === null ||
+                                             last_frame.id !== data.frame.base)) {
+                // changes to a picture we don't have (another request got
+                // its answer in between), so get the whole picture
+                last_frame = null;
+                $.getJSON(${request.route_url("api_frame")|js,n}, {id: data.frame.id}, function(frame) {
+                    last_frame = {id: frame.id, rows: frame.rows};
+                    term.echo(frame.rows.join('\n'));
+                    term.echo('\n');
+                });
+                return data.response;
+            }
+            var base = data.frame.base === null ? [] : last_frame.rows;
+            var rows = [];
+            $.each(data.frame.rows, function(i, part) {
+                if (typeof part === 'string') {
+                    rows.push(part);
+                } else if (part.length === 2) {
+                    rows.push.apply(rows, base.slice(part[0], part[0] + part[1]));
+                } else {
+                    var old = base[part[0]];
+                    rows.push(old.slice(0, part[1]) + part[2] +
+                              old.slice(old.length - part[3]));
+                }
+            });
+            last_frame = {id: data.frame.id, rows: rows};
+            return data.response + rows.join('\n');
+        };
+        var event_timer = null;
+        // Ask the server for events shortly before the next one is due
+        // (or when it's due, if the server was too busy to wait for it);
+        // if nothing is due, wait until the player does something.
+        var schedule_events = function(next_event_in, busy) {
+            if (event_timer !== null) {
+                window.clearTimeout(event_timer);
+                event_timer = null;
+            }
+            if (next_event_in === null || next_event_in === undefined) {
+                return;
+            }
+            var delay = busy ? next_event_in :
+                Math.max(0, next_event_in - events_max_wait);
+            event_timer = window.setTimeout(event_poll, delay * 1000);
+        };
+        // Commands go over a WebSocket if we have one open, and the
+        // server sends events over it as they happen.  Otherwise we use
+        // /command, and poll /events.
+        var websocket_port = ${websocket_port|js,n};
+        var socket = null;
+        var connect = function() {
+            if (!websocket_port || !window.WebSocket || !window.JSON) {
+                return;
+            }
+            var scheme = location.protocol === 'https:' ? 'wss://' : 'ws://';
+            var ws = new WebSocket(scheme + location.hostname + ':' +
+                                   websocket_port + '/');
+            ws.onopen = function() {
+                socket = ws;
+                schedule_events(null);
+            };
+            ws.onmessage = function(e) {
+                var data = JSON.parse(e.data);
+                term.echo(data.event ? data.response : with_frame(data));
+                term.echo('\n');
+                update_command_list(data);
+            };
+            ws.onclose = function() {
+                if (socket === ws) {
+                    socket = null;
+                    schedule_events(0);
+                }
+            };
+        };
         var term = $('#terminal').terminal(function(command, term) {
-            $.post(${request.route_url("api_command")|js,n}, {c: command}, function(data){
-                term.echo(data.response);
+            // Several lines pasted at once (or commands separated by
+            // semicolons, which the server splits) go in a single request.
+            var commands = $.grep(command.split('\n'), function(line) {
+                return $.trim(line) !== '';
+            });
+            if (commands.length === 0) {
+                commands = [command];
+            }
+            var params = {c: commands, v: command_list_version,
+                          f: last_frame === null ? '' : last_frame.id};
+            if (socket !== null) {
+                socket.send(JSON.stringify(params));
+                return;
+            }
+            $.ajax({
+                type: 'POST',
+                url: ${request.route_url("api_command")|js,n},
+                data: params,
+                traditional: true,
+                dataType: 'json'
+            }).success(function(data){
+                term.echo(with_frame(data));
                 term.echo('\n');
-                term.set_command_list(data.command_list);
+                update_command_list(data);
+                schedule_events(data.next_event_in);
             }).error(function(e) {
                 if (e.status) {
                   term.error(e.status + " " + e.statusText);
@@ -30,17 +142,20 @@
             command_list: ${command_list|js,n},
             prompt: '>'});
         var event_poll = function() {
-            $.getJSON(${request.route_url("api_events")|js,n}, function(data){
+            event_timer = null;
+            $.getJSON(${request.route_url("api_events")|js,n}, {wait: events_max_wait, v: command_list_version}, function(data){
                 if (data.response) {
                     term.echo(data.response);
                     term.echo('\n');
                 }
-                term.set_command_list(data.command_list);
-            }).complete(function() {
-                window.setTimeout(event_poll, 1000);
+                update_command_list(data);
+                schedule_events(data.next_event_in, data.busy);
+            }).error(function() {
+                schedule_events(2 * events_max_wait);
             });
         };
-        window.setTimeout(event_poll, 1000);
+        schedule_events(${next_event_in|js,n});
+        connect();
     });
   </script>
 </head>
@@ -1,6 +1,14 @@
 import unittest
 
 from pyramid import testing
+from webob.multidict import MultiDict
+import pkg_resources
+
+
+def dummy_request(session, **params):
+    return testing.DummyRequest(
+        params=MultiDict(params), session=session,
+        content_type='application/x-www-form-urlencoded')
 
 class ViewTests(unittest.TestCase):
     def setUp(self):
@@ -9,8 +17,1762 @@ class ViewTests(unittest.TestCase):
     def tearDown(self):
         testing.tearDown()
 
-    def test_my_view(self):
-        from .views import my_view
+    def test_index(self):
+        from .benchmark import CountingSession
+        from .views import index
+        session = CountingSession()
+        info = index(dummy_request(session))
+        interpreter = session['interpreter']
+        self.assertEqual(info['greeting'], interpreter.greeting)
+        self.assertEqual(info['command_list'], interpreter.command_list)
+        self.assertEqual(info['next_event_in'], 0)
+        self.assertEqual(session.saves, 1)
+
+    def test_websocket_port(self):
+        from .live import live_games
+        from .views import websocket_port
         request = testing.DummyRequest()
-        info = my_view(request)
-        self.assertEqual(info, {})
+        settings = request.registry.settings = {}
+        self.assertEqual(websocket_port(request), None)
+        settings['snakemud.websocket_port'] = '8081'
+        self.assertEqual(websocket_port(request), None)
+        live_games.max_size = 10
+        try:
+            self.assertEqual(websocket_port(request), 8081)
+            # the server doesn't start when games are kept in a journal
+            settings['snakemud.journal_dir'] = '/tmp/journal'
+            self.assertEqual(websocket_port(request), None)
+        finally:
+            live_games.max_size = 0
+
+
+class MapTests(unittest.TestCase):
+
+    def test_maps_share_the_level_template(self):
+        from .interpreter import Map
+        self.assertTrue(Map(level=1).template is Map(level=1).template)
+
+    def test_changes_are_kept_in_the_overlay(self):
+        from .interpreter import Map, BODY, FLOOR
+        map = Map(level=1)
+        x, y = map.start_pos[0]
+        map[x, y] = BODY
+        self.assertEqual(map[x, y], BODY)
+        self.assertEqual(map.template[x, y], FLOOR)
+        self.assertEqual(map.changes, {(x, y): BODY})
+        map[x, y] = FLOOR
+        self.assertEqual(map.changes, {})
+
+    def test_neighbors(self):
+        from .interpreter import Map, BODY, WALL
+        from .levels import neighbor_mask
+        map = Map(level=2)
+        template = map.template
+        for y in range(-1, template.height + 1):
+            for x in range(-1, template.width + 1):
+                self.assertEqual(template.neighbor_mask(x, y),
+                                 neighbor_mask(template, x, y))
+        x, y = map.start_pos[0]
+        map[x + 1, y] = BODY
+        self.assertEqual(map.neighbors(x, y),
+                         tuple(map[pos] for pos in [(x, y - 1), (x, y + 1),
+                                                    (x + 1, y), (x - 1, y)]))
+        self.assertEqual(map.neighbors(-5, -5), (WALL, ) * 4)
+
+    def test_neighbors_are_looked_up_once_per_move(self):
+        from .interpreter import Interpreter
+        interpreter = Interpreter()
+        neighbors = interpreter.neighbors()
+        self.assertTrue(interpreter.neighbors() is neighbors)
+        interpreter.interpret('look')
+        self.assertTrue(interpreter.neighbors() is neighbors)
+        d = interpreter.pick_direction()
+        if d:
+            interpreter.interpret('go ' + d)
+            self.assertFalse(interpreter.neighbors() is neighbors)
+
+    def test_pickle_size_does_not_depend_on_level_size(self):
+        import pickle
+        from .interpreter import Map
+        small = pickle.dumps(Map(level=1), 2)
+        big = pickle.dumps(Map(level=3), 2)
+        self.assertEqual(len(small), len(big))
+
+    def test_unpickle_old_format(self):
+        from .interpreter import Map, HEAD, BODY
+        template = Map(level=2).template
+        data = [list(row) for row in template.rows]
+        data[3][4] = HEAD
+        data[3][5] = BODY
+        map = Map.__new__(Map)
+        map.__setstate__(dict(data=data, start_length=17,
+                              start_pos=[(4, 3)]))
+        self.assertTrue(map.template is template)
+        self.assertEqual(map.changes, {(4, 3): HEAD, (5, 3): BODY})
+
+
+class InterpreterStateTests(unittest.TestCase):
+
+    def make_interpreter(self):
+        from .interpreter import Interpreter
+        interpreter = Interpreter()
+        interpreter.interpret('restart 3')
+        interpreter.interpret('explore 20')
+        interpreter.interpret('map on')
+        return interpreter
+
+    def assertSameState(self, a, b):
+        for attr in ['level', 'x', 'y', 'length', 'tail', 'seen',
+                     'auto_map', 'auto_draw', 'activity', 'last_event']:
+            self.assertEqual(getattr(a, attr), getattr(b, attr), attr)
+        self.assertEqual(a.map.changes, b.map.changes)
+
+    def test_pickle_roundtrip(self):
+        import pickle
+        interpreter = self.make_interpreter()
+        data = pickle.dumps(interpreter, 2)
+        copy = pickle.loads(data)
+        self.assertSameState(interpreter, copy)
+        self.assertEqual(copy.interpret('map'), interpreter.interpret('map'))
+
+    def test_compact_state_is_smaller_than_pickled_object_graph(self):
+        import pickle
+        interpreter = self.make_interpreter()
+        self.assertLess(len(pickle.dumps(interpreter, 2)),
+                        len(pickle.dumps(interpreter.__dict__, 2)))
+
+    def test_upgrade_old_pickled_state(self):
+        from .interpreter import Interpreter
+        interpreter = self.make_interpreter()
+        old = Interpreter.__new__(Interpreter)
+        old.__setstate__(dict(interpreter.__dict__))
+        self.assertSameState(interpreter, old)
+
+
+class LevelIndexTests(unittest.TestCase):
+
+    def test_levels_are_parsed_once(self):
+        from .levels import LevelIndex
+        index = LevelIndex()
+        self.assertTrue(1 in index)
+        self.assertFalse(0 in index)
+        self.assertTrue(index[3] is index[3])
+        self.assertEqual(index[3].start_length, 35)
+        self.assertEqual(len(index[3].start_pos), 1)
+
+    def test_invalidate(self):
+        from .levels import LevelIndex
+        index = LevelIndex()
+        template = index[1]
+        index.invalidate()
+        self.assertFalse(index[1] is template)
+        self.assertEqual(index[1].rows, template.rows)
+
+    def test_auto_reload_notices_changed_files(self):
+        from .levels import LevelIndex
+        index = LevelIndex()
+        index.auto_reload = True
+        template = index[1]
+        self.assertTrue(index[1] is template)
+        index._mtimes = {}  # pretend the files were touched
+        index._last_check = 0
+        self.assertFalse(index[1] is template)
+
+
+class BodyTests(unittest.TestCase):
+
+    def test_body(self):
+        from .interpreter import Body
+        body = Body([(1, 1), (1, 2)])
+        body.append((2, 2))
+        self.assertEqual(body[0], (1, 1))
+        self.assertEqual(body[-1], (2, 2))
+        self.assertEqual(body.popleft(), (1, 1))
+        self.assertFalse((1, 1) in body)
+        self.assertTrue((1, 2) in body)
+        self.assertEqual(len(body), 2)
+
+    def test_pickle(self):
+        import pickle
+        from .interpreter import Body
+        body = Body([(1, 1), (1, 2)])
+        copy = pickle.loads(pickle.dumps(body, 2))
+        self.assertEqual(copy, body)
+        self.assertTrue((1, 2) in copy)
+
+    def test_snake_does_not_outgrow_its_length(self):
+        from .interpreter import Interpreter
+        interpreter = Interpreter()
+        interpreter.interpret('explore 30')
+        self.assertTrue(len(interpreter.tail) <= interpreter.length)
+        self.assertEqual(len(interpreter.map.changes),
+                         len(interpreter.tail) + 1)
+
+
+class ExploredTests(unittest.TestCase):
+
+    def test_mark_around(self):
+        from .interpreter import Explored
+        seen = Explored(10, 5)
+        self.assertFalse(seen)
+        seen.mark_around(0, 0)
+        self.assertEqual(len(seen), 9)
+        self.assertTrue((-1, -1) in seen)
+        self.assertFalse((2, 2) in seen)
+        self.assertEqual(seen.bounds, (-1, 1, -1, 1))
+        self.assertEqual(seen.unseen_around(1, 1), 5)
+
+    def test_tostring_roundtrip(self):
+        from .interpreter import Explored
+        seen = Explored(10, 5)
+        seen.mark_around(3, 2)
+        seen.mark_around(4, 2)
+        copy = Explored(10, 5, seen.tostring())
+        self.assertEqual(copy, seen)
+        self.assertEqual(copy.bounds, seen.bounds)
+        self.assertEqual(len(copy), len(seen))
+
+    def test_upgrade_old_seen_set(self):
+        from .interpreter import Interpreter, Explored
+        interpreter = Interpreter()
+        state = dict(interpreter.__dict__)
+        state['seen'] = set(interpreter.seen)
+        old = Interpreter.__new__(Interpreter)
+        old.__setstate__(state)
+        self.assertTrue(isinstance(old.seen, Explored))
+        self.assertEqual(old.seen, interpreter.seen)
+
+
+def render_map_the_old_way(interpreter):
+    import re
+    seen = set(interpreter.seen)
+    tail = set(interpreter.tail)
+    x0, y0 = interpreter.x, interpreter.y
+    xs = [x for (x, y) in seen]
+    ys = [y for (x, y) in seen]
+    xmin, xmax = max(min(xs), x0 - 15), min(max(xs), x0 + 15)
+    ymin, ymax = max(min(ys), y0 - 15), min(max(ys), y0 + 15)
+    rows = []
+    for y in range(ymin, ymax + 1):
+        row = ['[[;#a84;]%s]' % interpreter.map[x, y]
+               if (x, y) == (x0, y0) or (x, y) in tail and (x, y) in seen
+               else interpreter.map[x, y] if (x, y) in seen
+               else ' '
+               for x in range(xmin, xmax + 1)]
+        rows.append(' '.join(row))
+    map = '\n'.join(rows)
+    while True:
+        s = re.sub(r'(\[\[;#a84;][^]]*)] \[\[;#a84;]([^]]*])', r'\1 \2', map)
+        if s == map:
+            break
+        map = s
+    return map
+
+
+class MapRenderingTests(unittest.TestCase):
+
+    def test_same_output_as_before(self):
+        import random
+        from .interpreter import Interpreter
+        from .markup import markup
+        interpreter = Interpreter()
+        for level in 1, 2, 3:
+            interpreter.interpret('restart %d' % level)
+            for n in range(100):
+                interpreter.interpret(random.choice('nsew'))
+                self.assertEqual(markup(interpreter.do_map()),
+                                 render_map_the_old_way(interpreter))
+
+    def test_rows_are_reused(self):
+        from .interpreter import Interpreter
+        interpreter = Interpreter()
+        interpreter.do_map()
+        rows = dict(interpreter._map_rows)
+        interpreter.do_map()
+        for y, row in interpreter._map_rows.items():
+            self.assertTrue(row is rows[y])
+
+
+class DrawingTests(unittest.TestCase):
+
+    def test_rooms_are_drawn_once(self):
+        from .interpreter import Interpreter, room_art
+        interpreter = Interpreter()
+        art = interpreter.do_draw()
+        self.assertTrue(interpreter.do_draw() is art)
+        self.assertTrue(art in room_art.values())
+        self.assertEqual(len(room_art), 4 ** 4)
+
+    def test_side_by_side(self):
+        from .interpreter import Interpreter
+        from .markup import colored, markup
+        interpreter = Interpreter()
+        left = colored('#a84', '@') + '\nab\n'
+        self.assertEqual(
+            markup(interpreter.side_by_side(left, 'x\ny\nz\nw', 2)),
+            '@   x\n'.replace('@', '[[;#a84;]@]') +
+            'ab  y\n'
+            '    z\n'
+            '    w')
+
+
+class EventsViewTests(unittest.TestCase):
+
+    def setUp(self):
+        from .benchmark import FakeClock
+        from . import views, interpreter
+        self.config = testing.setUp(settings={
+            'snakemud.events_max_wait': '10'})
+        self.clock = FakeClock()
+        self.saved_time = views.time, interpreter.time
+        views.time = interpreter.time = self.clock
+
+    def tearDown(self):
+        from . import views, interpreter
+        views.time, interpreter.time = self.saved_time
+        testing.tearDown()
+
+    def make_request(self, session, **params):
+        return dummy_request(session, **params)
+
+    def test_long_poll_waits_for_the_event(self):
+        from .benchmark import CountingSession
+        from .views import events
+        session = CountingSession()
+        self.assertEqual(events(self.make_request(session))['next_event_in'],
+                         60)
+        self.clock.sleep(55)
+        result = events(self.make_request(session, wait='10'))
+        self.assertEqual(result['response'], 'You sense the passage of time.')
+        self.assertEqual(result['next_event_in'], None)
+        self.assertTrue(self.clock.time() > 1000000060)
+
+    def test_no_waiting_for_far_away_events(self):
+        from .benchmark import CountingSession
+        from .views import events
+        session = CountingSession()
+        events(self.make_request(session))
+        start = self.clock.time()
+        result = events(self.make_request(session, wait='10'))
+        self.assertEqual(result['response'], None)
+        self.assertEqual(result['next_event_in'], 60)
+        self.assertEqual(self.clock.time(), start)
+
+    def test_too_many_waiting(self):
+        from .benchmark import CountingSession
+        from .views import events, waiters
+        session = CountingSession()
+        events(self.make_request(session))
+        self.clock.sleep(55)
+        waiters.count = 2
+        try:
+            result = events(self.make_request(session, wait='10'))
+        finally:
+            waiters.count = 0
+        self.assertEqual(result['response'], None)
+        self.assertEqual(result['next_event_in'], 5)
+        self.assertTrue(result['busy'])
+        # the client comes back when the event is due
+        self.clock.sleep(5.1)
+        result = events(self.make_request(session, wait='10'))
+        self.assertEqual(result['response'], 'You sense the passage of time.')
+
+    def test_idle_player_traffic(self):
+        from .benchmark import idle_player_traffic
+        old, new = idle_player_traffic(minutes=5)
+        self.assertEqual(old, (60, 60))
+        self.assertTrue(new[0] <= 1, new)
+        self.assertTrue(new[1] <= 1, new)
+
+
+class ChangeTrackingTests(unittest.TestCase):
+
+    def make_interpreter(self):
+        from .interpreter import Interpreter
+        interpreter = Interpreter()
+        interpreter.interpret('look')
+        interpreter.mark_saved()
+        return interpreter
+
+    def test_new_interpreter_needs_saving(self):
+        from .interpreter import Interpreter
+        self.assertTrue(Interpreter().changed)
+
+    def test_read_only_commands(self):
+        interpreter = self.make_interpreter()
+        for command in ['look', 'help', 'commands', 'gps', 'compass', 'map',
+                        'draw', 'level', 'xyzzy']:
+            interpreter.interpret(command)
+            self.assertFalse(interpreter.changed, command)
+
+    def test_commands_that_change_state(self):
+        for command in ['map on', 'draw on', 'restart']:
+            interpreter = self.make_interpreter()
+            interpreter.interpret(command)
+            self.assertTrue(interpreter.changed, command)
+
+    def test_moving_changes_state(self):
+        interpreter = self.make_interpreter()
+        while not interpreter.pick_direction():
+            interpreter.do_restart()
+            interpreter.mark_saved()
+        direction = interpreter.pick_direction()
+        interpreter.interpret(direction)
+        self.assertTrue(interpreter.changed)
+
+    def test_last_event_slack(self):
+        interpreter = self.make_interpreter()
+        interpreter.last_event += 1
+        self.assertFalse(interpreter.changed)
+        interpreter.last_event += interpreter.last_event_slack
+        self.assertTrue(interpreter.changed)
+
+    def test_unpickled_interpreter_is_unchanged(self):
+        import pickle
+        interpreter = pickle.loads(pickle.dumps(self.make_interpreter(), 2))
+        self.assertFalse(interpreter.changed)
+
+    def test_command_view_skips_save(self):
+        from .benchmark import CountingSession
+        from .views import command, session_writes
+        testing.setUp()
+        try:
+            session = CountingSession()
+            request = lambda c: dummy_request(session, c=c)
+            command(request('look'))
+            self.assertEqual(session.saves, 1)
+            skipped = session_writes.skipped
+            command(request('look'))
+            command(request('help'))
+            self.assertEqual(session.saves, 1)
+            self.assertEqual(session_writes.skipped, skipped + 2)
+            command(request('map on'))
+            self.assertEqual(session.saves, 2)
+        finally:
+            testing.tearDown()
+
+
+class CommandRegistryTests(unittest.TestCase):
+
+    def test_registry_is_built_once_per_class(self):
+        from .interpreter import Interpreter
+        self.assertTrue(Interpreter.commands() is Interpreter.commands())
+
+        class MyInterpreter(Interpreter):
+            def do_dance(self, *args):
+                """dance"""
+        self.assertTrue('dance' in MyInterpreter().command_list)
+        self.assertFalse('dance' in Interpreter().command_list)
+
+    def test_aliases(self):
+        from .interpreter import Interpreter
+        interpreter = Interpreter()
+        self.assertEqual(interpreter.interpret('pick up stone'),
+                         interpreter.interpret('take stone'))
+        self.assertEqual(interpreter.interpret('look at the map'),
+                         interpreter.interpret('examine the map'))
+        self.assertEqual(interpreter.interpret('xyzzy'),
+                         "Don't know how to xyzzy, sorry.")
+
+    def test_instance_commands(self):
+        from .interpreter import Interpreter
+        interpreter = Interpreter()
+        version = interpreter.command_list_version
+        interpreter.do_quit = lambda: 'Bye!'
+        interpreter.do_quit.__doc__ = 'exit'
+        self.assertTrue('quit' in interpreter.command_list)
+        self.assertNotEqual(interpreter.command_list_version, version)
+        self.assertEqual(interpreter.interpret('quit'), 'Bye!')
+        self.assertTrue('quit       -- exit' in interpreter.interpret('commands'))
+
+    def test_command_list_only_sent_when_changed(self):
+        from .benchmark import CountingSession
+        from .views import command
+        testing.setUp()
+        try:
+            session = CountingSession()
+            result = command(dummy_request(session, c='look'))
+            version = result['command_list_version']
+            self.assertTrue('look' in result['command_list'])
+            result = command(dummy_request(session, c='look', v=version))
+            self.assertFalse('command_list' in result)
+        finally:
+            testing.tearDown()
+
+
+class BatchCommandTests(unittest.TestCase):
+
+    def setUp(self):
+        testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_semicolons(self):
+        from .benchmark import CountingSession
+        from .views import command
+        session = CountingSession()
+        result = command(dummy_request(session, c='gps; level;inventory'))
+        self.assertEqual(len(result['responses']), 3)
+        self.assertTrue(result['responses'][0].startswith('Your GPS reads'))
+        self.assertEqual(result['response'], '\n\n'.join(result['responses']))
+
+    def test_several_parameters(self):
+        from .benchmark import CountingSession
+        from .views import command
+        session = CountingSession()
+        request = dummy_request(session)
+        request.params = MultiDict([('c', 'map on'), ('c', 'map off')])
+        result = command(request)
+        self.assertEqual(result['responses'],
+                         ['Automap enabled.', 'Automap disabled.'])
+        self.assertEqual(session.saves, 1)
+
+    def test_json_list(self):
+        from .benchmark import CountingSession
+        from .views import command
+        request = dummy_request(CountingSession())
+        request.content_type = 'application/json'
+        request.json_body = ['level', 'level 2']
+        result = command(request)
+        self.assertEqual(result['responses'], [
+            "You're playing level 1.",
+            "If you want to play a different level, use 'restart 2' instead."])
+
+    def test_bad_json(self):
+        import tempfile, shutil
+        from webob import Request
+        from .benchmark import make_app
+        data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, data_dir)
+        app = make_app(data_dir)
+        response = Request.blank('/command', method='POST', body='["look"',
+                                 content_type='application/json'
+                                 ).get_response(app)
+        self.assertEqual(response.status_int, 400)
+
+    def test_too_many_commands(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        from .benchmark import CountingSession
+        from .views import command, max_commands
+        session = CountingSession()
+        result = command(dummy_request(session, c=';'.join(
+            ['gps'] * max_commands)))
+        self.assertEqual(len(result['responses']), max_commands)
+        self.assertRaises(HTTPBadRequest, command, dummy_request(
+            session, c=';'.join(['gps'] * (max_commands + 1))))
+
+
+def make_interpreter_on(rows, head, length=1):
+    """Create an Interpreter with a short snake on a level made of rows."""
+    from .interpreter import Interpreter, Map, Body, HEAD
+    from .levels import LevelTemplate
+    interpreter = Interpreter()
+    interpreter.map = Map(template=LevelTemplate(None, rows, [head], length))
+    interpreter.x, interpreter.y = head
+    interpreter.map[head] = HEAD
+    interpreter.tail = Body()
+    interpreter.length = length
+    interpreter.seen = None
+    interpreter.mark_seen(*head)
+    return interpreter
+
+
+class PathfindingTests(unittest.TestCase):
+
+    room = ['#######',
+            '#.....#',
+            '#.....#',
+            '#######']
+
+    def test_explore_goes_to_the_nearest_unexplored_place(self):
+        interpreter = make_interpreter_on(['#########',
+                                           '#.......#',
+                                           '#########'], (1, 1))
+        interpreter.interpret('explore 10')
+        self.assertEqual((interpreter.x, interpreter.y), (7, 1))
+        self.assertEqual(interpreter.interpret('explore'),
+                         'I agree, you should do some exploring.')
+
+    def test_goto(self):
+        interpreter = make_interpreter_on(self.room, (1, 1), length=2)
+        interpreter.interpret('explore 5')
+        interpreter.interpret('goto +1, +2')
+        self.assertEqual((interpreter.x, interpreter.y), (1, 2))
+        self.assertEqual(interpreter.interpret('goto 1 2'),
+                         "You're already there.")
+
+    def test_goto_unknown_places(self):
+        interpreter = make_interpreter_on(self.room, (1, 1))
+        self.assertEqual(interpreter.interpret('goto 5 2'),
+                         "You don't know of any way there.")
+        self.assertEqual(interpreter.interpret('goto 0 0'),
+                         "You don't know of any way there.")
+        self.assertEqual(interpreter.interpret('goto home'),
+                         'Go to where?  (Try the coordinates your GPS shows.)')
+
+    def test_goto_does_not_go_through_the_body(self):
+        interpreter = make_interpreter_on(['#######',
+                                           '#.....#',
+                                           '#######'], (1, 1), length=3)
+        interpreter.interpret('explore 4')
+        self.assertEqual((interpreter.x, interpreter.y), (5, 1))
+        self.assertEqual(interpreter.interpret('goto 4 1'),
+                         "You don't know of any way there.")
+
+    def test_goto_stops_when_blocked(self):
+        interpreter = make_interpreter_on(self.room, (1, 1), length=2)
+        interpreter.interpret('explore 5')
+        interpreter.interpret('goto 1 1')
+        interpreter.find_path = lambda target: ['e', 'n', 'e', 'e']
+        output = interpreter.interpret('goto 4 1')
+        self.assertTrue(output.startswith("You go east."), output)
+        self.assertEqual(output.splitlines()[-2:],
+                         ["There's a wall blocking your way.",
+                          "You stop at +2, +1."])
+        self.assertEqual((interpreter.x, interpreter.y), (2, 1))
+
+    def test_distances_are_cached(self):
+        from .levels import get_template
+        template = get_template(3)
+        distances = template.distances_to((1, 1))
+        self.assertEqual(distances[1, 2], 1)
+        self.assertTrue(template.distances_to((1, 1)) is distances)
+
+
+class SharedWorldTests(unittest.TestCase):
+
+    def setUp(self):
+        from .world import worlds
+        worlds.clear()
+
+    tearDown = setUp
+
+    def make_interpreter(self, level=1):
+        from .interpreter import Interpreter
+        interpreter = Interpreter(shared_world=True)
+        interpreter.interpret('restart %d' % level)
+        return interpreter
+
+    def assertInWorld(self, interpreter):
+        from .interpreter import SharedMap
+        self.assertTrue(isinstance(interpreter.map, SharedMap))
+        world = interpreter.map.world
+        body = set(interpreter.tail) | set([(interpreter.x, interpreter.y)])
+        self.assertEqual(world.snakes[interpreter.snake_id], body)
+        for pos in body:
+            self.assertEqual(world.owner(pos), interpreter.snake_id)
+
+    def test_snakes_see_each_other(self):
+        from .interpreter import HEAD
+        a = self.make_interpreter()
+        b = self.make_interpreter()
+        self.assertInWorld(a)
+        self.assertInWorld(b)
+        self.assertTrue(a.map.world is b.map.world)
+        self.assertEqual(b.map[a.x, a.y], HEAD)
+
+    def test_other_snakes_block_the_way(self):
+        from .interpreter import BODY, HEAD
+        interpreter = self.make_interpreter(3)
+        world = interpreter.map.world
+        while not interpreter.pick_direction():
+            # boxed in by our own body
+            interpreter.interpret('restart')
+        direction = interpreter.pick_direction()
+        self.assertTrue(world.claim('other', interpreter.coords(direction),
+                                    BODY))
+        self.assertEqual(interpreter.interpret('go ' + direction),
+                         "Some other snake's body blocks the way.")
+        self.assertTrue(world.put('other', interpreter.coords(direction),
+                                  HEAD))
+        self.assertEqual(interpreter.interpret('go ' + direction),
+                         "Another snake is in the way.")
+        self.assertTrue('head of another snake' in interpreter.interpret('look'))
+
+    def test_full_level(self):
+        from .interpreter import Interpreter, SharedMap
+        from .world import get_world
+        world = get_world(1)
+        for pos in world.template.floor:
+            world.claim('other', pos, 'x')
+        interpreter = Interpreter(shared_world=True)
+        self.assertFalse(isinstance(interpreter.map, SharedMap))
+        self.assertTrue('full of snakes' in interpreter.interpret('restart'))
+
+    def test_pickle_roundtrip(self):
+        import pickle
+        from .world import worlds
+        interpreter = self.make_interpreter(3)
+        interpreter.interpret('explore 5')
+        world = interpreter.map.world
+        cells = dict(world.cells)
+        copy = pickle.loads(pickle.dumps(interpreter, 2))
+        self.assertEqual(copy.snake_id, interpreter.snake_id)
+        self.assertTrue(copy.map.world is world)
+        self.assertEqual(world.cells, cells)
+        # after a server restart the snake is put back where it was
+        worlds.clear()
+        copy = pickle.loads(pickle.dumps(interpreter, 2))
+        self.assertFalse(copy.map.world is world)
+        self.assertEqual(copy.map.world.cells, cells)
+        self.assertEqual(copy.events(), None)
+
+    def test_unpickle_after_someone_took_our_place(self):
+        import pickle
+        from .world import worlds, get_world
+        interpreter = self.make_interpreter(3)
+        data = pickle.dumps(interpreter, 2)
+        worlds.clear()
+        get_world(3).claim('other', (interpreter.x, interpreter.y), 'x')
+        copy = pickle.loads(data)
+        self.assertInWorld(copy)
+        self.assertNotEqual((copy.x, copy.y), (interpreter.x, interpreter.y))
+        self.assertTrue(copy.changed)
+        self.assertTrue('somewhere else' in copy.events())
+
+    def test_claim_and_leave_at_once(self):
+        import sys
+        import threading
+        from .world import World
+        from .levels import get_template
+        world = World(get_template(3))
+        floor = world.template.floor
+        sys.setcheckinterval(1)
+        self.addCleanup(sys.setcheckinterval, 100)
+
+        def claim():
+            for pos in floor:
+                world.claim('x', pos, 'x')
+
+        def leave():
+            for n in range(len(floor)):
+                world.leave('x')
+
+        for attempt in range(50):
+            threads = [threading.Thread(target=claim),
+                       threading.Thread(target=leave)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            world.leave('x')
+            self.assertEqual(world.cells, {})
+
+    def test_idle_snakes_are_removed(self):
+        a = self.make_interpreter()
+        b = self.make_interpreter()
+        world = a.map.world
+        world.last_seen[a.snake_id] -= world.idle_timeout + 1
+        self.assertEqual(world.reap(), 1)
+        self.assertFalse(a.snake_id in world.snakes)
+        self.assertTrue(all(owner == b.snake_id
+                            for owner, what in world.cells.values()))
+
+    def free_direction(self, interpreter):
+        while not interpreter.pick_direction():
+            # boxed in by our own body
+            interpreter.interpret('restart')
+        return interpreter.pick_direction()
+
+    def move(self, interpreter):
+        return interpreter.interpret('go ' + self.free_direction(interpreter))
+
+    def test_moving_counts_as_being_around(self):
+        interpreter = self.make_interpreter(3)
+        world = interpreter.map.world
+        world.last_seen[interpreter.snake_id] -= world.idle_timeout + 1
+        self.move(interpreter)
+        self.assertEqual(world.reap(), 0)
+        self.assertInWorld(interpreter)
+
+    def test_move_after_being_reaped(self):
+        import time
+        interpreter = self.make_interpreter(3)
+        world = interpreter.map.world
+        # while we're gone our body isn't in the way, so look before
+        direction = self.free_direction(interpreter)
+        self.assertEqual(world.reap(time.time() + world.idle_timeout + 60),
+                         1)
+        self.assertFalse(interpreter.snake_id in world.snakes)
+        self.assertTrue(interpreter.interpret('go ' + direction).startswith(
+            'You go'))
+        self.assertInWorld(interpreter)
+
+    def test_reaped_and_someone_took_our_place(self):
+        import time
+        interpreter = self.make_interpreter(3)
+        world = interpreter.map.world
+        old_pos = interpreter.x, interpreter.y
+        world.reap(time.time() + world.idle_timeout + 60)
+        world.claim('other', old_pos, 'x')
+        interpreter.interpret('look')
+        self.assertInWorld(interpreter)
+        self.assertNotEqual((interpreter.x, interpreter.y), old_pos)
+        self.assertTrue('somewhere else' in interpreter.events())
+
+    def test_restart_leaves_the_old_level(self):
+        interpreter = self.make_interpreter(1)
+        old_world = interpreter.map.world
+        interpreter.interpret('restart 2')
+        self.assertFalse(interpreter.snake_id in old_world.snakes)
+        self.assertEqual(old_world.cells, {})
+        self.assertInWorld(interpreter)
+
+    def test_many_players_at_once(self):
+        import random
+        import threading
+        from .interpreter import Interpreter, SharedMap
+        from .world import get_world
+        players = [Interpreter(shared_world=True) for n in range(100)]
+        for player in players:
+            player.interpret('restart 3')
+        errors = []
+
+        def play(players):
+            try:
+                for turn in range(20):
+                    for player in players:
+                        player.interpret(random.choice(
+                            ['explore', 'n', 's', 'e', 'w', 'look', 'map']))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=play, args=(players[n::8], ))
+                   for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        world = get_world(3)
+        in_world = [player for player in players
+                    if isinstance(player.map, SharedMap)]
+        self.assertTrue(in_world)
+        for player in in_world:
+            self.assertInWorld(player)
+        self.assertEqual(len(world.cells),
+                         sum(len(player.tail) + 1 for player in in_world))
+
+
+class BenchmarkTests(unittest.TestCase):
+
+    def test_traces(self):
+        from .benchmark import recorded_traces, synthetic_traces
+        traces = recorded_traces()
+        traces.update(synthetic_traces(moves=10))
+        for name in ['newcomer', 'movement', 'explore', 'automap',
+                     'restarts']:
+            self.assertTrue(traces[name], name)
+        self.assertFalse([command for command in traces['newcomer']
+                          if command.startswith('#')])
+
+    def test_command_name(self):
+        from .benchmark import command_name
+        self.assertEqual(command_name('n'), 'go')
+        self.assertEqual(command_name('Go north'), 'go')
+        self.assertEqual(command_name('map on'), 'map')
+        self.assertEqual(command_name(''), '')
+
+    def test_legacy_pickle_is_the_old_object_graph(self):
+        import pickle
+        from StringIO import StringIO
+        from .benchmark import make_session, legacy_pickle
+
+        class Plain(object):
+            pass
+
+        class Unpickler(pickle.Unpickler):
+            def find_class(self, module, name):
+                if module.startswith('snakemud'):
+                    return Plain
+                return pickle.Unpickler.find_class(self, module, name)
+
+        interpreter = make_session(3, 10)
+        old = Unpickler(StringIO(legacy_pickle(interpreter))).load()
+        self.assertEqual(type(old.map.data), list)
+        self.assertEqual(old.map.data[old.y][old.x], '@')
+        self.assertEqual(old.map.data[old.tail[0][1]][old.tail[0][0]], ',')
+        self.assertEqual(old.tail, tuple(interpreter.tail))
+        self.assertEqual(old.seen, set(interpreter.seen))
+        self.assertFalse(hasattr(old, 'snake_id'))
+
+    def test_legacy_unpickle(self):
+        from .benchmark import make_session, legacy_pickle, legacy_unpickle
+        interpreter = make_session(2, 10)
+        old = legacy_unpickle(legacy_pickle(interpreter))
+        self.assertEqual((old.x, old.y), (interpreter.x, interpreter.y))
+        self.assertEqual(old.tail, interpreter.tail)
+        self.assertEqual(old.seen, interpreter.seen)
+        self.assertEqual(old.map.changes, interpreter.map.changes)
+        self.assertTrue(old.map.template is interpreter.map.template)
+
+    def test_replay_interpreter(self):
+        from .benchmark import replay_interpreter
+        stats = replay_interpreter(['restart 3', 'map on', 'explore 3',
+                                    'gps', 'gps'])
+        self.assertEqual(sorted(stats), ['explore', 'gps', 'map', 'restart'])
+        self.assertEqual(len(stats['gps']), 2)
+        self.assertTrue(stats['restart'].session_bytes[0] > 0)
+        self.assertEqual(stats['gps'].session_bytes, [0, 0])
+        self.assertTrue(stats['explore'].percentile(99) > 0)
+
+    def test_replay_app(self):
+        from .benchmark import replay_app
+        stats = replay_app(['restart 2', 'level', 'level', 'explore 2'])
+        self.assertEqual(sorted(stats), ['explore', 'level', 'restart'])
+        self.assertTrue(stats['restart'].session_bytes[0] > 0)
+        self.assertEqual(stats['level'].session_bytes[1], 0)
+
+
+class GridTests(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        from .levels import levels
+        shutil.rmtree(self.tempdir)
+        levels.invalidate()
+
+    def make_grid(self, number, width, height, rows, start_pos):
+        import os
+        from .levels import write_grid, GridTemplate
+        filename = os.path.join(self.tempdir, 'l%d.grid' % number)
+        with open(filename, 'wb') as f:
+            write_grid(f, width, height, rows, start_pos, 11)
+        return GridTemplate(number, filename)
+
+    def test_convert_text_level(self):
+        import os
+        from .levels import GridTemplate, convert_level, get_template
+        template = get_template(3)
+        filename = os.path.join(self.tempdir, 'l3.grid')
+        text = pkg_resources.resource_string('snakemud', 'maps/l3.txt')
+        convert_level(text, filename)
+        grid = GridTemplate(3, filename)
+        self.assertEqual((grid.width, grid.height),
+                         (template.width, template.height))
+        self.assertEqual(grid.start_pos, template.start_pos)
+        self.assertEqual(grid.start_length, template.start_length)
+        for y in range(-1, template.height + 1):
+            for x in range(-1, template.width + 1):
+                self.assertEqual(grid[x, y], template[x, y], (x, y))
+        self.assertEqual(grid.distances_to(template.start_pos[0]),
+                         template.distances_to(template.start_pos[0]))
+
+    def test_playing_on_a_big_level(self):
+        import pickle
+        from .interpreter import Interpreter, ChunkedExplored
+        from .levels import levels, ManhattanDistances
+        width, height = 2000, 1500
+        row = '#' + '.' * (width - 2) + '#'
+        rows = ['#' * width] + [row] * (height - 2) + ['#' * width]
+        grid = self.make_grid(42, width, height, rows, [(1000, 700)])
+        self.assertTrue(isinstance(grid.distances_to((1, 1)),
+                                   ManhattanDistances))
+        levels.levels[42] = grid
+        interpreter = Interpreter()
+        interpreter.interpret('restart 42')
+        interpreter.interpret('explore 20')
+        self.assertTrue(isinstance(interpreter.seen, ChunkedExplored))
+        x, y = interpreter.x, interpreter.y
+        interpreter.interpret('explore 20')
+        interpreter.interpret('goto %d %d' % (x, y))
+        self.assertEqual((interpreter.x, interpreter.y), (x, y))
+        data = pickle.dumps(interpreter, 2)
+        self.assertTrue(len(data) < 1000, len(data))
+        copy = pickle.loads(data)
+        self.assertEqual(copy.seen, interpreter.seen)
+        self.assertEqual(copy.map.changes, interpreter.map.changes)
+        self.assertEqual(copy.do_map(), interpreter.do_map())
+
+    def test_chunked_explored(self):
+        from .interpreter import Explored, ChunkedExplored
+        seen = Explored(200, 100)
+        chunked = ChunkedExplored(200, 100)
+        for pos in [(0, 0), (63, 62), (64, 63), (199, 99), (120, 50)]:
+            seen.mark_around(*pos)
+            chunked.mark_around(*pos)
+        self.assertEqual(set(chunked), set(seen))
+        self.assertEqual(len(chunked), len(seen))
+        self.assertEqual(chunked.bounds, seen.bounds)
+        self.assertEqual(chunked.unseen_around(64, 64),
+                         seen.unseen_around(64, 64))
+        copy = ChunkedExplored(200, 100, chunked.tostring())
+        self.assertEqual(set(copy), set(seen))
+        self.assertEqual(copy.bounds, seen.bounds)
+        self.assertEqual(len(chunked.chunks), 5)
+
+    def test_size_limit(self):
+        from .levels import write_grid
+        from StringIO import StringIO
+        self.assertRaises(ValueError, write_grid, StringIO(), 40000, 10,
+                          [], [], 11)
+
+
+class CaveTests(unittest.TestCase):
+
+    def test_caves_are_reproducible(self):
+        from .caves import Cave, generate_cave
+        cave = generate_cave(Cave(42, 80, 40))
+        self.assertEqual(generate_cave(Cave(42, 80, 40)).rows, cave.rows)
+        self.assertEqual(generate_cave(Cave(42, 80, 40)).start_pos,
+                         cave.start_pos)
+        self.assertNotEqual(generate_cave(Cave(43, 80, 40)).rows, cave.rows)
+
+    def test_big_caves_are_connected(self):
+        from .caves import Cave, generate_cave
+        from .levels import FLOOR, WALL
+        cave = generate_cave(Cave(1, 300, 200))
+        self.assertEqual((cave.width, cave.height), (300, 200))
+        self.assertEqual(cave.rows[0], WALL * 300)
+        self.assertEqual(cave.rows[-1], WALL * 300)
+        self.assertTrue(len(cave.floor) > 300 * 200 / 4)
+        for pos in cave.start_pos:
+            self.assertEqual(cave[pos], FLOOR)
+        distances = cave.distances_to(cave.start_pos[0])
+        self.assertEqual(len(distances), len(cave.floor))
+
+    def test_caves_are_cached(self):
+        from .caves import Cave, caves
+        self.assertTrue(caves[Cave(5, 20, 20)] is caves[Cave(5, 20, 20)])
+
+    def test_cache_is_bounded_by_cells(self):
+        from .caves import Cave, CaveCache
+        cache = CaveCache()
+        cache.max_cells = 1000
+        small = [cache[Cave(n, 10, 10)] for n in range(10)]
+        self.assertEqual(len(cache._recent), 10)
+        big = cache[Cave(0, 20, 20)]
+        self.assertEqual(len(cache._recent), 7)
+        self.assertEqual(cache._cells, 1000)
+        self.assertFalse(Cave(3, 10, 10) in cache._recent)
+        self.assertTrue(Cave(4, 10, 10) in cache._recent)
+        # one cave is always kept, however big
+        huge = cache[Cave(0, 40, 40)]
+        self.assertEqual(cache._recent.keys(), [Cave(0, 40, 40)])
+
+    def test_restart_cave(self):
+        import pickle
+        from .caves import Cave
+        from .interpreter import Interpreter
+        interpreter = Interpreter()
+        interpreter.interpret('restart cave 123 60x30')
+        self.assertEqual(interpreter.level, Cave(123, 60, 30))
+        self.assertEqual(interpreter.interpret('level'),
+                         "You're playing cave 123 60x30.")
+        interpreter.interpret('explore 10')
+        data = pickle.dumps(interpreter, 2)
+        self.assertTrue(len(data) < 500, len(data))
+        copy = pickle.loads(data)
+        self.assertEqual(copy.level, interpreter.level)
+        self.assertTrue(copy.map.template is interpreter.map.template)
+        self.assertEqual(copy.map.changes, interpreter.map.changes)
+        self.assertEqual(copy.seen, interpreter.seen)
+
+    def test_restart_cave_errors(self):
+        from .interpreter import Interpreter
+        interpreter = Interpreter()
+        self.assertEqual(interpreter.interpret('restart cave 1 5x5'),
+                         'Caves can be from 10 to 500 cells across.')
+        self.assertEqual(interpreter.interpret('restart cave 1 axb'),
+                         "That's not a cave size.")
+        self.assertEqual(interpreter.interpret('restart cave one'),
+                         "That's not a cave number.")
+        self.assertEqual(interpreter.level, 1)
+
+
+class MetricsTests(unittest.TestCase):
+
+    def tearDown(self):
+        from .metrics import registry
+        registry.enabled = True
+
+    def test_histogram(self):
+        from .metrics import Registry
+        registry = Registry()
+        histogram = registry.histogram('x_seconds', 'Some time.',
+                                       label='verb', buckets=[0.1, 1])
+        histogram.observe(0.05, 'go')
+        histogram.observe(0.5, 'go')
+        histogram.observe(5, 'go')
+        histogram.observe(1, 'a"b')
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP x_seconds Some time.',
+            '# TYPE x_seconds histogram',
+            'x_seconds_bucket{verb="a\\"b",le="0.1"} 0',
+            'x_seconds_bucket{verb="a\\"b",le="1.0"} 1',
+            'x_seconds_bucket{verb="a\\"b",le="+Inf"} 1',
+            'x_seconds_sum{verb="a\\"b"} 1',
+            'x_seconds_count{verb="a\\"b"} 1',
+            'x_seconds_bucket{verb="go",le="0.1"} 1',
+            'x_seconds_bucket{verb="go",le="1.0"} 2',
+            'x_seconds_bucket{verb="go",le="+Inf"} 3',
+            'x_seconds_sum{verb="go"} 5.55',
+            'x_seconds_count{verb="go"} 3',
+        ]) + '\n')
+
+    def test_disabled(self):
+        from .metrics import Registry
+        registry = Registry()
+        counter = registry.counter('x_total', 'Things.')
+        registry.enabled = False
+        counter.inc()
+        self.assertEqual(counter.values, {})
+
+    def test_only_drawing_is_timed(self):
+        from .interpreter import Interpreter
+        from .metrics import render_seconds
+
+        def drawings():
+            return sum(render_seconds.values.get('draw', [0])[:-1])
+
+        interpreter = Interpreter()
+        before = drawings()
+        interpreter.interpret('draw on')
+        interpreter.interpret('draw off')
+        self.assertEqual(drawings(), before)
+        interpreter.interpret('draw')
+        self.assertEqual(drawings(), before + 1)
+
+    def test_metrics_page(self):
+        import re, tempfile, shutil
+        from webob import Request
+        from .benchmark import make_app
+        data_dir = tempfile.mkdtemp()
+        try:
+            app = make_app(data_dir)
+            Request.blank('/command', POST={'c': 'n'}).get_response(app)
+            response = Request.blank('/metrics', remote_addr='127.0.0.1'
+                                     ).get_response(app)
+            self.assertEqual(response.status_int, 200)
+            self.assertTrue('snakemud_command_seconds_count{verb="go"}'
+                            in response.body)
+            self.assertTrue('snakemud_session_save_seconds_count'
+                            in response.body)
+            self.assertTrue(re.search('^snakemud_session_state_bytes_count'
+                                      ' [1-9]', response.body, re.M))
+            response = Request.blank('/metrics', remote_addr='10.0.0.1'
+                                     ).get_response(app)
+            self.assertEqual(response.status_int, 403)
+            app = make_app(data_dir, **{'snakemud.metrics': 'false'})
+            response = Request.blank('/metrics').get_response(app)
+            self.assertEqual(response.status_int, 404)
+        finally:
+            shutil.rmtree(data_dir)
+
+    def test_verb(self):
+        from .interpreter import Interpreter
+        interpreter = Interpreter()
+        self.assertEqual(interpreter.verb('N'), 'go')
+        self.assertEqual(interpreter.verb('look at map'), 'examine')
+        self.assertEqual(interpreter.verb('dance'), 'unknown')
+        self.assertEqual(interpreter.verb(' '), '')
+
+
+class SimulatorTests(unittest.TestCase):
+
+    def test_games_are_reproducible(self):
+        from .simulate import games
+        self.assertEqual(games(['1', '2'], ['random'], 3, 42),
+                         games(['1', '2'], ['random'], 3, 42))
+        self.assertNotEqual(games(['1'], ['random'], 3, 42),
+                            games(['1'], ['random'], 3, 43))
+        self.assertEqual(len(games(['1', '2'], ['random', 'wall'], 3, 0)),
+                         12)
+
+    def test_bots(self):
+        from .simulate import bots, play
+        for bot in bots:
+            result = play('cave 5 30x20', bot, 1, max_moves=50)
+            self.assertTrue(result['outcome'] in ('win', 'dead end',
+                                                  'timeout'))
+            self.assertTrue(result['moves'] <= 50)
+            self.assertEqual(play('cave 5 30x20', bot, 1, max_moves=50)
+                             ['moves'], result['moves'])
+
+    def test_processes_do_not_change_results(self):
+        from .simulate import games, simulate
+        todo = games(['2', 'cave 7 20x20'], ['random', 'frontier'], 2, 0)
+
+        def strip(results):
+            return [dict(r, seconds=None) for r in results]
+        self.assertEqual(strip(simulate(todo, 30, processes=0)),
+                         strip(simulate(todo, 30, processes=2)))
+
+    def test_output(self):
+        from StringIO import StringIO
+        from .simulate import ResultWriter
+        result = dict(level='1', bot='wall', seed=7, outcome='win', moves=12,
+                      seconds=0.5)
+        f = StringIO()
+        ResultWriter(f, 'csv').write(result)
+        self.assertEqual(f.getvalue().splitlines(),
+                         ['level,bot,seed,outcome,moves,seconds',
+                          '1,wall,7,win,12,0.5'])
+        f = StringIO()
+        ResultWriter(f, 'jsonl').write(result)
+        self.assertEqual(f.getvalue(),
+                         '{"bot": "wall", "level": "1", "moves": 12,'
+                         ' "outcome": "win", "seconds": 0.5, "seed": 7}\n')
+
+    def test_summary(self):
+        from .simulate import Summary
+        summary = Summary()
+        for outcome, moves in [('win', 10), ('win', 30), ('dead end', 5),
+                               ('timeout', 100)]:
+            summary.add(dict(level='1', bot='wall', seed=0, outcome=outcome,
+                             moves=moves, seconds=0.01))
+        [row] = summary.rows()
+        self.assertEqual(row['games'], 4)
+        self.assertEqual(row['wins'], 0.5)
+        self.assertEqual(row['dead_ends'], 0.25)
+        self.assertEqual(row['median_moves'], 30)
+        self.assertAlmostEqual(row['ms_per_game'], 10)
+
+
+class JournalTests(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        from .journal import Journal
+        self.tmpdir = tempfile.mkdtemp()
+        self.journal = Journal(self.tmpdir, snapshot_every=5,
+                               keep_history=True)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def play(self, player, commands):
+        game = self.journal.load(player)
+        for command in commands:
+            game.interpret(command)
+        game.save()
+        return game
+
+    def test_replay_is_exact(self):
+        from .interpreter import Interpreter
+        from .journal import replay
+        entries = [[1000.0, 42, 'command', 'restart cave'],
+                   [1001.0, 7, 'command', 'explore 5'],
+                   [1100.0, 0, 'events']]
+        first = replay(Interpreter(), entries)
+        second = replay(Interpreter(), entries)
+        self.assertEqual(first.__getstate__(), second.__getstate__())
+        self.assertEqual(first.level, second.level)
+        self.assertEqual(first.last_event, 1100.0)
+        self.assertFalse(first.activity)
+
+    def test_load_replays_the_log(self):
+        from .journal import load_or_create
+        player, game = load_or_create(self.journal, None)
+        self.assertTrue(self.journal.valid_player(player))
+        self.assertEqual(load_or_create(self.journal, player)[0], player)
+        game = self.play(player, ['restart 3', 'explore 3', 'w'])
+        self.assertEqual(self.journal.generations(player), [0])
+        self.assertEqual(len(self.journal.read_log(player, 0)), 3)
+        loaded = self.journal.load(player)
+        self.assertEqual(loaded.__getstate__(), game.__getstate__())
+        self.assertFalse(loaded.changed)
+
+    def test_idle_events_are_not_logged(self):
+        from .journal import load_or_create
+        player, game = load_or_create(self.journal, None)
+        game.interpret('look')
+        game.events()
+        self.assertEqual(len(game.new_entries), 1)
+
+    def test_compaction(self):
+        from .journal import load_or_create
+        player, game = load_or_create(self.journal, None)
+        game = self.play(player, ['restart 2', 'n', 's'])
+        game = self.play(player, ['explore 2', 'e', 'w'])
+        self.assertEqual(self.journal.generations(player), [0, 1])
+        self.assertEqual(self.journal.read_log(player, 1), [])
+        self.assertEqual(self.journal.load(player).__getstate__(),
+                         game.__getstate__())
+        self.assertEqual(self.journal.check_history(player), [])
+        self.journal.keep_history = False
+        self.play(player, ['explore 5'] * 5)
+        self.assertEqual(self.journal.generations(player), [2])
+
+    def test_interleaved_requests(self):
+        import os
+        from .journal import load_or_create
+        self.journal.keep_history = False
+        player, game = load_or_create(self.journal, None)
+        self.play(player, ['restart 2', 'n', 's'])
+        # two requests load the game ...
+        first = self.journal.load(player)
+        second = self.journal.load(player)
+        first.interpret('explore 2')
+        # ... and the other one saves first, taking a snapshot
+        second.interpret('e')
+        second.interpret('w')
+        second.save()
+        self.assertEqual(self.journal.generations(player), [1])
+        first.save()
+        self.assertEqual(first.generation, 1)
+        self.assertFalse(os.path.exists(self.journal._path(player, '0.log')))
+        self.assertEqual([entry[3] for entry in
+                          self.journal.read_log(player, 1)], ['explore 2'])
+
+    def test_unfinished_line(self):
+        from .journal import parse_log
+        self.assertEqual(parse_log('[1,2,"events"]\n[1,2,"com'),
+                         [[1, 2, 'events']])
+
+    def test_web_app(self):
+        from webob import Request
+        from .benchmark import make_app
+        app = make_app(self.tmpdir, **{'snakemud.journal_dir': self.tmpdir})
+        response = Request.blank('/command', POST={'c': 'restart 2'}
+                                 ).get_response(app)
+        cookie = response.headers['Set-Cookie'].split(';')[0]
+        response = Request.blank('/command', POST={'c': 'level'},
+                                 headers={'Cookie': cookie}
+                                 ).get_response(app)
+        self.assertTrue('level 2' in response.json['response'])
+        self.assertFalse('Set-Cookie' in response.headers)
+
+
+class LiveGamesTests(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        from .benchmark import make_app
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = make_app(self.tmpdir, **{'snakemud.live_games': '2'})
+        self.cookies = {}
+
+    def tearDown(self):
+        import shutil
+        from .live import live_games
+        live_games.clear()
+        live_games.max_size = 0
+        shutil.rmtree(self.tmpdir)
+
+    def command(self, player, command):
+        from webob import Request
+        headers = {}
+        if player in self.cookies:
+            headers['Cookie'] = self.cookies[player]
+        response = Request.blank('/command', POST={'c': command},
+                                 headers=headers).get_response(self.app)
+        if 'Set-Cookie' in response.headers:
+            self.cookies[player] = response.headers['Set-Cookie'].split(';')[0]
+        return response.json['response']
+
+    def saved_level(self, player):
+        from .live import live_games
+        from beaker.session import Session
+        game = live_games._games.values()[0]
+        session = Session({}, id=self.cookies[player].split('=', 1)[1][40:],
+                          use_cookies=False, **game.params)
+        return session['interpreter'].level
+
+    def test_write_behind(self):
+        from .live import live_games
+        self.command('alice', 'restart 2')
+        self.assertEqual(len(live_games), 0)
+        self.command('alice', 'restart 3')
+        self.assertEqual(len(live_games), 1)
+        [game] = live_games._games.values()
+        self.assertFalse(game.lock.locked())
+        self.assertTrue(game.dirty_since is not None)
+        self.assertEqual(self.saved_level('alice'), 2)
+        self.assertTrue('level 3' in self.command('alice', 'level'))
+        live_games.flush()
+        self.assertEqual(game.dirty_since, None)
+        self.assertEqual(self.saved_level('alice'), 3)
+
+    def test_deferred_saves_are_counted(self):
+        from .views import session_writes
+        self.command('alice', 'restart 2')
+        self.command('alice', 'gps')
+        performed, skipped = session_writes.performed, session_writes.skipped
+        self.command('alice', 'map on')
+        self.command('alice', 'gps')
+        self.assertEqual(session_writes.performed, performed + 1)
+        self.assertEqual(session_writes.skipped, skipped + 1)
+
+    def test_eviction(self):
+        from .live import live_games
+        for player in 'abc':
+            self.command(player, 'restart 2')
+            self.command(player, 'restart 3')
+        self.assertEqual(len(live_games), 2)
+        # the least recently used game was written when it was dropped
+        self.assertEqual(self.saved_level('a'), 3)
+        self.assertTrue('level 3' in self.command('a', 'level'))
+
+    def run_server_process(self, flush_interval, sweep_interval=5):
+        """Play alice's game in another process, which keeps it in its live
+        game cache; returns the process and alice's cookie."""
+        import subprocess, sys
+        script = """if 1:
+            import sys, time
+            from webob import Request
+            from snakemud.benchmark import make_app
+            from snakemud.live import live_games
+            live_games.sweep_interval = %r
+            app = make_app(%r, **{'snakemud.live_games': '10',
+                                  'snakemud.live_games_flush_interval': %r})
+            cookie = None
+            for command in 'restart 2', 'restart 3':
+                request = Request.blank('/command', POST={'c': command})
+                if cookie:
+                    request.headers['Cookie'] = cookie
+                response = request.get_response(app)
+                cookie = cookie or response.headers['Set-Cookie'].split(';')[0]
+            print cookie
+            sys.stdout.flush()
+            time.sleep(60)
+        """ % (sweep_interval, self.tmpdir, str(flush_interval))
+        process = subprocess.Popen([sys.executable, '-c', script],
+                                   stdout=subprocess.PIPE)
+        def stop():
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        self.addCleanup(stop)
+        self.cookies['alice'] = process.stdout.readline().strip()
+        return process
+
+    def saved_session_level(self, player):
+        from beaker.session import Session
+        from pyramid_beaker import session_factory_from_settings
+        from .benchmark import make_app
+        params = session_factory_from_settings({
+            'session.type': 'file',
+            'session.data_dir': self.tmpdir + '/data',
+            'session.lock_dir': self.tmpdir + '/lock',
+            'session.secret': 'snakemud-benchmark'})._options
+        session = Session({}, id=self.cookies[player].split('=', 1)[1][40:],
+                          use_cookies=False, **params)
+        return session['interpreter'].level
+
+    def test_sigterm_writes_changes(self):
+        import os, signal
+        process = self.run_server_process(flush_interval=3600)
+        self.assertEqual(self.saved_session_level('alice'), 2)
+        os.kill(process.pid, signal.SIGTERM)
+        self.assertEqual(process.wait(), -signal.SIGTERM)
+        self.assertEqual(self.saved_session_level('alice'), 3)
+
+    def test_changes_are_written_without_requests(self):
+        import time
+        process = self.run_server_process(flush_interval=0,
+                                          sweep_interval=0.05)
+        for n in range(50):
+            if self.saved_session_level('alice') == 3:
+                break
+            time.sleep(0.1)
+        self.assertEqual(self.saved_session_level('alice'), 3)
+
+    def test_flush_gives_up_on_games_in_use(self):
+        from .live import LiveGames
+        games = LiveGames()
+        games.max_size = 10
+        game = games.acquire('0' * 32, {})
+        # locked by a request that never finishes
+        game.dirty_since = 0
+        games.flush(timeout=0.05)
+        self.assertEqual(game.dirty_since, 0)
+
+    def test_session_id(self):
+        from .live import session_id
+        request = dummy_request({})
+        self.assertEqual(session_id(request), None)
+
+
+class FrameTests(unittest.TestCase):
+
+    def test_diff_rows(self):
+        from .frames import diff_rows, apply_diff
+        base = ['# # # # # # # # # #', '# . . . @ * * . . #',
+                '# . . . . . . . . #', '# # # # # # # # # #']
+        rows = ['# # # # # # # # # #', '# # # # # # # # # #',
+                '# . . . . @ * * . #', '# . . . . . . . . #', 'new row']
+        parts = diff_rows(base, rows)
+        self.assertEqual(parts, [[0, 1], [0, 1], [1, 8, '. @ * *', 4],
+                                 [2, 1], 'new row'])
+        self.assertEqual(apply_diff(base, parts), rows)
+        self.assertEqual(diff_rows([], rows), rows)
+
+    def test_command_sends_changes(self):
+        from .benchmark import CountingSession
+        from .frames import apply_diff
+        from .views import command
+        interpreter = make_interpreter_on(["#########",
+                                           "#.......#",
+                                           "#.......#",
+                                           "#########"], (3, 1))
+        interpreter.interpret('map on')
+        session = CountingSession(interpreter=interpreter)
+        result = command(dummy_request(session, c='gps', f=''))
+        self.assertFalse('frame' in result)
+        result = command(dummy_request(session, c='look', f=''))
+        frame = result['frame']
+        self.assertEqual(frame['base'], None)
+        self.assertTrue(result['response'].endswith('\n\n'))
+        self.assertEqual(result['response'] + '\n'.join(frame['rows']),
+                         interpreter.interpret('look'))
+        result = command(dummy_request(session, c='look', f=frame['id']))
+        self.assertEqual(result['frame']['base'], frame['id'])
+        self.assertEqual(result['frame']['rows'], [[0, len(frame['rows'])]])
+        self.assertEqual(apply_diff(frame['rows'], result['frame']['rows']),
+                         frame['rows'])
+        result = command(dummy_request(session, c='look'))
+        self.assertFalse('frame' in result)
+        self.assertEqual(result['response'], interpreter.interpret('look'))
+
+    def test_whole_frame(self):
+        from pyramid.httpexceptions import HTTPNotFound
+        from .frames import frame_update
+        from .views import show_frame
+        frame = frame_update('# @ #\n# . #', None)
+        request = testing.DummyRequest(params={'id': frame['id']})
+        self.assertEqual(show_frame(request),
+                         {'id': frame['id'], 'rows': ['# @ #', '# . #']})
+        request = testing.DummyRequest(params={'id': 'forgotten'})
+        self.assertRaises(HTTPNotFound, show_frame, request)
+
+    def test_frame_must_end_the_output(self):
+        from .views import run_commands
+
+        class Interpreter(object):
+            frame = '# @ #'
+
+            def events(self):
+                return None
+
+            def verb(self, command):
+                return command
+
+            def interpret(self, command):
+                return 'The picture came first:\n\n# @ #\n\nand then this.'
+
+        result = run_commands(Interpreter(), ['look'], '')
+        self.assertFalse('frame' in result)
+        self.assertEqual(result['responses'],
+                         ['The picture came first:\n\n# @ #\n\n'
+                          'and then this.'])
+
+
+class WebSocketTests(unittest.TestCase):
+
+    def test_accept_key(self):
+        from .websocket import accept_key
+        # the example from RFC 6455
+        self.assertEqual(accept_key('dGhlIHNhbXBsZSBub25jZQ=='),
+                         's3pPLMBiTxaQ9kYGzzhZRbK+xOo=')
+
+    def test_frames(self):
+        from .websocket import decode_frame, encode_frame, ProtocolError
+        self.assertEqual(encode_frame(1, 'hi'), '\x81\x02hi')
+        self.assertEqual(len(encode_frame(1, 'x' * 300)), 304)
+        masked = '\x81\x82\x01\x02\x03\x04' + chr(ord('h') ^ 1) + chr(
+            ord('i') ^ 2)
+        self.assertEqual(decode_frame(masked + 'more', 100),
+                         (True, 1, 'hi', 8))
+        self.assertEqual(decode_frame(masked[:5], 100), None)
+        self.assertRaises(ProtocolError, decode_frame, '\x81\x02hi', 100)
+        self.assertRaises(ProtocolError, decode_frame, masked, 1)
+
+
+class WebSocketServerTests(unittest.TestCase):
+
+    def setUp(self):
+        import os, shutil, tempfile
+        from webob import Request
+        from .benchmark import make_app
+        from .websocket import WebSocketServer
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.settings = {'session.type': 'file',
+                         'session.data_dir': os.path.join(tmpdir, 'data'),
+                         'session.lock_dir': os.path.join(tmpdir, 'lock'),
+                         'session.key': 'snakemud-benchmark',
+                         'session.secret': 'snakemud-benchmark',
+                         'snakemud.live_games': '10'}
+        self.app = make_app(tmpdir, **self.settings)
+        self.cookies = {}
+        for player in 'alice', 'bob':
+            response = Request.blank('/command', POST={'c': 'restart 2'}
+                                     ).get_response(self.app)
+            self.cookies[player] = response.headers['Set-Cookie'].split(
+                ';')[0]
+        server = WebSocketServer(self.settings, '127.0.0.1', 0)
+        thread = server.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.stop)
+        self.port = server.socket.getsockname()[1]
+
+    def tearDown(self):
+        from .live import live_games
+        live_games.clear()
+        live_games.max_size = 0
+
+    def handshake(self, cookie):
+        import socket
+        s = socket.create_connection(('127.0.0.1', self.port))
+        s.settimeout(5)
+        s.sendall('GET / HTTP/1.1\r\n'
+                  'Host: localhost:%d\r\n'
+                  'Upgrade: websocket\r\n'
+                  'Connection: Upgrade\r\n'
+                  'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+                  'Sec-WebSocket-Version: 13\r\n'
+                  'Cookie: %s\r\n\r\n' % (self.port, cookie))
+        data = ''
+        while '\r\n\r\n' not in data:
+            data += s.recv(1000)
+        self.addCleanup(s.close)
+        return s, data.split('\r\n')[0]
+
+    def send(self, s, message):
+        import json, struct
+        payload = json.dumps(message)
+        mask = '\x00\x00\x00\x00'
+        s.sendall(struct.pack('!BBH', 0x81, 0x80 | 126, len(payload)) +
+                  mask + payload)
+
+    def receive(self, s):
+        import json, struct
+        data = s.recv(4)
+        n = ord(data[1]) & 0x7f
+        if n == 126:
+            n, = struct.unpack('!H', data[2:4])
+            data = ''
+        else:
+            data = data[2:]
+        while len(data) < n:
+            data += s.recv(n - len(data))
+        return json.loads(data)
+
+    def test_connection(self):
+        from webob import Request
+        s, status = self.handshake('nobody=here')
+        self.assertEqual(status, 'HTTP/1.1 403 Forbidden')
+        s, status = self.handshake(self.cookies['alice'])
+        self.assertEqual(status, 'HTTP/1.1 101 Switching Protocols')
+        self.send(s, {'c': ['level', 'map on']})
+        result = self.receive(s)
+        self.assertEqual(result['responses'],
+                         ["You're playing level 2.", 'Automap enabled.'])
+        self.assertTrue(result['command_list'])
+        # HTTP requests play the same game
+        response = Request.blank(
+            '/command', POST={'c': 'look'},
+            headers={'Cookie': self.cookies['alice']}).get_response(self.app)
+        self.assertTrue('[[;#a84;]' in response.json['response'])
+        # goodbye
+        s.sendall('\x88\x82\x00\x00\x00\x00\x03\xe8')
+        self.assertEqual(s.recv(4), '\x88\x02\x03\xe8')
+
+    def test_busy_game_does_not_hold_up_others(self):
+        from .live import live_games, parse_session_cookie
+        sid = parse_session_cookie(
+            {'key': 'snakemud-benchmark', 'secret': 'snakemud-benchmark'},
+            self.cookies['alice'])
+        # an HTTP request of alice's is taking its time
+        game = live_games.acquire(sid, {})
+        alice, status = self.handshake(self.cookies['alice'])
+        self.send(alice, {'c': 'level'})
+        bob, status = self.handshake(self.cookies['bob'])
+        self.send(bob, {'c': 'level'})
+        self.assertEqual(self.receive(bob)['responses'],
+                         ["You're playing level 2."])
+        live_games.release(game)
+        self.assertEqual(self.receive(alice)['responses'],
+                         ["You're playing level 2."])
+
+    def test_refused_without_live_game_cache(self):
+        from .live import live_games
+        live_games.max_size = 0
+        s, status = self.handshake(self.cookies['alice'])
+        self.assertEqual(status, 'HTTP/1.1 503 Service Unavailable')
+
+
+class TelnetTests(unittest.TestCase):
+
+    def test_strip_telnet(self):
+        from .telnet import strip_telnet
+        self.assertEqual(strip_telnet('look\r\n'), ('look\r\n', ''))
+        self.assertEqual(strip_telnet('\xff\xfb\x1flo\xff\xffok'),
+                         ('lo\xffok', ''))
+        self.assertEqual(strip_telnet('\xff\xfa\x18\x00xterm\xff\xf0n\n'),
+                         ('n\n', ''))
+        self.assertEqual(strip_telnet('n\xff\xfd'), ('n', '\xff\xfd'))
+
+    def test_server(self):
+        import socket, time
+        from .telnet import TelnetServer, read_until_prompt
+        server = TelnetServer('127.0.0.1', 0)
+        server.pack_after = 0
+        thread = server.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.stop)
+        port = server.socket.getsockname()[1]
+        s = socket.create_connection(('127.0.0.1', port))
+        self.addCleanup(s.close)
+        greeting = read_until_prompt(s, 5)
+        self.assertTrue("Type 'help'" in greeting)
+        # the idle game gets packed away
+        for n in range(50):
+            player, = server.players
+            if player.state is not None:
+                break
+            time.sleep(0.1)
+        self.assertTrue(player.state is not None)
+        s.sendall('\xff\xfb\x1flook\r\n')
+        response = read_until_prompt(s, 5)
+        self.assertTrue('\x1b[38;5;63mnorth\x1b[0m' in response)
+        self.assertTrue('\r\n' in response)
+        self.assertFalse('[[;' in response)
+        s.sendall('quit\r\n')
+        self.assertEqual(s.recv(100), 'Bye!\r\n')
+        self.assertEqual(s.recv(100), '')
+
+
+class MarkupTests(unittest.TestCase):
+
+    def test_serializers(self):
+        from .markup import ansi, colored, markup, plain, xterm_color
+        text = 'a ' + colored('#66f', 'north') + ' exit'
+        self.assertEqual(markup(text), 'a [[;#66f;]north] exit')
+        self.assertEqual(plain(text), 'a north exit')
+        self.assertEqual(ansi(text), 'a \x1b[38;5;63mnorth\x1b[0m exit')
+        self.assertEqual(len(text), len('a north exit'))
+        self.assertEqual(markup('[[x]'), '[[x]')
+        self.assertEqual(xterm_color('#a84'), 137)
+        self.assertEqual(xterm_color('#000000'), 16)
+
+    def test_lines(self):
+        from .markup import Text, colored, join, markup
+        text = join('\n', [colored('#a84', '@') + ' ', 'ab  ', '', 'c\n'])
+        self.assertEqual([markup(l.rstrip()) for l in text.splitlines()],
+                         ['[[;#a84;]@]', 'ab', '', 'c'])
+        self.assertEqual(Text.build(['a', 'b', ('#a84', '@'), 'c']).spans,
+                         ((None, 'ab'), ('#a84', '@'), (None, 'c')))
+
+    def test_plain_is_markup_without_colors(self):
+        import pickle, random, re
+        from .interpreter import Interpreter
+        from .markup import plain
+        interpreter = Interpreter()
+        interpreter.interpret('map on')
+        interpreter.interpret('draw on')
+        for command in 'look', 'e', 'n', 'w', 'explore 5':
+            copy = pickle.loads(pickle.dumps(interpreter))
+            interpreter.rng = random.Random(42)
+            copy.rng = random.Random(42)
+            output = interpreter.interpret(command)
+            self.assertEqual(re.sub(r'\[\[[^]]*]([^]]*)]', r'\1', output),
+                             plain(copy.interpret_text(command)))
+        self.assertTrue('[[;#a84;]@]' in interpreter.interpret('look'))
@@ -1,41 +1,406 @@
+import logging
+import threading
+import time
+
+from pyramid.httpexceptions import HTTPBadRequest, HTTPForbidden, HTTPNotFound
+from pyramid.response import Response
+from pyramid.settings import asbool
 from pyramid.view import view_config
 
 from .interpreter import Interpreter
+from .journal import Journal, Game, load_or_create
+from .live import live_games, session_id, session_params
+from .frames import frame_update, frames
+from . import metrics
+
+
+log = logging.getLogger(__name__)
+
+
+class SessionWriteCounter(object):
+    """Counts session saves performed and skipped because nothing changed."""
+
+    log_every = 1000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.performed = 0
+        self.skipped = 0
+
+    def count(self, saved):
+        with self.lock:
+            if saved:
+                self.performed += 1
+            else:
+                self.skipped += 1
+            total = self.performed + self.skipped
+            performed, skipped = self.performed, self.skipped
+        if total % self.log_every == 0:
+            log.info('session saves: %d performed, %d skipped',
+                     performed, skipped)
+
+
+session_writes = SessionWriteCounter()
+
+
+class Waiters(object):
+    """Counts the /events requests waiting for an event.
+
+    Each of them holds one of the server's few threads, so only so many
+    may wait at once.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def enter(self, limit):
+        """Count one more, unless there are limit already."""
+        with self.lock:
+            if self.count >= limit:
+                return False
+            self.count += 1
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.count -= 1
+
+
+waiters = Waiters()
 
 
 def get_interpreter(request):
+    with metrics.session_load_seconds.time():
+        journal = get_journal(request)
+        if journal is not None:
+            return load_game(request, journal)
+        game = acquire_live_game(request)
+        if game is not None and game.interpreter is not None:
+            return game.interpreter
+        interpreter = load_interpreter(request)
+        if game is not None:
+            game.interpreter = interpreter
+        return interpreter
+
+
+def load_interpreter(request):
     try:
         return request.session['interpreter']
     except KeyError:
-        request.session['interpreter'] = Interpreter()
-        request.session.save()
+        request.session['interpreter'] = Interpreter(
+            shared_world=shared_world(request))
         return request.session['interpreter']
 
 
+def acquire_live_game(request):
+    """Return the player's game in the live game cache, if it's on.
+
+    The game is locked until the request is finished, or until
+    release_live_game() is called.
+    """
+    if not live_games.enabled:
+        return None
+    game = request.environ.get('snakemud.live_game')
+    if game is not None:
+        return game
+    sid = session_id(request)
+    if sid is None:
+        # a new player; their game is cached from the next request on
+        return None
+    game = live_games.acquire(sid, session_params(request))
+    metrics.live_game_lookups.inc('miss' if game.interpreter is None
+                                  else 'hit')
+    request.environ['snakemud.live_game'] = game
+    request.add_finished_callback(release_live_game)
+    return game
+
+
+def release_live_game(request):
+    """Let other requests of the player use the cached game."""
+    game = request.environ.pop('snakemud.live_game', None)
+    if game is not None:
+        live_games.release(game)
+
+
+def reload_interpreter(request):
+    """Get the interpreter again, in case another request changed it."""
+    release_live_game(request)
+    game = acquire_live_game(request)
+    if game is None or game.interpreter is None:
+        request.session.load()
+    return get_interpreter(request)
+
+
+def shared_world(request):
+    """Do new players share levels with other players' snakes?"""
+    settings = request.registry.settings or {}
+    return asbool(settings.get('snakemud.shared_world', False))
+
+
+def get_journal(request):
+    """Return the Journal of players' games, if they're kept in one.
+
+    That's if the snakemud.journal_dir setting is set; otherwise the whole
+    game is saved in the session after every change.
+    """
+    settings = request.registry.settings or {}
+    directory = settings.get('snakemud.journal_dir')
+    if not directory:
+        return None
+    snapshot_every = settings.get('snakemud.journal_snapshot_every')
+    return Journal(directory,
+                   snapshot_every=(int(snapshot_every) if snapshot_every
+                                   else None),
+                   keep_history=asbool(settings.get(
+                       'snakemud.journal_keep_history', False)))
+
+
+def load_game(request, journal):
+    """Load the player's game from the journal.
+
+    The session only remembers who the player is.
+    """
+    player, game = load_or_create(journal, request.session.get('player'))
+    if request.session.get('player') != player:
+        request.session['player'] = player
+        request.session.save()
+    return game
+
+
+def save_interpreter(request, interpreter):
+    """Save the session if the interpreter's state has changed."""
+    if isinstance(interpreter, Game):
+        changed = interpreter.save()
+        session_writes.count(changed)
+        metrics.session_saves.inc('logged' if changed else 'skipped')
+        return
+    game = request.environ.get('snakemud.live_game')
+    if game is not None and game.interpreter is interpreter:
+        # written to the session store later
+        changed = interpreter.changed
+        if changed:
+            live_games.changed(game)
+            interpreter.mark_saved()
+        session_writes.count(changed)
+        metrics.session_saves.inc('deferred' if changed else 'skipped')
+        return
+    changed = interpreter.changed
+    if changed:
+        request.session.save()
+        interpreter.mark_saved()
+    session_writes.count(changed)
+    metrics.session_saves.inc('saved' if changed else 'skipped')
+
+
+def command_list_update(request, interpreter):
+    """Response fields for the command list, if the client's is out of date.
+
+    Clients send the version of the command list they have as ?v=.
+    """
+    return command_list_fields(interpreter, request.params.get('v'))
+
+
+def command_list_fields(interpreter, client_version):
+    version = interpreter.command_list_version
+    if client_version == version:
+        return {}
+    return {'command_list': interpreter.command_list,
+            'command_list_version': version}
+
+
+def events_max_wait(request):
+    """How long /events may hold a connection open, in seconds."""
+    settings = request.registry.settings or {}
+    return float(settings.get('snakemud.events_max_wait', 10))
+
+
+def events_max_waiters(request):
+    """How many /events requests may be waiting at once."""
+    settings = request.registry.settings or {}
+    return int(settings.get('snakemud.events_max_waiters', 2))
+
+
 @view_config(route_name='home', renderer='snakemud:templates/index.mako')
 def index(request):
     interpreter = get_interpreter(request)
+    save_interpreter(request, interpreter)
     return dict(greeting=interpreter.greeting,
-                command_list=interpreter.command_list)
+                command_list=interpreter.command_list,
+                command_list_version=interpreter.command_list_version,
+                next_event_in=interpreter.next_event_in(),
+                events_max_wait=events_max_wait(request),
+                websocket_port=websocket_port(request))
+
+
+def websocket_port(request):
+    """The port of the WebSocket server, or None if there isn't one."""
+    settings = request.registry.settings or {}
+    port = settings.get('snakemud.websocket_port')
+    # the same conditions under which websocket.start_server() refuses
+    if (not port or settings.get('snakemud.journal_dir')
+            or not live_games.enabled):
+        return None
+    return int(port)
+
+
+def requested_commands(request):
+    """Return the list of commands in a /command request.
+
+    Commands come as one or more c parameters, or as a JSON list in the
+    request body; any of them may hold several commands separated by
+    semicolons.
+
+    Raises HTTPBadRequest if the body isn't JSON or there are more than
+    max_commands commands.
+    """
+    try:
+        if request.content_type == 'application/json':
+            commands = request.json_body
+            if not isinstance(commands, list):
+                commands = [commands]
+        else:
+            commands = request.params.getall('c')
+        return split_commands(commands)
+    except ValueError as e:
+        raise HTTPBadRequest(str(e))
+
+
+# most commands a request may run
+max_commands = 100
+
+
+def split_commands(commands):
+    """Split up commands separated by semicolons.
+
+    Raises ValueError if there are more than max_commands of them.
+    """
+    result = []
+    for command in commands:
+        result.extend(unicode(command).split(';'))
+        if len(result) > max_commands:
+            raise ValueError('more than %d commands' % max_commands)
+    return result or ['']
 
 
 @view_config(route_name='api_command', renderer='json')
 def command(request):
+    """Run one or more commands.
+
+    The response has the output of each command in 'responses', and all
+    of them joined together (preceded by any pending event) in 'response'.
+
+    Clients that can patch the automap/autodraw picture they showed last
+    send its id as ?f= (empty if they have none).  The picture at the end
+    of the last command's output is then left out of the responses and
+    sent as changes in 'frame' (see snakemud.frames).
+    """
+    commands = requested_commands(request)
     interpreter = get_interpreter(request)
-    command = request.params.get('c')
+    result = run_commands(interpreter, commands, request.params.get('f'))
+    save_interpreter(request, interpreter)
+    result['next_event_in'] = interpreter.next_event_in()
+    result.update(command_list_update(request, interpreter))
+    return result
+
+
+def run_commands(interpreter, commands, frame_base=None):
+    """Run commands, returning the 'response', 'responses' and 'frame'
+    fields of the command() response.
+
+    frame_base is the id of the client's last frame, or None if the client
+    can't patch frames.
+    """
     events = interpreter.events()
-    response = interpreter.interpret(command)
+    responses = []
+    for command in commands:
+        with metrics.command_seconds.time(interpreter.verb(command)):
+            responses.append(interpreter.interpret(command))
+    frame = interpreter.frame
+    if (frame and frame_base is not None and responses and
+            responses[-1].endswith(frame)):
+        responses[-1] = responses[-1][:-len(frame)]
+    else:
+        frame = None
+    response = '\n\n'.join(responses)
     if events:
         response = events + '\n\n' + response
-    request.session.save() # interpreter may have changed its state
-    return {'response': response,
-            'command_list': interpreter.command_list}
+    result = {'response': response,
+              'responses': responses}
+    if frame is not None:
+        result['frame'] = frame_update(frame, frame_base)
+    return result
 
 @view_config(route_name='api_events', renderer='json')
 def events(request):
+    """Long-poll for game events.
+
+    If an event is due within ?wait=N seconds (capped by the
+    snakemud.events_max_wait setting), hold the request until it happens.
+    The response says when the next event is due (null if nothing will
+    happen until the player does something), so the client knows when to
+    come back.
+
+    Only snakemud.events_max_waiters requests wait at once, so waiting
+    players can't take all of the server's threads; the others return
+    right away, with busy set, and the client comes back when the event
+    is due.
+    """
+    metrics.events_requests.inc()
     interpreter = get_interpreter(request)
+    try:
+        wait = float(request.params.get('wait', 0))
+    except ValueError:
+        wait = 0
+    wait = min(wait, events_max_wait(request))
+    delay = interpreter.next_event_in()
+    busy = False
+    if delay and delay <= wait:
+        if waiters.enter(events_max_waiters(request)):
+            metrics.events_waits.inc()
+            # don't keep the player's commands waiting meanwhile
+            release_live_game(request)
+            try:
+                time.sleep(delay + 0.1)
+            finally:
+                waiters.leave()
+            # the player may have typed something while we were asleep
+            interpreter = reload_interpreter(request)
+        else:
+            metrics.events_busy.inc()
+            busy = True
     events = interpreter.events()
-    request.session.save() # interpreter may have changed its state
-    return {'response': events,
-            'command_list': interpreter.command_list}
+    save_interpreter(request, interpreter)
+    result = {'response': events,
+              'next_event_in': interpreter.next_event_in()}
+    if busy:
+        result['busy'] = True
+    result.update(command_list_update(request, interpreter))
+    return result
+
+
+@view_config(route_name='api_frame', renderer='json')
+def show_frame(request):
+    """Return a recently sent frame whole, as {'id': ..., 'rows': [...]}.
+
+    For clients that got changes to a frame they don't have, because the
+    responses to two of their requests crossed.
+    """
+    id = request.params.get('id', '')
+    rows = frames.get(id)
+    if rows is None:
+        raise HTTPNotFound()
+    return {'id': id, 'rows': rows}
+
+
+def show_metrics(request):
+    """Show the metrics (registered as /metrics by main, if enabled).
 
+    Only to the addresses in the snakemud.metrics_from setting.
+    """
+    if request.remote_addr not in request.registry.settings[
+            'snakemud.metrics_from']:
+        raise HTTPForbidden()
+    return Response(metrics.registry.render(),
+                    content_type=metrics.registry.content_type,
+                    charset='utf-8')
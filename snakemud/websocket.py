@@ -0,0 +1,589 @@
+"""A WebSocket channel for the browser terminal.
+
+With snakemud.websocket_port set, the app serves WebSocket connections on
+that port from a thread of its own, next to the HTTP server.  Over a
+connection the browser sends commands as JSON messages, {"c": [...],
+"v": ..., "f": ...} with the same meaning as the parameters of /command,
+and gets back the same responses as /command gives.  Events are sent as
+they happen, as {"response": ..., "event": true}, so there's no need to
+poll /events.
+
+The connection uses the player's game in the live game cache (see
+snakemud.live), so the player can use HTTP and WebSockets at the same
+time, and the game is written to the session store the way the cache
+does it, and when they disconnect.  Without the cache there's no
+WebSocket server: the two would keep separate copies of the game.
+
+A single thread looks after all the connections, so it never waits for
+a game: the game work (taking the game's lock, loading it, running
+commands, looking for events, writing it) is done by a pool of worker
+threads, which hand back what to send.
+
+The player is identified by their session cookie; the connection is
+refused if they have none (they get one by loading the page first) or if
+it comes from a page on another host.
+"""
+import asyncore
+import base64
+import collections
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import Queue
+import socket
+import struct
+import threading
+import time
+import urlparse
+
+from beaker.session import Session
+from pyramid.settings import asbool
+from pyramid_beaker import session_factory_from_settings
+
+from snakemud.interpreter import Interpreter
+from snakemud.live import live_games, parse_session_cookie
+from snakemud.views import command_list_fields, run_commands, split_commands
+
+
+log = logging.getLogger(__name__)
+
+GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+(CONTINUATION, TEXT, BINARY, CLOSE, PING, PONG) = (0, 1, 2, 8, 9, 10)
+
+# close status codes
+NORMAL, PROTOCOL_ERROR, UNSUPPORTED, TOO_BIG = 1000, 1002, 1003, 1009
+INTERNAL_ERROR = 1011
+
+
+class ProtocolError(Exception):
+
+    def __init__(self, message, status=PROTOCOL_ERROR):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+def accept_key(key):
+    """The Sec-WebSocket-Accept for a Sec-WebSocket-Key."""
+    return base64.b64encode(hashlib.sha1(key + GUID).digest())
+
+
+def parse_request(data):
+    """Parse an HTTP request head into (method, path, headers).
+
+    Header names are lowercased.
+    """
+    lines = data.split('\r\n')
+    try:
+        method, path, version = lines[0].split()
+    except ValueError:
+        raise ProtocolError('bad request line')
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, colon, value = line.partition(':')
+        if not colon:
+            raise ProtocolError('bad header')
+        headers[name.strip().lower()] = value.strip()
+    return method, path, headers
+
+
+def encode_frame(opcode, payload=''):
+    """Make an unmasked (server to client) frame."""
+    if isinstance(payload, unicode):
+        payload = payload.encode('utf-8')
+    n = len(payload)
+    if n < 126:
+        header = struct.pack('!BB', 0x80 | opcode, n)
+    elif n < 0x10000:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, n)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, n)
+    return header + payload
+
+
+def decode_frame(data, max_size):
+    """Parse a (client to server, so masked) frame at the start of data.
+
+    Returns (fin, opcode, payload, frame length), or None if data doesn't
+    have the whole frame yet.
+    """
+    if len(data) < 2:
+        return None
+    b0, b1 = struct.unpack_from('!BB', data)
+    fin, opcode = bool(b0 & 0x80), b0 & 0x0f
+    if not b1 & 0x80:
+        raise ProtocolError('client frames must be masked')
+    n = b1 & 0x7f
+    offset = 2
+    if n == 126:
+        if len(data) < 4:
+            return None
+        n, = struct.unpack_from('!H', data, 2)
+        offset = 4
+    elif n == 127:
+        if len(data) < 10:
+            return None
+        n, = struct.unpack_from('!Q', data, 2)
+        offset = 10
+    if n > max_size:
+        raise ProtocolError('message too big', TOO_BIG)
+    if len(data) < offset + 4 + n:
+        return None
+    mask = bytearray(data[offset:offset + 4])
+    payload = bytearray(data[offset + 4:offset + 4 + n])
+    for i in xrange(n):
+        payload[i] ^= mask[i & 3]
+    return fin, opcode, str(payload), offset + 4 + n
+
+
+def load_interpreter(game, shared_world=False):
+    """Load a LiveGame's interpreter from the session store."""
+    session = Session({}, id=game.session_id, use_cookies=False,
+                      **game.params)
+    interpreter = session.get('interpreter')
+    if interpreter is None:
+        interpreter = Interpreter(shared_world=shared_world)
+        game.dirty_since = time.time()
+    return interpreter
+
+
+class Connection(asyncore.dispatcher):
+    """A player's WebSocket connection."""
+
+    max_request = 8192
+    max_message = 65536
+    # most messages waiting for the game
+    max_pending = 16
+
+    def __init__(self, sock, server):
+        asyncore.dispatcher.__init__(self, sock, map=server.map)
+        self.server = server
+        self.in_buffer = ''
+        self.out_buffer = ''
+        self.open = False
+        self.closing = False
+        self.fragments = None
+        self.session_id = None
+        # commands waiting for the game
+        self.pending = []
+        # a worker is doing something with the game
+        self.busy = False
+        self.next_event_at = None
+        # the game has been written after the player left
+        self.left = False
+
+    # asyncore
+
+    def readable(self):
+        return not self.closing
+
+    def writable(self):
+        return bool(self.out_buffer)
+
+    def handle_read(self):
+        try:
+            data = self.recv(8192)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        if not data:
+            return
+        self.in_buffer += data
+        try:
+            if not self.open:
+                self.handshake()
+            if self.open:
+                self.read_frames()
+        except ProtocolError as e:
+            log.debug('websocket protocol error: %s', e)
+            if self.open:
+                self.close_with(e.status)
+            else:
+                self.reject('400 Bad Request')
+
+    def handle_write(self):
+        sent = self.send(self.out_buffer)
+        self.out_buffer = self.out_buffer[sent:]
+        if self.closing and not self.out_buffer:
+            self.close()
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        log.exception('websocket connection error')
+        self.close()
+
+    def close(self):
+        if self.open:
+            self.open = False
+            self.server.connections.discard(self)
+            self.next_job()
+        asyncore.dispatcher.close(self)
+
+    # the protocol
+
+    def write(self, data):
+        self.out_buffer += data
+
+    def reject(self, status):
+        self.write('HTTP/1.1 %s\r\nContent-Length: 0\r\n'
+                   'Connection: close\r\n\r\n' % status)
+        self.closing = True
+
+    def handshake(self):
+        head, sep, rest = self.in_buffer.partition('\r\n\r\n')
+        if not sep:
+            if len(self.in_buffer) > self.max_request:
+                raise ProtocolError('request too big')
+            return
+        self.in_buffer = rest
+        method, path, headers = parse_request(head)
+        if (method != 'GET' or
+                headers.get('upgrade', '').lower() != 'websocket' or
+                'sec-websocket-key' not in headers):
+            raise ProtocolError('not a websocket request')
+        if headers.get('sec-websocket-version') != '13':
+            self.write('HTTP/1.1 426 Upgrade Required\r\n'
+                       'Sec-WebSocket-Version: 13\r\n'
+                       'Content-Length: 0\r\n\r\n')
+            self.closing = True
+            return
+        origin = headers.get('origin')
+        host = headers.get('host', '').rpartition(':')[0] or headers.get(
+            'host')
+        if origin and urlparse.urlparse(origin).hostname != host:
+            self.reject('403 Forbidden')
+            return
+        self.session_id = parse_session_cookie(self.server.session_params,
+                                               headers.get('cookie', ''))
+        if self.session_id is None:
+            self.reject('403 Forbidden')
+            return
+        if not live_games.enabled:
+            self.reject('503 Service Unavailable')
+            return
+        self.write('HTTP/1.1 101 Switching Protocols\r\n'
+                   'Upgrade: websocket\r\n'
+                   'Connection: Upgrade\r\n'
+                   'Sec-WebSocket-Accept: %s\r\n\r\n'
+                   % accept_key(headers['sec-websocket-key']))
+        self.open = True
+        self.server.connections.add(self)
+        # load the game and see when its events are due
+        self.next_event_at = 0
+        self.next_job()
+
+    def read_frames(self):
+        while self.open:
+            frame = decode_frame(self.in_buffer, self.max_message)
+            if frame is None:
+                return
+            fin, opcode, payload, length = frame
+            self.in_buffer = self.in_buffer[length:]
+            if opcode == CLOSE:
+                self.close_with(NORMAL)
+            elif opcode == PING:
+                self.write(encode_frame(PONG, payload))
+            elif opcode == PONG:
+                pass
+            elif opcode in (TEXT, CONTINUATION):
+                if opcode == TEXT:
+                    self.fragments = []
+                elif self.fragments is None:
+                    raise ProtocolError('unexpected continuation frame')
+                self.fragments.append(payload)
+                if sum(map(len, self.fragments)) > self.max_message:
+                    raise ProtocolError('message too big', TOO_BIG)
+                if fin:
+                    message = ''.join(self.fragments)
+                    self.fragments = None
+                    self.handle_message(message)
+            else:
+                raise ProtocolError('only text messages, please',
+                                    UNSUPPORTED)
+
+    def close_with(self, status):
+        self.write(encode_frame(CLOSE, struct.pack('!H', status)))
+        self.server.connections.discard(self)
+        self.open = False
+        self.closing = True
+        self.next_job()
+
+    def send_json(self, data):
+        self.write(encode_frame(TEXT, json.dumps(data)))
+
+    # the game
+
+    def next_job(self):
+        """Give the pool the next thing to do with the game, if it isn't
+        busy with one already.
+
+        Commands go first; then the last write when the player has left;
+        then a look for events when they're due.
+        """
+        if self.busy:
+            return
+        if self.pending:
+            job, args = self.play, (self.pending.pop(0), )
+        elif not self.open:
+            if self.session_id is None or self.left:
+                return
+            self.left = True
+            job, args = self.write_game, ()
+        elif (self.next_event_at is not None and
+                time.time() >= self.next_event_at):
+            job, args = self.poll_events, ()
+        else:
+            return
+        self.busy = True
+        self.server.submit(self, job, *args)
+
+    def done(self, result, failed):
+        """Called in the loop with what a job returned."""
+        self.busy = False
+        if failed:
+            if self.open:
+                self.close_with(INTERNAL_ERROR)
+        elif result is not None and self.open:
+            message, next_event_in = result
+            if message is not None:
+                self.send_json(message)
+            # the game may also get news some other way (other players,
+            # the player's HTTP requests), so check every so often anyway
+            wait = self.server.event_check_interval
+            if next_event_in is not None:
+                wait = min(wait, next_event_in)
+            self.next_event_at = time.time() + wait
+        self.next_job()
+
+    def tick(self, now):
+        self.next_job()
+
+    def handle_message(self, message):
+        try:
+            data = json.loads(message)
+        except ValueError:
+            raise ProtocolError('bad JSON')
+        if not isinstance(data, dict):
+            raise ProtocolError('bad message')
+        if len(self.pending) >= self.max_pending:
+            raise ProtocolError('too many messages waiting')
+        commands = data.get('c', '')
+        if not isinstance(commands, list):
+            commands = [commands]
+        try:
+            data['c'] = split_commands(commands)
+        except ValueError as e:
+            raise ProtocolError(str(e), TOO_BIG)
+        self.pending.append(data)
+        self.next_job()
+
+    # these run in the worker threads
+
+    def acquire(self):
+        """Return the player's LiveGame, locked and loaded."""
+        game = live_games.acquire(self.session_id, self.server.session_params)
+        if game.interpreter is None:
+            try:
+                game.interpreter = load_interpreter(
+                    game, self.server.shared_world)
+            except Exception:
+                live_games.release(game)
+                raise
+        return game
+
+    def release(self, game):
+        interpreter = game.interpreter
+        if interpreter is not None and interpreter.changed:
+            live_games.changed(game)
+            interpreter.mark_saved()
+        live_games.release(game)
+
+    def play(self, data):
+        game = self.acquire()
+        try:
+            interpreter = game.interpreter
+            result = run_commands(interpreter, data['c'], data.get('f'))
+            result['next_event_in'] = interpreter.next_event_in()
+            result.update(command_list_fields(interpreter, data.get('v')))
+        finally:
+            self.release(game)
+        return result, result['next_event_in']
+
+    def poll_events(self):
+        game = self.acquire()
+        try:
+            interpreter = game.interpreter
+            message = None
+            if interpreter.next_event_in() == 0:
+                events = interpreter.events()
+                if events:
+                    message = {'response': events, 'event': True,
+                               'next_event_in': interpreter.next_event_in()}
+            return message, interpreter.next_event_in()
+        finally:
+            self.release(game)
+
+    def write_game(self):
+        """Write the game to the session store, as the player has left."""
+        game = live_games.acquire(self.session_id, self.server.session_params)
+        try:
+            game.write()
+        finally:
+            live_games.release(game)
+
+
+class Waker(asyncore.file_dispatcher):
+    """Wakes the loop up when the workers have results for it."""
+
+    def __init__(self, map):
+        r, self.write_fd = os.pipe()
+        fcntl.fcntl(self.write_fd, fcntl.F_SETFL, os.O_NONBLOCK)
+        asyncore.file_dispatcher.__init__(self, r, map=map)
+        os.close(r)
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(8192)
+        except (OSError, socket.error):
+            pass
+
+    def wake(self):
+        try:
+            os.write(self.write_fd, 'x')
+        except OSError:
+            # the pipe is full, so the loop will wake up anyway
+            pass
+
+
+class WebSocketServer(asyncore.dispatcher):
+    """Accepts WebSocket connections and keeps their games ticking."""
+
+    tick_interval = 0.5
+    # longest time between looks for events of a connected player
+    event_check_interval = 2
+    # threads doing the game work
+    workers = 4
+
+    def __init__(self, settings, host='0.0.0.0', port=6544):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.session_params = dict(
+            session_factory_from_settings(settings)._options)
+        self.shared_world = asbool(settings.get('snakemud.shared_world',
+                                                False))
+        self.connections = set()
+        self.jobs = Queue.Queue()
+        # (connection, result, failed) of the jobs done
+        self.results = collections.deque()
+        self.waker = Waker(self.map)
+        self.running = True
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(64)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            sock, addr = pair
+            Connection(sock, self)
+
+    def submit(self, connection, job, *args):
+        """Have a worker call job(*args), and connection.done() with the
+        result in the loop."""
+        self.jobs.put((connection, job, args))
+
+    def work(self):
+        while True:
+            item = self.jobs.get()
+            if item is None:
+                return
+            connection, job, args = item
+            try:
+                result, failed = job(*args), False
+            except Exception:
+                log.exception('websocket game error')
+                result, failed = None, True
+            self.results.append((connection, result, failed))
+            self.waker.wake()
+
+    def serve_forever(self):
+        workers = [threading.Thread(target=self.work,
+                                    name='websocket-worker-%d' % n)
+                   for n in range(self.workers)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        last_tick = time.time()
+        while self.running:
+            asyncore.loop(timeout=self.tick_interval, map=self.map, count=1)
+            while self.results:
+                connection, result, failed = self.results.popleft()
+                connection.done(result, failed)
+            now = time.time()
+            if now - last_tick >= self.tick_interval:
+                last_tick = now
+                for connection in list(self.connections):
+                    connection.tick(now)
+        for dispatcher in self.map.values():
+            dispatcher.close()
+        # let the workers write the games of the players that were here
+        for worker in workers:
+            self.jobs.put(None)
+        for worker in workers:
+            worker.join()
+        os.close(self.waker.write_fd)
+
+    def stop(self):
+        """Make serve_forever() close all the connections and return."""
+        self.running = False
+
+    def start(self):
+        """Serve in a background thread."""
+        thread = threading.Thread(target=self.serve_forever,
+                                  name='websocket')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_server(settings):
+    """Start the WebSocket server, if snakemud.websocket_port is set.
+
+    There's one per process, however many times the app is created.
+    """
+    global _server
+    port = settings.get('snakemud.websocket_port')
+    if not port:
+        return None
+    if settings.get('snakemud.journal_dir'):
+        log.warning('not serving WebSockets: they keep games in the'
+                    ' session, not the journal')
+        return None
+    if not live_games.enabled:
+        log.warning('not serving WebSockets: they need the live game cache'
+                    ' (snakemud.live_games)')
+        return None
+    with _server_lock:
+        if _server is None:
+            _server = WebSocketServer(
+                settings, settings.get('snakemud.websocket_host', '0.0.0.0'),
+                int(port))
+            _server.start()
+            log.info('serving WebSockets on port %s', port)
+        return _server
@@ -0,0 +1,208 @@
+import itertools
+import threading
+import time
+
+from snakemud.levels import FLOOR, WALL, NEIGHBOR_BITS, neighbor_cells
+from snakemud.levels import get_template
+
+
+class World(object):
+    """A level shared by the snakes of every player playing it together.
+
+    The snakes live in a spatial index mapping cells to (snake id, what is
+    drawn there), so finding out what's in a cell is a single dict lookup.
+
+    Taking or giving up a cell locks only that cell's lock stripe, so
+    snakes moving about in different parts of the level don't wait for
+    each other.  The snake's set of cells is updated under the same lock,
+    so a cell is never in the index without being in its snake's set,
+    where leave() will find it.
+    """
+
+    lock_stripes = 64
+
+    # forget snakes whose players haven't been around for this long
+    idle_timeout = 15 * 60
+    reap_interval = 60
+
+    def __init__(self, template):
+        self.template = template
+        self.cells = {}
+        self.snakes = {}
+        self.last_seen = {}
+        # y -> a number that changes every time something in that row does
+        self.row_versions = {}
+        self._versions = itertools.count(1)
+        self._locks = [threading.Lock() for n in range(self.lock_stripes)]
+        self._snakes_lock = threading.Lock()
+        self._last_reap = time.time()
+
+    def _lock(self, pos):
+        return self._locks[hash(pos) % self.lock_stripes]
+
+    def _changed(self, (x, y)):
+        self.row_versions[y] = next(self._versions)
+
+    def _body(self, snake_id):
+        return self.snakes.setdefault(snake_id, set())
+
+    def __getitem__(self, pos):
+        entry = self.cells.get(pos)
+        if entry is None:
+            return self.template[pos]
+        return entry[1]
+
+    def neighbors(self, x, y):
+        """Return what's to the north, south, east and west of (x, y)."""
+        mask = self.template.neighbor_mask(x, y)
+        result = []
+        for pos, bit in zip(neighbor_cells(x, y), NEIGHBOR_BITS):
+            entry = self.cells.get(pos)
+            if entry is not None:
+                result.append(entry[1])
+            else:
+                result.append(FLOOR if mask & bit else WALL)
+        return tuple(result)
+
+    def owner(self, pos):
+        """Return the id of the snake in a cell, or None."""
+        entry = self.cells.get(pos)
+        return entry[0] if entry is not None else None
+
+    def row_version(self, y):
+        return self.row_versions.get(y, 0)
+
+    def claim(self, snake_id, pos, what):
+        """Put a snake into an empty cell.
+
+        Returns False if the cell is not empty floor.
+        """
+        if self.template[pos] != FLOOR:
+            return False
+        with self._lock(pos):
+            if pos in self.cells:
+                return False
+            self.cells[pos] = (snake_id, what)
+            with self._snakes_lock:
+                # (a snake that left meanwhile is back)
+                self._body(snake_id).add(pos)
+                self.last_seen[snake_id] = time.time()
+        self._changed(pos)
+        return True
+
+    def put(self, snake_id, pos, what):
+        """Change what a cell held by a snake looks like.
+
+        Returns False if the snake doesn't hold the cell.
+        """
+        with self._lock(pos):
+            entry = self.cells.get(pos)
+            if entry is None or entry[0] != snake_id:
+                return False
+            # moving counts as being around
+            self.last_seen[snake_id] = time.time()
+            if entry[1] == what:
+                return True
+            self.cells[pos] = (snake_id, what)
+        self._changed(pos)
+        return True
+
+    def release(self, snake_id, pos):
+        """Take a snake out of a cell."""
+        with self._lock(pos):
+            entry = self.cells.get(pos)
+            if entry is None or entry[0] != snake_id:
+                return
+            del self.cells[pos]
+            self.snakes.get(snake_id, set()).discard(pos)
+        self._changed(pos)
+
+    def present(self, snake_id):
+        """Is the snake in the level (not reaped or gone)?"""
+        return snake_id in self.snakes
+
+    def join(self, snake_id):
+        """Note that a snake's player is still around."""
+        now = time.time()
+        with self._snakes_lock:
+            self._body(snake_id)
+            self.last_seen[snake_id] = now
+            reap = now - self._last_reap >= self.reap_interval
+            if reap:
+                self._last_reap = now
+        if reap:
+            self.reap(now)
+
+    def rejoin(self, snake_id, cells):
+        """Put a snake back where its player last saw it.
+
+        cells is a list of (pos, what) pairs.  Returns False (and removes
+        the snake) if some other snake took any of these cells meanwhile.
+        """
+        self.join(snake_id)
+        for pos, what in cells:
+            if not (self.put(snake_id, pos, what) or
+                    self.claim(snake_id, pos, what)):
+                self.leave(snake_id)
+                return False
+        stale = self._body(snake_id).difference(pos for pos, what in cells)
+        for pos in stale:
+            self.release(snake_id, pos)
+        return True
+
+    def leave(self, snake_id):
+        """Remove a snake from the level."""
+        with self._snakes_lock:
+            body = self.snakes.pop(snake_id, ())
+            self.last_seen.pop(snake_id, None)
+        for pos in list(body):
+            self.release(snake_id, pos)
+
+    def reap(self, now=None):
+        """Remove the snakes of players who haven't been around lately."""
+        if now is None:
+            now = time.time()
+        with self._snakes_lock:
+            idle = [snake_id for snake_id, seen in self.last_seen.items()
+                    if now - seen > self.idle_timeout]
+        for snake_id in idle:
+            self.leave(snake_id)
+        return len(idle)
+
+    # how many floor cells to look at when looking for free ones
+    free_cell_sample = 1000
+
+    def free_cells(self):
+        """Return some floor cells no snake is in, in random order."""
+        return [pos for pos in self.template.sample_floor(
+                    self.free_cell_sample)
+                if pos not in self.cells]
+
+
+class WorldIndex(object):
+    """The shared worlds of all levels, created as players join them."""
+
+    def __init__(self):
+        self._worlds = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, level):
+        template = get_template(level)
+        with self._lock:
+            world = self._worlds.get(level)
+            if world is None or world.template is not template:
+                # new level, or the map file was changed (development mode)
+                world = self._worlds[level] = World(template)
+            return world
+
+    def clear(self):
+        with self._lock:
+            self._worlds.clear()
+
+
+worlds = WorldIndex()
+
+
+def get_world(level):
+    """Return the shared World for a level number."""
+    return worlds[level]